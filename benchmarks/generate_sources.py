@@ -0,0 +1,308 @@
+"""
+Writes synthetic NHM, NWM and WRF-Hydro source files for benchmarking the extraction scripts
+without the real datasets (92 GB NHM .tar, 2 GB NWM NetCDF, NCAR WRF-Hydro outputs).
+
+The files have the variable names, dimensions, dtypes and time axes that the extractors read:
+- NHM: byHRU_musk_obs.tar, with netcdf/hru_outflow.nc, netcdf/seg_outflow.nc and
+    netcdf/seg_upstream_inflow.nc at member indices 7, 33 and 36 (13,241 days x segments/HRUs)
+- NWM: nwmv21_nwis.nc with hourly streamflow (feature_id x time), feature_id, time, latitude, longitude
+- WRF-Hydro: reaches_daily_* (streamflow) and lakes_daily_* (inflow) files for one configuration
+
+scale is the fraction of the full (CONUS or domain) feature count; time axes are always full length.
+The Pywr-DRB IDs in site_match_registry are always included, so the extractors find every node.
+Chunking and compression are set in source_formats; update them from `ncdump -hs` of the real files.
+
+Flows are random lognormal values with a seasonal cycle, so compression ratios are only indicative.
+The other NHM .tar members are small placeholder files, since tarfile.getmembers() seeks over
+member data rather than reading it.
+"""
+
+import os
+import sys
+import json
+import tarfile
+import tempfile
+
+import numpy as np
+import pandas as pd
+import netCDF4 as nc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_match_registry import get_site_match_registry
+from pywr_drb_node_data import obs_pub_site_matches
+import extract_nhmv10_data
+import extract_nwmv21_data
+import extract_wrf_hydro_data
+
+# Full scale feature counts (scale=1.0)
+full_scale_sizes = {
+    'nhm_segments': 56460,
+    'nhm_hrus': 109951,
+    'nhm_drb_segments': 459,
+    'nwm_features': 7994,
+    'nwm_drb_gauges': 200,
+    'wrf_reaches': 25000,   # approximate DRB domain size
+    'wrf_lakes': 150,
+}
+
+# NetCDF storage settings for each source (time-blocked writes use the chunk length along time)
+source_formats = {
+    'nhm': {'dtype': 'f4', 'zlib': True, 'complevel': 4, 'chunk_days': 365, 'chunk_features': 4096},
+    'nwm': {'dtype': 'i4', 'scale_factor': 0.01, 'zlib': True, 'complevel': 4, 'chunk_hours': 8760, 'chunk_features': 1},
+    'wrf': {'dtype': 'f4', 'zlib': True, 'complevel': 4, 'chunk_days': 365, 'chunk_features': 4096},
+}
+
+nhm_filler_variables = ['basin_cfs', 'basin_ppt', 'dprst_evap_hru', 'dprst_stor_hru', 'dunnian_flow', 'gwres_flow',
+                        'gwres_stor', 'hortonian_flow', 'hru_actet', 'hru_impervstor', 'hru_intcpstor', 'hru_ppt',
+                        'hru_rain', 'hru_snow', 'hru_streamflow_out', 'hru_lateral_flow', 'imperv_evap', 'intcp_evap',
+                        'net_ppt', 'net_rain', 'net_snow', 'pkwater_equiv', 'potet', 'pref_flow', 'seg_gwflow',
+                        'seg_inflow', 'seg_lateral_inflow', 'seg_sroff', 'seg_ssflow', 'slow_flow', 'snowcov_area',
+                        'snowmelt', 'soil_moist', 'soil_rechr', 'sroff', 'ssres_flow', 'swrad', 'tmaxf', 'tminf']
+nhm_members = {7: 'hru_outflow', 33: 'seg_outflow', 36: 'seg_upstream_inflow'}
+nhm_n_members = 40
+
+wrf_config = {'climate': 'aorc', 'calibration': 'calib', 'landcover': 'nlcd2016'}
+
+
+def get_scaled_size(name, scale):
+    """Return the feature count for a scale, at least 1."""
+    return max(1, int(round(full_scale_sizes[name] * scale)))
+
+
+def get_feature_ids(required_ids, n, rng, start=100000):
+    """
+    Gets n unique integer feature IDs which include the required IDs.
+
+    Args:
+        required_ids (list): IDs which must be included.
+        n (int): Number of IDs, at least len(required_ids).
+        rng (np.random.Generator): Random generator.
+        start (int): Smallest filler ID.
+
+    Returns:
+        np.array: Sorted IDs.
+    """
+    required = np.unique(np.array(required_ids, dtype='int64'))
+    n_filler = max(0, n - len(required))
+    filler = np.setdiff1d(start + rng.choice(10 * (n_filler + len(required)) + 1, size=n_filler + len(required), replace=False),
+                          required)[:n_filler]
+    return np.sort(np.concatenate([required, filler]))
+
+
+def get_synthetic_flows(n_times, n_features, rng, steps_per_year=365.25, offset=0):
+    """Return seasonal lognormal flows (cms) of shape (n_times, n_features)."""
+    t = np.arange(offset, offset + n_times)[:, None]
+    seasonal = 1.0 + 0.6 * np.cos(2 * np.pi * t / steps_per_year)
+    base = np.random.default_rng(n_features).lognormal(1.0, 1.0, size=(1, n_features))
+    return (base * seasonal * rng.lognormal(0.0, 0.5, size=(n_times, n_features))).astype('float32')
+
+
+def write_time_feature_netcdf(filename, variable, feature_variable, feature_ids, n_times,
+                              time_units, rng, fmt, time_first=True, steps_per_year=365.25, extra_variables=None):
+    """
+    Writes a flow variable to NetCDF in time blocks.
+
+    Args:
+        filename (str): Output file.
+        variable (str): Flow variable name.
+        feature_variable (str): Name of the feature dimension and ID variable.
+        feature_ids (np.array): Feature IDs.
+        n_times (int): Length of the time axis.
+        time_units (str): CF time units.
+        rng (np.random.Generator): Random generator.
+        fmt (dict): Storage settings from source_formats.
+        time_first (bool): If True, the flow variable is (time, feature), otherwise (feature, time).
+        steps_per_year (float): Time steps per year, for the seasonal cycle.
+        extra_variables (dict, optional): Other feature variables (name: values).
+    """
+    n_features = len(feature_ids)
+    chunk_times = min(n_times, fmt.get('chunk_days', fmt.get('chunk_hours')))
+    chunk_features = min(n_features, fmt['chunk_features'])
+
+    with nc.Dataset(filename, 'w') as ds:
+        ds.createDimension('time', n_times)
+        ds.createDimension(feature_variable, n_features)
+        time = ds.createVariable('time', 'i4', ('time',))
+        time.units = time_units
+        time[:] = np.arange(n_times)
+        ids = ds.createVariable(feature_variable, 'i8', (feature_variable,))
+        ids[:] = feature_ids
+        for name, values in (extra_variables or {}).items():
+            var = ds.createVariable(name, 'f4', (feature_variable,))
+            var[:] = values
+
+        dims = ('time', feature_variable) if time_first else (feature_variable, 'time')
+        chunks = (chunk_times, chunk_features) if time_first else (chunk_features, chunk_times)
+        flow = ds.createVariable(variable, fmt['dtype'], dims, zlib=fmt['zlib'], complevel=fmt['complevel'],
+                                 chunksizes=chunks, fill_value=-9999 if fmt['dtype'] == 'i4' else None)
+        if 'scale_factor' in fmt:
+            flow.scale_factor = fmt['scale_factor']
+
+        for t0 in range(0, n_times, chunk_times):
+            block = get_synthetic_flows(min(chunk_times, n_times - t0), n_features, rng,
+                                        steps_per_year=steps_per_year, offset=t0)
+            if time_first:
+                flow[t0:t0 + len(block), :] = block
+            else:
+                flow[:, t0:t0 + len(block)] = block.T
+
+
+def generate_nhm_source(source_dir, scale, rng):
+    """
+    Writes a synthetic byHRU_musk_obs.tar and the segment/gage matches used by the NHM extractor.
+
+    Returns:
+        dict: Source files and matches.
+    """
+    fmt = source_formats['nhm']
+    n_days = extract_nhmv10_data.nhm_n_days
+    node_ids = [int(i) for i in get_site_match_registry().get_read_list('nhmv10', roles=('node',))]
+    segment_ids = get_feature_ids(node_ids, get_scaled_size('nhm_segments', scale), rng, start=1)
+
+    n_drb = max(len(node_ids), min(len(segment_ids), get_scaled_size('nhm_drb_segments', scale)))
+    drb_segment_ids = np.union1d(node_ids, rng.choice(segment_ids, size=n_drb - len(node_ids), replace=False))
+    drb_segment_ids = [int(i) for i in drb_segment_ids[:n_drb]]
+
+    # The extractor selects HRU outflows using the DRB segment IDs
+    hru_ids = get_feature_ids(drb_segment_ids, get_scaled_size('nhm_hrus', scale), rng, start=1)
+    gage_ids = [g for ids in obs_pub_site_matches.values() if ids for g in ids]
+    gage_segments = {'gage_id': gage_ids,
+                     'nhm_segment_id': [int(i) for i in rng.choice(drb_segment_ids, size=len(gage_ids))]}
+
+    tar_filename = os.path.join(source_dir, extract_nhmv10_data.nhm_tar_filename)
+    fillers = iter(nhm_filler_variables)
+    with tempfile.TemporaryDirectory() as tmp, tarfile.open(tar_filename, 'w') as tar:
+        for i in range(nhm_n_members):
+            name = nhm_members[i] if i in nhm_members else next(fillers)
+            fname = os.path.join(tmp, f'{name}.nc')
+            if i in nhm_members:
+                feature_variable, ids = ('hru', hru_ids) if name.startswith('hru') else ('segment', segment_ids)
+                write_time_feature_netcdf(fname, name, feature_variable, ids, n_days,
+                                          f'days since {extract_nhmv10_data.nhm_start_date}', rng, fmt)
+            else:
+                write_time_feature_netcdf(fname, name, 'segment', segment_ids[:1], 1,
+                                          f'days since {extract_nhmv10_data.nhm_start_date}', rng, fmt)
+            tar.add(fname, arcname=f'netcdf/{name}.nc')
+            os.remove(fname)
+
+    return {'tar_filename': tar_filename,
+            'drb_segment_ids': drb_segment_ids,
+            'gage_segments': gage_segments}
+
+
+def generate_nwm_source(source_dir, scale, rng):
+    """
+    Writes a synthetic nwmv21_nwis.nc and the gauge metadata used by the NWM extractor.
+
+    Returns:
+        dict: Source files.
+    """
+    fmt = source_formats['nwm']
+    n_days = len(pd.date_range(extract_nwmv21_data.nwm_start_date, extract_nwmv21_data.nwm_end_date, freq='D'))
+    node_ids = [int(i) for i in get_site_match_registry().get_read_list('nwmv21', roles=('node',)) if len(i) < 8]
+    feature_ids = get_feature_ids(node_ids + [4147956], get_scaled_size('nwm_features', scale), rng)
+
+    n_gauges = max(len(node_ids), min(len(feature_ids), get_scaled_size('nwm_drb_gauges', scale)))
+    gauge_comids = np.union1d(node_ids, rng.choice(feature_ids, size=n_gauges, replace=False))[:n_gauges]
+    gauge_metadata = pd.DataFrame({'site_no': [f'0{1400000 + i}' for i in range(len(gauge_comids))],
+                                   'comid': gauge_comids})
+    gauge_metadata_filename = os.path.join(source_dir, 'drb_all_usgs_metadata.csv')
+    gauge_metadata.to_csv(gauge_metadata_filename, index=False)
+
+    nwm_filename = os.path.join(source_dir, 'nwmv21_nwis.nc')
+    start_hour = int((pd.Timestamp(extract_nwmv21_data.nwm_start_date) - pd.Timestamp('1970-01-01')) / pd.Timedelta(hours=1))
+    write_time_feature_netcdf(nwm_filename, 'streamflow', 'feature_id', feature_ids, 24 * n_days,
+                              'hours since 1970-01-01 00:00:00', rng, fmt, time_first=False, steps_per_year=24 * 365.25,
+                              extra_variables={'latitude': rng.uniform(38.5, 42.5, len(feature_ids)),
+                                               'longitude': rng.uniform(-76.5, -74.0, len(feature_ids))})
+    with nc.Dataset(nwm_filename, 'a') as ds:
+        ds['time'][:] = start_hour + np.arange(24 * n_days)
+
+    return {'nwm_filename': nwm_filename,
+            'gauge_metadata_filename': gauge_metadata_filename}
+
+
+def generate_wrf_source(source_dir, scale, rng, config=wrf_config):
+    """
+    Writes synthetic WRF-Hydro reach (lakes off) and lake files for one configuration.
+
+    Returns:
+        dict: Source folder and configuration.
+    """
+    fmt = source_formats['wrf']
+    wrf_dir = os.path.join(source_dir, 'WRF-Hydro') + '/'
+    start, end = extract_wrf_hydro_data.date_ranges[config['climate']]
+    n_days = len(pd.date_range(start, end, freq='D'))
+    node_ids = [int(i) for i in get_site_match_registry().get_read_list('wrf')]
+
+    for flowtype, levelpool, variable, size in (('reaches', 'no_pool', 'streamflow', 'wrf_reaches'),
+                                                 ('lakes', 'pool', 'inflow', 'wrf_lakes')):
+        fname = extract_wrf_hydro_data.get_WRF_Hydro_output_filename({**config, 'flowtype': flowtype, 'levelpool': levelpool},
+                                                                      wrf_dir=wrf_dir)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        feature_ids = get_feature_ids(node_ids, get_scaled_size(size, scale), rng)
+        write_time_feature_netcdf(fname, variable, 'feature_id', feature_ids, n_days,
+                                  f'days since {start}', rng, fmt)
+
+    return {'wrf_dir': wrf_dir, 'config': config}
+
+
+source_generators = {
+    'nhmv10': generate_nhm_source,
+    'nwmv21': generate_nwm_source,
+    'wrf_hydro': generate_wrf_source,
+}
+
+
+def get_source_site_ids():
+    """Return the Pywr-DRB IDs which each synthetic source must include, from site_match_registry."""
+    registry = get_site_match_registry()
+    return {'nhmv10': {'nodes': registry.get_read_list('nhmv10'), 'gauges': registry.get_read_list('obs_pub')},
+            'nwmv21': {'nodes': registry.get_read_list('nwmv21')},
+            'wrf_hydro': {'nodes': registry.get_read_list('wrf')}}
+
+
+def generate_sources(source_dir, scale, sources=None, seed=0):
+    """
+    Writes synthetic sources, unless they already exist for the same scale, seed, formats and Pywr-DRB IDs.
+
+    Args:
+        source_dir (str): Output folder for this scale.
+        scale (float): Fraction of full scale feature counts.
+        sources (list, optional): Sources to generate. Defaults to all.
+        seed (int): Random seed.
+
+    Returns:
+        dict: For each source, the files and matches needed to run its extractor.
+    """
+    sources = list(source_generators) if sources is None else sources
+    manifest_filename = os.path.join(source_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+
+    source_site_ids = get_source_site_ids()
+    os.makedirs(source_dir, exist_ok=True)
+    for source in sources:
+        settings = {'scale': scale, 'seed': seed, 'sizes': full_scale_sizes, 'formats': source_formats,
+                    'site_ids': source_site_ids[source]}
+        if manifest.get(source, {}).get('settings') == settings:
+            continue
+        print(f'Generating synthetic {source} source at scale {scale}...')
+        rng = np.random.default_rng([seed, list(source_generators).index(source)])
+        manifest[source] = {'settings': settings, **source_generators[source](source_dir, scale, rng)}
+        with open(manifest_filename, 'w') as f:
+            json.dump(manifest, f, indent=1)
+    return {source: manifest[source] for source in sources}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Write synthetic NHM, NWM and WRF-Hydro sources.')
+    parser.add_argument('source_dir')
+    parser.add_argument('--scale', type=float, default=0.01)
+    parser.add_argument('--sources', nargs='+', choices=list(source_generators), default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_sources(args.source_dir, args.scale, args.sources, args.seed)
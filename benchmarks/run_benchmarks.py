@@ -0,0 +1,209 @@
+"""
+Runs the NHM, NWM and WRF-Hydro extractors against synthetic sources (see generate_sources.py)
+at several scales, and appends wall time, CPU time, peak RSS and bytes read to a JSON lines
+results file, labelled with the git commit, so runs can be compared across commits.
+
+Each extractor run is a separate Python process, so peak RSS is not shared between runs.
+Peak RSS comes from resource.getrusage() and bytes read from /proc/self/io (Linux); both are
+recorded as None where unavailable.
+
+Usage (from the repository root):
+    python benchmarks/run_benchmarks.py --scales 0.01 0.05 --repeat 3
+    python benchmarks/run_benchmarks.py --summary
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+DATA_DIR = os.path.join(BENCHMARK_DIR, 'data')
+RESULTS_FILE = os.path.join(BENCHMARK_DIR, 'results.jsonl')
+
+sys.path.insert(0, REPO_DIR)
+from instrumentation import read_proc_io, get_peak_rss_mb, span
+
+default_scales = [0.01, 0.05]
+extractors = ['nhmv10', 'nwmv21', 'wrf_hydro']
+
+
+def run_nhm(source, output_dir):
+    from extract_nhmv10_data import extract_nhm_drb_flows, get_pywrdrb_nhm_flows
+    from dataset_io import write_flow_dataset
+    import pandas as pd
+
+    for subfolder in ('netcdf', 'csv'):
+        os.makedirs(os.path.join(output_dir, subfolder), exist_ok=True)
+    with span('nhmv10'):
+        drb_seg_outflow = extract_nhm_drb_flows(source['drb_segment_ids'], tar_filename=source['tar_filename'],
+                                                output_dir=output_dir)
+        flows = get_pywrdrb_nhm_flows(drb_seg_outflow, pd.DataFrame(source['gage_segments']))
+        write_flow_dataset(flows, f'{output_dir}/csv/streamflow_daily_nhmv10_mgd', units='mgd', source='nhmv10')
+    return flows.shape
+
+
+def run_nwm(source, output_dir):
+    from extract_nwmv21_data import extract_nwm_gauge_streamflow
+    from dataset_io import write_flow_dataset
+
+    with span('nwmv21'):
+        flows, gauge_matches = extract_nwm_gauge_streamflow(source['nwm_filename'], source['gauge_metadata_filename'])
+        write_flow_dataset(flows, f'{output_dir}/nwmv21_gauge_streamflow_daily_mgd', units='mgd', source='nwmv21')
+        gauge_matches.to_csv(f'{output_dir}/nwmv21_gauge_metadata.csv', index=False)
+    return flows.shape
+
+
+def run_wrf(source, output_dir):
+    from extract_wrf_hydro_data import retrieve_and_export_pywrdrb_input_from_WRF_Hydro_output
+    from pywr_drb_node_data import wrf_hydro_site_matches
+
+    flows = retrieve_and_export_pywrdrb_input_from_WRF_Hydro_output(source['config'], wrf_hydro_site_matches,
+                                                                    return_df=True, wrf_dir=source['wrf_dir'],
+                                                                    output_dir=f'{output_dir}/')
+    return flows.shape
+
+
+extractor_runs = {
+    'nhmv10': run_nhm,
+    'nwmv21': run_nwm,
+    'wrf_hydro': run_wrf,
+}
+
+
+def run_one(extractor, source, output_dir):
+    """
+    Runs one extractor in this process, and measures it.
+
+    Returns:
+        dict: Wall time, CPU time, peak RSS, bytes read and the output shape.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    run = extractor_runs[extractor]
+    rss_before = get_peak_rss_mb()
+    io_before = read_proc_io()
+    cpu_before = time.process_time()
+    start = time.perf_counter()
+
+    shape = run(source, output_dir)
+
+    wall_time = time.perf_counter() - start
+    io_after = read_proc_io()
+    return {'wall_time_s': wall_time,
+            'cpu_time_s': time.process_time() - cpu_before,
+            'peak_rss_mb': get_peak_rss_mb(),
+            'start_rss_mb': rss_before,
+            'bytes_read': io_after['rchar'] - io_before['rchar'] if io_after else None,
+            'disk_bytes_read': io_after['read_bytes'] - io_before['read_bytes'] if io_after else None,
+            'output_shape': list(shape)}
+
+
+def get_git_commit():
+    """Return (commit hash, True if the working tree has changes), or (None, None) outside git."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def run_benchmarks(scales=default_scales, extractors=extractors, repeat=1,
+                   data_dir=DATA_DIR, results_file=RESULTS_FILE, seed=0):
+    """
+    Generates sources for each scale (if needed), runs each extractor in a child process,
+    and appends the results to the results file.
+
+    Args:
+        scales (list): Fractions of full scale feature counts.
+        extractors (list): Extractors to run.
+        repeat (int): Runs of each extractor at each scale.
+        data_dir (str): Folder for synthetic sources and outputs.
+        results_file (str): JSON lines results file.
+        seed (int): Random seed for the synthetic sources.
+
+    Returns:
+        list: Result records.
+    """
+    from generate_sources import generate_sources
+
+    commit, dirty = get_git_commit()
+    records = []
+    for scale in scales:
+        scale_dir = os.path.join(data_dir, f'scale_{scale:g}')
+        sources = generate_sources(os.path.join(scale_dir, 'sources'), scale, extractors, seed=seed)
+        for extractor in extractors:
+            for i in range(repeat):
+                output_dir = os.path.join(scale_dir, 'output', extractor)
+                proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', extractor,
+                                       '--source', json.dumps(sources[extractor]), '--output-dir', output_dir],
+                                      cwd=REPO_DIR, capture_output=True, text=True)
+                record = {'timestamp': datetime.now().isoformat(timespec='seconds'),
+                          'commit': commit, 'dirty': dirty,
+                          'python': platform.python_version(), 'host': platform.node(),
+                          'extractor': extractor, 'scale': scale, 'run': i}
+                if proc.returncode == 0:
+                    record.update(json.loads(proc.stdout.strip().splitlines()[-1]))
+                else:
+                    record['error'] = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f'exit code {proc.returncode}'
+                records.append(record)
+                print(f"{extractor} at scale {scale:g} (run {i}): "
+                      f"{record.get('wall_time_s', float('nan')):.2f} s, {record.get('peak_rss_mb') or float('nan'):.0f} MB peak RSS"
+                      + (f", ERROR: {record['error']}" if 'error' in record else ''))
+
+    with open(results_file, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    print(f'Appended {len(records)} results to {results_file}')
+    return records
+
+
+def summarize_results(results_file=RESULTS_FILE):
+    """
+    Summarizes the results file as the median of each metric by extractor, scale and commit.
+
+    Returns:
+        pd.DataFrame: Median wall time, peak RSS and bytes read.
+    """
+    import pandas as pd
+    results = pd.read_json(results_file, lines=True)
+    if 'error' in results.columns:
+        results = results.loc[results['error'].isna()]
+    results['commit'] = results['commit'].str[:8] + results['dirty'].map({True: '+', False: ''})
+    return results.groupby(['extractor', 'scale', 'commit'], sort=False)[['wall_time_s', 'peak_rss_mb', 'bytes_read']].median()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the extractors against synthetic sources.')
+    parser.add_argument('--scales', type=float, nargs='+', default=default_scales)
+    parser.add_argument('--extractors', nargs='+', choices=extractors, default=extractors)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--results-file', default=RESULTS_FILE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--summary', action='store_true', help='Print the results file summary and exit.')
+    parser.add_argument('--run-one', choices=extractors, help=argparse.SUPPRESS)
+    parser.add_argument('--source', help=argparse.SUPPRESS)
+    parser.add_argument('--output-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_one:
+        # Child process: extractor output goes to stderr, the measurements are the last line of stdout
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        result = run_one(args.run_one, json.loads(args.source), args.output_dir)
+        print(json.dumps(result), file=stdout)
+    elif args.summary:
+        print(summarize_results(args.results_file).to_string())
+    else:
+        run_benchmarks(args.scales, args.extractors, args.repeat, args.data_dir, args.results_file, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Command line interface for the data retrieval and processing scripts.
+
+Each script is a subcommand, which imports the script module and calls its main().
+Modules are only imported when their subcommand runs, so `python cli.py --help`
+does not load pandas, geopandas, netCDF4, statsmodels or matplotlib.
+
+Usage:
+    python cli.py --help
+    python cli.py nhmv10
+    python cli.py --instrument inflow-scaling
+    python cli.py pipeline --dry-run
+"""
+
+import os
+import sys
+import argparse
+import importlib
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Subcommand: (module, description)
+commands = {
+    'usgs': ('retrieve_usgs_data', 'Retrieve USGS gauge flows and the unmanaged gauge metadata.'),
+    'nhmv10': ('extract_nhmv10_data', 'Extract NHMv10 segment flows for the DRB and Pywr-DRB nodes.'),
+    'nwmv21': ('extract_nwmv21_data', 'Extract NWMv2.1 flows at USGS gauges.'),
+    'wrf-hydro': ('extract_wrf_hydro_data', 'Extract WRF-Hydro flows for Pywr-DRB nodes.'),
+    'gap-filling': ('gap_filling', 'Fill gaps in the Pywr-DRB gauge flows from donor gauge regressions.'),
+    'inflow-scaling': ('inflow_scaling_regression', 'Train the inflow scaling regressions and export scaled inflows.'),
+    'scaling-bootstrap': ('inflow_scaling_bootstrap', 'Bootstrap the inflow scaling coefficients.'),
+    'scaling-cv': ('inflow_scaling_cross_validation', 'Cross-validate the inflow scaling configurations.'),
+    'marginal-inflows': ('marginal_inflows', 'Derive marginal catchment inflows for each node.'),
+    'node-basins': ('retrieve_node_basin_geometry', 'Update the node basin geometries from the NLDI.'),
+    'demands': ('disaggregate_drbc_demand_data', 'Aggregate DRBC demands to Pywr-DRB node catchments.'),
+    'site-matches': ('site_match_registry', 'Print the IDs to read for each source.'),
+}
+
+# Subcommands which pass their remaining arguments on to main(argv)
+forwarding_commands = {
+    'pipeline': ('pipeline', 'Run the stages which are out of date (see pipeline.py --help).'),
+    'quality': ('data_quality', 'Check flow datasets for gaps, negative, flat and outlying flows (see data_quality.py --help).'),
+    'synthetic': ('synthetic_generator', 'Generate Kirsch-Nowak synthetic inflow ensembles (see synthetic_generator.py --help).'),
+    'benchmark': ('benchmarks.run_benchmarks', 'Benchmark the extractors (see benchmarks/run_benchmarks.py --help).'),
+}
+
+
+def get_parser():
+    """Return the argument parser, with one subparser per script."""
+    parser = argparse.ArgumentParser(prog='cli.py', description='Pywr-DRB input data retrieval and processing.')
+    parser.add_argument('--instrument', action='store_true', help='Log stage timings (see instrumentation.py).')
+    parser.add_argument('--instrument-log', metavar='FILE', help='Instrumentation log file (implies --instrument).')
+    subparsers = parser.add_subparsers(dest='command', metavar='command', required=True)
+    for name, (_, description) in commands.items():
+        subparsers.add_parser(name, help=description, description=description)
+    for name, (_, description) in forwarding_commands.items():
+        subparser = subparsers.add_parser(name, help=description, description=description, add_help=False)
+        subparser.add_argument('args', nargs=argparse.REMAINDER)
+    return parser
+
+
+def import_command_module(module):
+    """Import a script module; benchmarks.* modules are imported from the benchmarks folder."""
+    if module.startswith('benchmarks.'):
+        sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+        module = module.split('.', 1)[1]
+    sys.path.insert(0, ROOT_DIR)
+    return importlib.import_module(module)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = get_parser()
+    args, extra = parser.parse_known_args(argv)
+    if args.command in forwarding_commands:
+        # arguments after the subcommand belong to it, including any which look like options
+        forwarded = argv[argv.index(args.command) + 1:]
+    elif extra:
+        parser.error(f'unrecognized arguments: {" ".join(extra)}')
+
+    if args.instrument or args.instrument_log:
+        from instrumentation import enable, INSTRUMENT_LOG
+        enable(args.instrument_log or INSTRUMENT_LOG)
+
+    if args.command in forwarding_commands:
+        module = import_command_module(forwarding_commands[args.command][0])
+        return module.main(forwarded)
+    module = import_command_module(commands[args.command][0])
+    return module.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""
+Data quality checks for the streamflow datasets produced by this repo.
+
+Each dataset is read once and checked as one (time x site) array, so all sites are
+checked together. For each site it reports:
+- missing values: count, number of runs, and the longest run
+- negative and zero flows (which break the log transform of the inflow scaling regression)
+- flat lines: runs of at least FLAT_LINE_DAYS identical values
+- outliers: log flows more than OUTLIER_Z robust z-scores from the site's monthly median
+- the first and last dates with data
+and for the date index of each dataset:
+- duplicated dates, non-increasing dates, missing days, and timestamps not at midnight
+  (e.g., daily means aggregated in the wrong time zone)
+
+The report is written as JSON (QUALITY_REPORT), with one entry per dataset which is
+replaced each time that dataset is checked, and the site table in 'split' orientation.
+
+Usage:
+    python data_quality.py                 # check all datasets matching flow_dataset_patterns
+    python data_quality.py <dataset> ...   # check datasets (with or without extension)
+    python data_quality.py --help          # options
+"""
+
+import os
+import glob
+import argparse
+import json
+import fnmatch
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from directories import WRFHYDRO_DIR
+from dataset_io import read_flow_dataset, get_dataset_stem, get_flow_dataset_filename
+from instrumentation import span
+
+QUALITY_REPORT = './datasets/data_quality_report.json'
+
+# Runs of at least this many identical daily values are flagged as flat lines
+FLAT_LINE_DAYS = 7
+
+# Robust z-score (in log flow, against the site's monthly median) above which a value is an outlier
+OUTLIER_Z = 6.0
+
+# Datasets produced by the pipeline stages
+flow_dataset_patterns = ['./datasets/USGS/streamflow_daily_usgs_*',
+                         './datasets/NHMv10/csv/drb_seg_outflow_mgd.*',
+                         './datasets/NHMv10/csv/streamflow_daily_nhmv10_mgd.*',
+                         './datasets/NHMv10/csv/catchment_inflow_*',
+                         './datasets/NWMv21/*streamflow_daily*',
+                         './datasets/NWMv21/catchment_inflow_*',
+                         f'{WRFHYDRO_DIR}streamflow_daily_wrf*',
+                         f'{WRFHYDRO_DIR}catchment_inflow_*',
+                         './datasets/Hybrid/scaled_inflows_*']
+
+site_check_columns = ['n_days', 'n_missing', 'n_missing_runs', 'longest_missing_run',
+                      'n_negative', 'n_zero', 'n_flat_runs', 'longest_flat_run', 'n_outliers',
+                      'first_valid', 'last_valid']
+
+
+def is_flow_dataset(filename, patterns=flow_dataset_patterns):
+    """Return True if a .arrow or .csv file matches one of the flow dataset patterns."""
+    if not filename.endswith(('.arrow', '.csv')):
+        return False
+    filename = os.path.normpath(filename)
+    return any(fnmatch.fnmatch(filename, os.path.normpath(p)) for p in patterns)
+
+
+def find_flow_datasets(patterns=flow_dataset_patterns):
+    """
+    Finds the produced flow datasets.
+
+    Returns:
+        list: Dataset filenames (the .arrow file where both .arrow and .csv exist).
+    """
+    stems = []
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern)):
+            stem = get_dataset_stem(filename)
+            if is_flow_dataset(filename, patterns) and stem not in stems:
+                stems.append(stem)
+    return [get_flow_dataset_filename(stem) for stem in stems]
+
+
+def get_run_lengths(mask):
+    """
+    Return the length of the run of True values ending at each position of each column (0 where False).
+
+    Args:
+        mask (np.ndarray): Boolean (time x site) array.
+
+    Returns:
+        np.ndarray: Run lengths with the same shape as mask.
+    """
+    counts = np.cumsum(mask, axis=0, dtype='int32')
+    return counts - np.maximum.accumulate(np.where(mask, 0, counts), axis=0)
+
+
+def check_date_index(index):
+    """
+    Checks a dataset date index for irregularities.
+
+    Args:
+        index (pd.DatetimeIndex): Date index.
+
+    Returns:
+        dict: start, end, n_dates, n_duplicated, n_not_increasing, n_missing_days,
+            n_not_midnight and tz.
+    """
+    index = pd.DatetimeIndex(index)
+    values = index.tz_localize(None).values if index.tz is not None else index.values
+    days = values.astype('datetime64[D]')
+    steps = np.diff(days.astype('int64'))
+    unique_days = np.unique(days)
+    n_expected = int((unique_days[-1] - unique_days[0]).astype('int64')) + 1 if len(unique_days) else 0
+    return {'start': str(unique_days[0]) if len(unique_days) else None,
+            'end': str(unique_days[-1]) if len(unique_days) else None,
+            'n_dates': len(index),
+            'n_duplicated': int(index.duplicated().sum()),
+            'n_not_increasing': int((steps < 0).sum()),
+            'n_missing_days': n_expected - len(unique_days),
+            'n_not_midnight': int((values != days).sum()),
+            'tz': None if index.tz is None else str(index.tz)}
+
+
+def check_site_flows(df, flat_line_days=FLAT_LINE_DAYS, outlier_z=OUTLIER_Z):
+    """
+    Checks the flows of all sites in a dataset in one pass over the (time x site) array.
+
+    Args:
+        df (pd.DataFrame): Flows with a DatetimeIndex, one column per site.
+        flat_line_days (int): Minimum length of a flat line.
+        outlier_z (float): Robust z-score above which a value is an outlier.
+
+    Returns:
+        pd.DataFrame: site_check_columns for each site.
+    """
+    values = df.to_numpy(dtype='float64', na_value=np.nan)
+    missing = np.isnan(values)
+
+    # Missing runs; the number of runs is the number of run starts (run length of 1)
+    missing_runs = get_run_lengths(missing)
+
+    # Flat lines: runs of days equal to the previous day (NaN never equals NaN)
+    same = np.zeros(values.shape, dtype=bool)
+    same[1:] = values[1:] == values[:-1]
+    flat_runs = get_run_lengths(same)
+
+    # Outliers against monthly climatology, using the median absolute deviation of log flows
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_values = np.where(values > 0, np.log(values), np.nan)
+    months = pd.DatetimeIndex(df.index).month.values
+    n_outliers = np.zeros(values.shape[1], dtype='int64')
+    for m in np.unique(months):
+        month_values = log_values[months == m]
+        if np.isnan(month_values).all():
+            continue
+        with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+            # all-NaN sites have no climatology
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(month_values, axis=0)
+            mad = np.nanmedian(np.abs(month_values - median), axis=0)
+            z = 0.6745*np.abs(month_values - median)/mad
+        n_outliers += np.where(np.isfinite(z), z > outlier_z, False).sum(axis=0)
+
+    valid = ~missing
+    has_data = valid.any(axis=0)
+    first_valid = np.where(has_data, valid.argmax(axis=0), -1)
+    last_valid = np.where(has_data, len(values) - 1 - valid[::-1].argmax(axis=0), -1)
+    dates = pd.DatetimeIndex(df.index).strftime('%Y-%m-%d').values
+    with np.errstate(invalid='ignore'):
+        report = pd.DataFrame({'n_days': len(values),
+                               'n_missing': missing.sum(axis=0),
+                               'n_missing_runs': (missing_runs == 1).sum(axis=0),
+                               'longest_missing_run': missing_runs.max(axis=0, initial=0),
+                               'n_negative': (values < 0).sum(axis=0),
+                               'n_zero': (values == 0).sum(axis=0),
+                               'n_flat_runs': (flat_runs == flat_line_days - 1).sum(axis=0),
+                               'longest_flat_run': np.where(has_data, flat_runs.max(axis=0, initial=0) + 1, 0),
+                               'n_outliers': n_outliers,
+                               'first_valid': np.where(has_data, dates[first_valid], None),
+                               'last_valid': np.where(has_data, dates[last_valid], None)},
+                              index=pd.Index([str(c) for c in df.columns], name='site'))
+    return report[site_check_columns]
+
+
+def summarize_site_checks(site_checks, flat_line_days=FLAT_LINE_DAYS):
+    """Return the number of sites with each issue."""
+    return {'n_sites': len(site_checks),
+            'sites_missing': int((site_checks['n_missing'] > 0).sum()),
+            'sites_all_missing': int((site_checks['n_missing'] == site_checks['n_days']).sum()),
+            'sites_negative': int((site_checks['n_negative'] > 0).sum()),
+            'sites_zero': int((site_checks['n_zero'] > 0).sum()),
+            'sites_flat': int((site_checks['longest_flat_run'] >= flat_line_days).sum()),
+            'sites_outliers': int((site_checks['n_outliers'] > 0).sum())}
+
+
+def check_dataset(filename):
+    """
+    Checks one flow dataset.
+
+    Args:
+        filename (str): Dataset filename, with or without extension.
+
+    Returns:
+        dict: 'filename', 'index' (see check_date_index), 'summary', and 'sites' (pd.DataFrame).
+    """
+    with span('quality', filename=filename) as s:
+        df = read_flow_dataset(filename)
+        s.set_shape(df)
+        site_checks = check_site_flows(df)
+    return {'filename': get_flow_dataset_filename(filename),
+            'index': check_date_index(df.index),
+            'summary': summarize_site_checks(site_checks),
+            'sites': site_checks}
+
+
+def get_issues(result):
+    """Return a list of short descriptions of the issues found in one dataset."""
+    issues = [f'{k} {v}' for k, v in result['index'].items() if k.startswith('n_') and k != 'n_dates' and v]
+    issues += [f'{k} {v}' for k, v in result['summary'].items() if k != 'n_sites' and v]
+    return issues
+
+
+def write_quality_report(results, report_filename=QUALITY_REPORT):
+    """
+    Writes (or updates) the JSON quality report, replacing the entries of the checked datasets.
+
+    Args:
+        results (list): Outputs of check_dataset().
+        report_filename (str): JSON report.
+    """
+    report = {}
+    if os.path.exists(report_filename):
+        with open(report_filename, 'r') as f:
+            report = json.load(f)
+    for result in results:
+        report[os.path.relpath(result['filename'])] = {
+            'checked': pd.Timestamp.now().isoformat(timespec='seconds'),
+            'index': result['index'],
+            'summary': result['summary'],
+            'sites': json.loads(result['sites'].to_json(orient='split'))}
+
+    folder = os.path.dirname(report_filename)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    with open(report_filename, 'w') as f:
+        json.dump(report, f, separators=(',', ':'))
+
+
+def check_datasets(filenames=None, report_filename=QUALITY_REPORT):
+    """
+    Checks flow datasets, prints any issues, and updates the quality report.
+    Datasets which cannot be read are reported and skipped.
+
+    Args:
+        filenames (list, optional): Datasets to check. Defaults to all produced datasets (find_flow_datasets()).
+        report_filename (str, optional): JSON report. If None, no report is written.
+
+    Returns:
+        list: Outputs of check_dataset().
+    """
+    filenames = find_flow_datasets() if filenames is None else filenames
+    results = []
+    for filename in filenames:
+        try:
+            result = check_dataset(filename)
+        except (OSError, ValueError) as e:
+            # e.g., a missing file, or a file which is not a flow dataset
+            print(f'{filename}: could not be read ({e})')
+            continue
+        issues = get_issues(result)
+        print(f'{result["filename"]}: ' + (', '.join(issues) if issues else 'no issues'))
+        results.append(result)
+    if report_filename is not None and results:
+        write_quality_report(results, report_filename)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check flow datasets for gaps, negative, flat and outlying flows.')
+    parser.add_argument('datasets', nargs='*',
+                        help='Datasets to check, with or without extension (default: all datasets matching flow_dataset_patterns).')
+    parser.add_argument('--report', default=QUALITY_REPORT, help=f'JSON report to update (default: {QUALITY_REPORT}).')
+    args = parser.parse_args(argv)
+    check_datasets(args.datasets or None, report_filename=args.report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,462 @@
+"""
+Columnar binary storage for the streamflow datasets exported by this repo.
+
+Datasets (e.g., streamflow_daily_*, scaled_inflows_*) are written as Arrow IPC (Feather v2) files,
+with zstd compressed float columns, the date index stored as int32 days since 1970-01-01, and
+metadata (units, source, site matches) in the schema. CSV remains an optional export.
+
+read_flow_dataset() reads either format from a filename with or without extension, preferring
+the .arrow file if both exist, so readers do not need to know which format was exported.
+Files written with compression=None can be memory-mapped; read_flow_table() then gives
+zero-copy access to the columns. Compressed files (the FLOW_COMPRESSION default) are decompressed
+into memory when read, so set FLOW_COMPRESSION = None where mapping matters (e.g., large datasets
+read by many processes).
+
+For running many Pywr-DRB simulations in parallel, datasets can also be exported as flow arrays:
+a (node x time) float .npy file, with each node's series contiguous, and a small .json header
+(node order, start date, units). read_flow_array() memory-maps the array read-only, so all
+worker processes share one page-cache copy and loading does not depend on the data size.
+Ensembles (e.g., synthetic inflows) are stored the same way, as a (realization x time x node)
+.npy file with a .json header, which worker processes fill in place (see create_ensemble_array()).
+
+Precision policy: flows are held in memory and written as FLOW_DTYPE (float32 by default), since
+the source models carry far fewer significant digits than float64. CSV exports are rounded to
+CSV_SIGNIFICANT_DIGITS. Regressions and differences of large flows (e.g., marginal inflows) are
+computed in float64 and cast when stored. Each cast records the maximum absolute difference from
+the float64 values (max_abs_diff) on its instrumentation span and in the dataset metadata.
+"""
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from instrumentation import span
+
+FLOW_DATASET_EXTENSION = '.arrow'
+DATE_COLUMN = '__date__'
+METADATA_KEY = b'pywrdrb'
+
+FLOW_ARRAY_EXTENSION = '.npy'
+FLOW_ARRAY_HEADER_EXTENSION = '.json'
+
+# Precision policy: dtype of flows in memory and on disk, either 'float32' or 'float64'
+FLOW_DTYPE = 'float32'
+
+# Lossless compression of .arrow files: 'zstd', 'lz4', or None (only uncompressed files are read zero-copy)
+FLOW_COMPRESSION = 'zstd'
+
+# Significant digits of flows in CSV exports (float32 holds 7)
+CSV_SIGNIFICANT_DIGITS = 7
+CSV_FLOAT_FORMAT = f'%.{CSV_SIGNIFICANT_DIGITS}g'
+
+# If True, a CSV copy is also written with each dataset
+EXPORT_CSV = False
+
+# If True, a memory-mappable flow array is also written with each dataset
+EXPORT_FLOW_ARRAY = False
+
+
+def get_dataset_stem(filename):
+    """Return the filename without a .arrow or .csv extension."""
+    stem, ext = os.path.splitext(filename)
+    return stem if ext in (FLOW_DATASET_EXTENSION, '.csv', FLOW_ARRAY_EXTENSION, FLOW_ARRAY_HEADER_EXTENSION) else filename
+
+
+def get_max_abs_difference(values, baseline):
+    """Return the maximum absolute difference between two arrays, ignoring NaN (0.0 if there are no values)."""
+    diff = np.abs(np.asarray(values, dtype='float64') - np.asarray(baseline, dtype='float64'))
+    diff = diff[~np.isnan(diff)]
+    return float(diff.max()) if diff.size else 0.0
+
+
+def cast_flows(data, dtype=None, s=None):
+    """
+    Casts flows to the precision policy dtype, and records the maximum absolute difference
+    from the float64 values on a span.
+
+    Args:
+        data (pd.DataFrame or np.ndarray): Flows, e.g., in float64 after a unit conversion.
+        dtype (str, optional): Either 'float32' or 'float64'. Defaults to FLOW_DTYPE.
+        s (instrumentation.Span, optional): Span to record dtype and max_abs_diff on.
+
+    Returns:
+        pd.DataFrame or np.ndarray: Flows as dtype.
+    """
+    dtype = np.dtype(FLOW_DTYPE if dtype is None else dtype)
+    if isinstance(data, pd.DataFrame):
+        baseline = data.to_numpy(dtype='float64', na_value=np.nan)
+        cast = pd.DataFrame(baseline.astype(dtype), index=data.index, columns=data.columns)
+    else:
+        baseline = np.ma.filled(np.ma.asarray(data).astype('float64'), np.nan)
+        cast = baseline.astype(dtype)
+    if s is not None:
+        s.set(dtype=dtype.name, max_abs_diff=get_max_abs_difference(cast, baseline))
+    return cast
+
+
+def round_significant(values, digits=CSV_SIGNIFICANT_DIGITS):
+    """Round values to significant digits, as in a '%.{digits}g' format."""
+    values = np.asarray(values, dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponent = np.floor(np.log10(np.abs(values)))
+    exponent = np.where(np.isfinite(exponent), exponent, 0)
+    scale = 10.0**(digits - 1 - exponent)
+    return np.round(values * scale) / scale
+
+
+def get_flow_dataset_filename(filename):
+    """
+    Finds the exported file for a dataset.
+
+    Args:
+        filename (str): Dataset filename, with or without extension.
+
+    Returns:
+        str: The .arrow file if it exists, otherwise the .csv file.
+    """
+    stem = get_dataset_stem(filename)
+    for ext in (FLOW_DATASET_EXTENSION, '.csv'):
+        if os.path.exists(f'{stem}{ext}'):
+            return f'{stem}{ext}'
+    raise FileNotFoundError(f'No {FLOW_DATASET_EXTENSION} or .csv file found for {filename}')
+
+
+def write_flow_dataset(df, filename,
+                       units='mgd',
+                       source=None,
+                       site_matches=None,
+                       dtype=None,
+                       compression=FLOW_COMPRESSION,
+                       export_csv=None,
+                       export_array=None):
+    """
+    Writes a daily flow dataset as an Arrow IPC file.
+
+    Args:
+        df (pd.DataFrame): Flows with a DatetimeIndex.
+        filename (str): Output filename, with or without extension.
+        units (str): Flow units.
+        source (str, optional): Dataset source (e.g., 'nhmv10').
+        site_matches (dict, optional): Node/site matches used to select the columns.
+        dtype (str, optional): Either 'float64' or 'float32'. Defaults to FLOW_DTYPE.
+        compression (str, optional): Either 'zstd', 'lz4', or None (allows memory-mapping).
+        export_csv (bool, optional): If True, also write a CSV. Defaults to EXPORT_CSV.
+        export_array (bool, optional): If True, also write a flow array. Defaults to EXPORT_FLOW_ARRAY.
+
+    Returns:
+        str: Filename of the .arrow file.
+    """
+    stem = get_dataset_stem(filename)
+    dtype = np.dtype(FLOW_DTYPE if dtype is None else dtype)
+    with span('export', filename=f'{stem}{FLOW_DATASET_EXTENSION}') as s:
+        s.set_shape(df)
+        index = pd.DatetimeIndex(df.index)
+        days = index.values.astype('datetime64[D]').astype('int32')
+
+        values = df.to_numpy(dtype='float64', na_value=np.nan)
+        cast = values.astype(dtype)
+        max_abs_diff = get_max_abs_difference(cast, values)
+        s.set(dtype=dtype.name, max_abs_diff=max_abs_diff)
+
+        names = [DATE_COLUMN] + [str(c) for c in df.columns]
+        arrays = [pa.array(days)] + [pa.array(cast[:, i]) for i in range(df.shape[1])]
+        metadata = {'units': units,
+                    'source': source,
+                    'site_matches': site_matches,
+                    'index_name': df.index.name,
+                    'dtype': dtype.name,
+                    'max_abs_diff': max_abs_diff}
+        table = pa.Table.from_arrays(arrays, names=names,
+                                     metadata={METADATA_KEY: json.dumps(metadata, default=str).encode()})
+
+        fname = f'{stem}{FLOW_DATASET_EXTENSION}'
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        with pa.OSFile(fname, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+    print(f'{fname}: {dtype.name}, max abs difference from float64 {max_abs_diff:.3g} {units}')
+
+    if EXPORT_CSV if export_csv is None else export_csv:
+        write_flow_csv(pd.DataFrame(cast, index=df.index, columns=df.columns), f'{stem}.csv', baseline=values)
+    if EXPORT_FLOW_ARRAY if export_array is None else export_array:
+        write_flow_array(df, stem, units=units, source=source, dtype=dtype)
+    return fname
+
+
+def write_flow_csv(df, filename, baseline=None, **kwargs):
+    """
+    Writes flows to CSV, rounded to CSV_SIGNIFICANT_DIGITS.
+
+    Args:
+        df (pd.DataFrame): Flows.
+        filename (str): Output .csv filename.
+        baseline (np.ndarray, optional): float64 flows to report the max abs difference from. Defaults to df.
+        **kwargs: Passed to pd.DataFrame.to_csv().
+
+    Returns:
+        float: Maximum absolute difference of the CSV values from the baseline.
+    """
+    with span('export', filename=filename) as s:
+        s.set_shape(df)
+        values = df.to_numpy(dtype='float64', na_value=np.nan)
+        max_abs_diff = get_max_abs_difference(round_significant(values), values if baseline is None else baseline)
+        s.set(max_abs_diff=max_abs_diff)
+        df.to_csv(filename, sep=',', float_format=CSV_FLOAT_FORMAT, **kwargs)
+    return max_abs_diff
+
+
+def read_flow_table(filename, memory_map=True):
+    """
+    Reads an Arrow flow dataset as a pa.Table. For uncompressed files which are memory-mapped,
+    the columns are zero-copy views of the file.
+
+    Args:
+        filename (str): Dataset filename, with or without extension.
+        memory_map (bool): If True, memory-map the file instead of reading it.
+
+    Returns:
+        pa.Table: Table with the DATE_COLUMN and one column for each site.
+    """
+    fname = f'{get_dataset_stem(filename)}{FLOW_DATASET_EXTENSION}'
+    # The table's buffers keep the mapping alive after the file is closed
+    with (pa.memory_map(fname, 'r') if memory_map else pa.OSFile(fname, 'rb')) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def read_flow_dataset_metadata(filename):
+    """Return the metadata (units, source, site_matches, index_name) of an Arrow flow dataset."""
+    fname = f'{get_dataset_stem(filename)}{FLOW_DATASET_EXTENSION}'
+    with pa.memory_map(fname, 'r') as source:
+        schema = pa.ipc.open_file(source).schema
+    return json.loads(schema.metadata[METADATA_KEY])
+
+
+def read_flow_dataset(filename, columns=None, memory_map=True, dtype=None):
+    """
+    Reads a daily flow dataset written by write_flow_dataset(), or a CSV with a date index.
+
+    Args:
+        filename (str): Dataset filename, with or without extension.
+        columns (list, optional): Columns to read. Defaults to all.
+        memory_map (bool): If True, memory-map Arrow files instead of reading them.
+        dtype (str, optional): Either 'float32' or 'float64' (e.g., for regressions). Defaults to FLOW_DTYPE.
+
+    Returns:
+        pd.DataFrame: Flows with a DatetimeIndex.
+    """
+    fname = get_flow_dataset_filename(filename)
+    with span('load', filename=fname) as s:
+        if fname.endswith('.csv'):
+            df = pd.read_csv(fname, index_col=0, parse_dates=True)
+            df = df if columns is None else df.loc[:, columns]
+        else:
+            table = read_flow_table(fname, memory_map=memory_map)
+            if columns is not None:
+                table = table.select([DATE_COLUMN] + [str(c) for c in columns])
+            metadata = json.loads(table.schema.metadata[METADATA_KEY])
+
+            index = pd.to_datetime(table.column(DATE_COLUMN).to_numpy(), unit='D')
+            index.name = metadata['index_name']
+            df = table.drop_columns([DATE_COLUMN]).to_pandas()
+            df.index = index
+        df = df.astype(FLOW_DTYPE if dtype is None else dtype)
+        s.set_shape(df)
+    return df
+
+
+def write_flow_array(df, filename, units='mgd', source=None, dtype=None):
+    """
+    Writes a daily flow dataset as a memory-mappable (node x time) .npy array with a .json header.
+    Both files are written to temporary names and then renamed, so workers never map a partial file.
+
+    Args:
+        df (pd.DataFrame): Flows with a daily DatetimeIndex and node columns.
+        filename (str): Output filename, with or without extension.
+        units (str): Flow units.
+        source (str, optional): Dataset source (e.g., 'nhmv10').
+        dtype (str, optional): Either 'float64' or 'float32'. Defaults to FLOW_DTYPE.
+
+    Returns:
+        str: Filename of the .npy file.
+    """
+    stem = get_dataset_stem(filename)
+    dtype = np.dtype(FLOW_DTYPE if dtype is None else dtype)
+    index = pd.DatetimeIndex(df.index)
+    if len(index) > 1 and not (np.diff(index.values.astype('datetime64[D]').astype('int64')) == 1).all():
+        raise ValueError(f'Flow arrays require a continuous daily index: {filename}')
+
+    header = {'nodes': [str(c) for c in df.columns],
+              'start_date': index[0].strftime('%Y-%m-%d') if len(index) else None,
+              'n_days': len(index),
+              'freq': 'D',
+              'units': units,
+              'source': source,
+              'dtype': np.dtype(dtype).name,
+              'layout': 'node x time'}
+
+    fname = f'{stem}{FLOW_ARRAY_EXTENSION}'
+    header_fname = f'{stem}{FLOW_ARRAY_HEADER_EXTENSION}'
+    with span('export', filename=fname) as s:
+        s.set_shape(df)
+        values = np.lib.format.open_memmap(f'{fname}.tmp', mode='w+', dtype=dtype, shape=(df.shape[1], len(index)))
+        values[:] = df.to_numpy(dtype=dtype, na_value=np.nan).T
+        values.flush()
+        del values
+        with open(f'{header_fname}.tmp', 'w') as f:
+            json.dump(header, f, indent=1)
+
+        os.replace(f'{fname}.tmp', fname)
+        os.replace(f'{header_fname}.tmp', header_fname)
+    return fname
+
+
+def read_flow_array_header(filename):
+    """Return the header (nodes, start_date, n_days, units, ...) of a flow array."""
+    with open(f'{get_dataset_stem(filename)}{FLOW_ARRAY_HEADER_EXTENSION}') as f:
+        return json.load(f)
+
+
+def read_flow_array(filename):
+    """
+    Attaches to a flow array written by write_flow_array(), read-only and without copying.
+
+    Args:
+        filename (str): Dataset filename, with or without extension.
+
+    Returns:
+        tuple: (np.memmap of shape (node, time), header dict)
+    """
+    header = read_flow_array_header(filename)
+    values = np.load(f'{get_dataset_stem(filename)}{FLOW_ARRAY_EXTENSION}', mmap_mode='r')
+    if values.shape != (len(header['nodes']), header['n_days']):
+        raise ValueError(f'Flow array shape {values.shape} does not match the header of {filename}')
+    return values, header
+
+
+def get_flow_array_dates(header):
+    """Return the DatetimeIndex of a flow array from its header."""
+    return pd.date_range(header['start_date'], periods=header['n_days'], freq=header['freq'])
+
+
+def read_flow_array_series(filename, node):
+    """
+    Gets the flow series of one node from a flow array, as a read-only view of the mapped file.
+
+    Args:
+        filename (str): Dataset filename, with or without extension.
+        node (str): Node name.
+
+    Returns:
+        pd.Series: Flows with a DatetimeIndex.
+    """
+    values, header = read_flow_array(filename)
+    return pd.Series(values[header['nodes'].index(node)], index=get_flow_array_dates(header),
+                     name=node, copy=False)
+
+
+def get_ensemble_dates(start_date, n_days, calendar='standard'):
+    """
+    Return the dates of an ensemble array.
+
+    Args:
+        start_date (str): First date.
+        n_days (int): Number of days.
+        calendar (str): 'standard', or 'noleap' for 365 day years without Feb 29.
+
+    Returns:
+        pd.DatetimeIndex: Dates.
+    """
+    if calendar != 'noleap':
+        return pd.date_range(start_date, periods=n_days, freq='D')
+    # Enough standard days to hold n_days after dropping leap days
+    dates = pd.date_range(start_date, periods=n_days + n_days//365 + 1, freq='D')
+    return dates[~((dates.month == 2) & (dates.day == 29))][:n_days]
+
+
+def create_ensemble_array(filename, nodes, n_realizations, start_date, n_days,
+                          calendar='standard', units='mgd', source=None, dtype=None, **metadata):
+    """
+    Creates an empty (realization x time x node) ensemble array, under temporary names, for
+    worker processes to fill with open_ensemble_array(..., mode='r+'). Call commit_ensemble_array()
+    once all realizations are written, so readers never map a partial ensemble.
+
+    Args:
+        filename (str): Output filename, with or without extension.
+        nodes (list): Node names.
+        n_realizations (int): Number of realizations.
+        start_date (str): First date.
+        n_days (int): Number of days.
+        calendar (str): 'standard', or 'noleap' for 365 day years without Feb 29.
+        units (str): Flow units.
+        source (str, optional): Dataset source (e.g., 'kirsch_nowak').
+        dtype (str, optional): Either 'float64' or 'float32'. Defaults to FLOW_DTYPE.
+        **metadata: Other header entries (e.g., seed).
+
+    Returns:
+        str: Filename of the temporary .npy file.
+    """
+    stem = get_dataset_stem(filename)
+    dtype = np.dtype(FLOW_DTYPE if dtype is None else dtype)
+    header = {'nodes': [str(n) for n in nodes],
+              'n_realizations': n_realizations,
+              'start_date': pd.Timestamp(start_date).strftime('%Y-%m-%d'),
+              'n_days': n_days,
+              'calendar': calendar,
+              'units': units,
+              'source': source,
+              'dtype': dtype.name,
+              'layout': 'realization x time x node',
+              **metadata}
+
+    tmp_fname = f'{stem}{FLOW_ARRAY_EXTENSION}.tmp'
+    values = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=dtype, shape=(n_realizations, n_days, len(nodes)))
+    del values
+    with open(f'{stem}{FLOW_ARRAY_HEADER_EXTENSION}.tmp', 'w') as f:
+        json.dump(header, f, indent=1)
+    return tmp_fname
+
+
+def open_ensemble_array(filename, mode='r'):
+    """
+    Memory-maps an ensemble array without copying.
+
+    Args:
+        filename (str): Dataset filename, with or without extension.
+        mode (str): 'r' for a committed ensemble, or 'r+' to write an uncommitted one.
+
+    Returns:
+        tuple: (np.memmap of shape (realization, time, node), header dict)
+    """
+    stem = get_dataset_stem(filename)
+    suffix = '.tmp' if mode == 'r+' else ''
+    with open(f'{stem}{FLOW_ARRAY_HEADER_EXTENSION}{suffix}') as f:
+        header = json.load(f)
+    values = np.load(f'{stem}{FLOW_ARRAY_EXTENSION}{suffix}', mmap_mode=mode)
+    if values.shape != (header['n_realizations'], header['n_days'], len(header['nodes'])):
+        raise ValueError(f'Ensemble array shape {values.shape} does not match the header of {filename}')
+    return values, header
+
+
+def commit_ensemble_array(filename):
+    """
+    Renames a filled ensemble array from its temporary names.
+
+    Returns:
+        str: Filename of the .npy file.
+    """
+    stem = get_dataset_stem(filename)
+    fname = f'{stem}{FLOW_ARRAY_EXTENSION}'
+    os.replace(f'{fname}.tmp', fname)
+    os.replace(f'{stem}{FLOW_ARRAY_HEADER_EXTENSION}.tmp', f'{stem}{FLOW_ARRAY_HEADER_EXTENSION}')
+    return fname
+
+
+def discard_ensemble_array(filename):
+    """Removes the temporary files of an uncommitted ensemble array (e.g., after a failed run)."""
+    stem = get_dataset_stem(filename)
+    for fname in [f'{stem}{FLOW_ARRAY_EXTENSION}.tmp', f'{stem}{FLOW_ARRAY_HEADER_EXTENSION}.tmp']:
+        if os.path.exists(fname):
+            os.remove(fname)
@@ -1,25 +1,168 @@
+"""
+Irrigated fraction of each WEAP catchment from the MIrAD 250m rasters.
+
+The catchments are rasterized once into a label grid (0 = outside all catchments) covering
+only the catchments' bounding box, and cached on disk for each raster grid. Each year's raster
+is then read in blocks of rows within that window, and the (label, class) pixel counts are
+found with np.bincount. Years are processed in parallel.
+
+Pixels are assigned to the catchment containing their center, as in rasterstats.zonal_stats(),
+and the irrigated fraction is class 1 over all classes except 255 (and the raster's nodata value).
+"""
+
+import os
+import sys
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
 import rasterio
-from rasterstats import zonal_stats
+from rasterio import features
+from rasterio.windows import Window
 import geopandas as gpd
 
-v = gpd.GeoDataFrame.from_file("WEAP_catchments_fixed.zip")
-fname='mirad250_17v4.tif'
-r = rasterio.open("mirad250m_DRB/{}".format(fname))
-v = v.to_crs(r.crs)
-
-fnames=['mirad250_02v4.tif','mirad250_07v4.tif','mirad250_12v4.tif','mirad250_17v4.tif']
-years=[2002,2007,2012,2017]
-frac_list = []
-for fname,yr in zip(fnames,years):
-    r = rasterio.open("mirad250m_DRB/{}".format(fname))
-    arr=r.read(1)
-    affine=r.transform
-    zs=zonal_stats(v,arr,affine=affine,categorical=True)
-    stats = pd.DataFrame(zs).fillna(0).drop(255,axis=1)
-    f=stats[1]/stats.sum(axis=1)
-    f.name=yr
-    frac_list.append(f)
-frac = pd.concat(frac_list,axis=1)
-frac.index=v['ObjID'] # or 'BasinID' or 'Name'
-frac.to_excel('irrigated_fraction.xlsx')
\ No newline at end of file
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from instrumentation import span
+
+catchment_filename = "WEAP_catchments_fixed.zip"
+raster_dir = "mirad250m_DRB"
+cache_dir = "cache"
+
+fnames = ['mirad250_02v4.tif', 'mirad250_07v4.tif', 'mirad250_12v4.tif', 'mirad250_17v4.tif']
+years = [2002, 2007, 2012, 2017]
+
+irrigated_class = 1
+excluded_class = 255
+
+# Number of raster rows to read at a time
+block_rows = 1024
+
+
+def get_catchment_window(catchments, raster):
+    """
+    Gets the raster window covering the bounding box of the catchments.
+
+    Args:
+        catchments (gpd.GeoDataFrame): Catchments in the raster CRS.
+        raster (rasterio.DatasetReader): Open raster.
+
+    Returns:
+        Window: Window clipped to the raster extent.
+    """
+    minx, miny, maxx, maxy = catchments.total_bounds
+    rows, cols = rasterio.transform.rowcol(raster.transform, [minx, maxx], [maxy, miny])
+    row_start, row_stop = max(min(rows), 0), min(max(rows) + 1, raster.height)
+    col_start, col_stop = max(min(cols), 0), min(max(cols) + 1, raster.width)
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def get_catchment_labels(catchments, raster_filename, catchment_filename=catchment_filename, cache_dir=cache_dir):
+    """
+    Rasterizes the catchments onto the grid of a raster, within the catchments' bounding box.
+    The label grid is cached for each catchment file and raster grid.
+
+    Args:
+        catchments (gpd.GeoDataFrame): Catchment polygons.
+        raster_filename (str): Raster defining the grid.
+        catchment_filename (str): File the catchments were loaded from; used for the cache key.
+        cache_dir (str): Folder for cached label grids.
+
+    Returns:
+        str: Filename of the cached label grid (.npz with 'labels' and 'window').
+    """
+    with rasterio.open(raster_filename) as r:
+        grid = f"{r.crs}|{tuple(r.transform)}|{r.width}|{r.height}"
+        with open(catchment_filename, "rb") as f:
+            key = hashlib.sha256(f.read() + grid.encode()).hexdigest()[:16]
+        label_filename = f"{cache_dir}/catchment_labels_{key}.npz"
+        if os.path.exists(label_filename):
+            return label_filename
+
+        with span("clip", filename=raster_filename) as s:
+            catchments = catchments.to_crs(r.crs)
+            window = get_catchment_window(catchments, r)
+            labels = features.rasterize(
+                zip(catchments.geometry, range(1, len(catchments) + 1)),
+                out_shape=(window.height, window.width),
+                transform=r.window_transform(window),
+                fill=0,
+                dtype="int32",
+            )
+            s.set_shape(labels)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez_compressed(label_filename, labels=labels,
+                        window=np.array([window.col_off, window.row_off, window.width, window.height]))
+    return label_filename
+
+
+def count_catchment_classes(raster_filename, label_filename, n_catchments):
+    """
+    Counts the pixels of each class in each catchment, reading the raster in blocks of rows.
+
+    Args:
+        raster_filename (str): Categorical raster.
+        label_filename (str): Label grid from get_catchment_labels().
+        n_catchments (int): Number of catchments.
+
+    Returns:
+        np.ndarray: Pixel counts with shape (n_catchments, n_classes).
+    """
+    cache = np.load(label_filename)
+    labels = cache["labels"]
+    col_off, row_off, width, height = cache["window"]
+
+    with rasterio.open(raster_filename) as r, span("aggregate", filename=raster_filename) as s:
+        s.set_shape(labels)
+        n_classes = np.iinfo(r.dtypes[0]).max + 1
+        counts = np.zeros((n_catchments + 1) * n_classes, dtype="int64")
+        for i in range(0, height, block_rows):
+            n_rows = min(block_rows, height - i)
+            data = r.read(1, window=Window(col_off, row_off + i, width, n_rows))
+            block_labels = labels[i:i + n_rows]
+            valid = block_labels > 0
+            if r.nodata is not None:
+                valid &= data != r.nodata
+            counts += np.bincount(block_labels[valid].astype("int64") * n_classes + data[valid],
+                                  minlength=counts.size)
+    return counts.reshape(n_catchments + 1, n_classes)[1:]
+
+
+def calculate_irrigated_fraction(raster_filename, label_filename, n_catchments):
+    """
+    Calculates the irrigated fraction of each catchment for one raster.
+
+    Args:
+        raster_filename (str): MIrAD raster.
+        label_filename (str): Label grid from get_catchment_labels().
+        n_catchments (int): Number of catchments.
+
+    Returns:
+        np.ndarray: Irrigated fraction of each catchment. NaN for catchments without pixels.
+    """
+    counts = count_catchment_classes(raster_filename, label_filename, n_catchments)
+    counts[:, excluded_class] = 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return counts[:, irrigated_class] / counts.sum(axis=1)
+
+
+if __name__ == "__main__":
+    with span("irrigated_fractions"):
+        with span("load", filename=catchment_filename) as s:
+            v = gpd.GeoDataFrame.from_file(catchment_filename)
+            s.set_shape(v)
+        raster_filenames = ["{}/{}".format(raster_dir, fname) for fname in fnames]
+
+        # Rasterize once for each raster grid (the MIrAD rasters share one)
+        label_filenames = [get_catchment_labels(v, fname) for fname in raster_filenames]
+
+        with ProcessPoolExecutor(max_workers=len(years)) as executor:
+            frac_list = list(executor.map(calculate_irrigated_fraction,
+                                          raster_filenames, label_filenames, [len(v)] * len(years)))
+
+        with span("export") as s:
+            frac = pd.DataFrame(np.stack(frac_list, axis=1), columns=years)
+            frac.index = v['ObjID'] # or 'BasinID' or 'Name'
+            frac.to_excel('irrigated_fraction.xlsx')
+            s.set_shape(frac)
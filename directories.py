@@ -35,8 +35,6 @@ necessary_files = []
 # https://www.sciencebase.gov/catalog/item/612e264ed34e40dd9c091228
 NWM_DIR = '../NWMv21/'
 necessary_files = ['nwmv21_nwis.nc']
-for file in necessary_files:
-    assert(file in os.listdir(NWM_DIR)), f'Required file {file} not found in {NWM_DIR}'
 
 # Contains various WRF-Hydro model outputs, as provided by Aubrey Duggar at NCAR
 WRFHYDRO_DIR = './datasets/WRF-Hydro/'
@@ -47,3 +45,12 @@ SPATIAL_DIR = './datasets/Spatial/'
 
 # Contains demand data
 DEMAND_DIR = './datasets/Demand/'
+
+# Cached intermediate results (e.g., area weights, parsed workbooks); safe to delete
+CACHE_DIR = './datasets/cache/'
+
+
+def check_necessary_files(directory, files):
+    """Raise an AssertionError if any of the files are not found in directory."""
+    for file in files:
+        assert(os.path.isdir(directory) and file in os.listdir(directory)), f'Required file {file} not found in {directory}'
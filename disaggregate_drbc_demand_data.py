@@ -14,33 +14,307 @@ Written by Andrew Hamilton in 2022, adapted from Noah Knowles' script for DRB WE
 """
 
 import os
+import json
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import geopandas as gpd
-
-from pywrdrb.pywr_drb_node_data import upstream_nodes_dict
-from pywrdrb.utils.lists import majorflow_list, reservoir_list
 
 # Directories
-from .directories import SPATIAL_DIR, DEMAND_DIR, PYWRDRB_DATA_DIR
+from directories import SPATIAL_DIR, DEMAND_DIR, PYWRDRB_DATA_DIR, CACHE_DIR
+from fingerprint import hash_file, hash_object, hash_shapefile
+from instrumentation import span
+
+
+# DRBC water use workbook, and the demand category of each sheet with basin data
+drbc_workbook_filename = "DRBCreport_data-release_v2110.xlsx"
+drbc_sheet_categories = {
+    "A-1": "PWS", "A-2": "PWS",
+    "A-6": "PWR_THERM", "A-7": "PWR_THERM",
+    "A-9": "PWR_HYDRO", "A-10": "PWR_HYDRO",
+    "A-11": "IND", "A-12": "IND",
+    "A-14": "MIN", "A-15": "MIN",
+    "A-17": "IRR", "A-18": "IRR", "A-19": "IRR",  # 18=RCP4.5, 19=RCP8.5
+    "A-22": "OTH", "A-23": "OTH",
+}
+usecolnames = ["BASIN_ID", "YEAR", "DESIGNATION", "WD_MGD", "CU_MGD"]
+
+# historical (1990-2018)
+historic_demand_sheets = {
+    "PWS": "A-1",
+    "PWR_THERM": "A-6",
+    "PWR_HYDRO": "A-9",
+    "IND": "A-11",
+    "MIN": "A-14",
+    "IRR": "A-17",
+    "OTH": "A-22",
+}
+
+# projected (2010-2060); irrigation projections differ for RCP4.5 (A-18) and RCP8.5 (A-19)
+projected_demand_sheets = {
+    "PWS": "A-2",
+    "PWR_THERM": "A-7",
+    "PWR_HYDRO": "A-10",
+    "IND": "A-12",
+    "MIN": "A-15",
+    "OTH": "A-23",
+}
+
+# Demand scenarios: sheets to use for each category, and the (first, last) year window
+drbc_demand_scenarios = {
+    "historic": {"sheets": historic_demand_sheets, "years": (2000, 2018)},  # avg over years from 2000 on
+    "projected_rcp45": {"sheets": {**projected_demand_sheets, "IRR": "A-18"}, "years": (2010, 2060)},
+    "projected_rcp85": {"sheets": {**projected_demand_sheets, "IRR": "A-19"}, "years": (2010, 2060)},
+}
+
+
+@lru_cache(maxsize=None)
+def get_pywrdrb_node_lists():
+    """
+    Imports the Pywr-DRB node definitions on first use, so this module can be imported without pywrdrb.
 
+    Returns:
+        (dict, list, list): upstream_nodes_dict, majorflow_list and reservoir_list from pywrdrb.
+    """
+    from pywrdrb.pywr_drb_node_data import upstream_nodes_dict
+    from pywrdrb.utils.lists import majorflow_list, reservoir_list
+    return upstream_nodes_dict, majorflow_list, reservoir_list
 
-def disaggregate_DRBC_demands():
+
+def read_drbc_sheet(workbook, sheet):
     """
-    Disaggregates DRBC water demand data to align with PywrDRB catchments.
+    Reads one sheet of the DRBC workbook and normalises it into a long table.
+
+    Args:
+        workbook (str): Path to the DRBC workbook.
+        sheet (str): Sheet name.
 
     Returns:
-        pd.DataFrame: Contains demand data disaggregated to align with PywrDRB catchments.
+        pd.DataFrame: Columns sheet, category, BASIN_ID, YEAR, DESIGNATION, WD_or_CU, MGD. None if the sheet has no basin data.
+    """
+    df = pd.read_excel(workbook, sheet, engine="openpyxl")
+    if not set(usecolnames).issubset(df.columns):
+        return None
+
+    df = df[usecolnames].melt(
+        id_vars=["BASIN_ID", "YEAR", "DESIGNATION"],
+        value_vars=["WD_MGD", "CU_MGD"],
+        var_name="WD_or_CU",
+        value_name="MGD",
+    )
+    df["DESIGNATION"] = df["DESIGNATION"].astype("string")
+    df.insert(0, "category", drbc_sheet_categories.get(sheet, sheet))
+    df.insert(0, "sheet", sheet)
+    return df
+
+
+def ingest_drbc_workbook(workbook, cache_dir=CACHE_DIR, n_workers=None):
+    """
+    Parses every sheet of the DRBC workbook into one long table, stored as parquet.
+
+    Sheets are parsed in parallel worker processes. The table is cached, keyed on the workbook
+    hash, so Excel is only read the first time (or after the workbook changes).
+
+    Args:
+        workbook (str): Path to the DRBC workbook.
+        cache_dir (str): Folder for the cached table.
+        n_workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        pd.DataFrame: Columns sheet, category, BASIN_ID, YEAR, DESIGNATION, WD_or_CU, MGD.
+    """
+    cache_file = f"{cache_dir}drbc_demands_{hash_file(workbook)[:16]}.parquet"
+    if os.path.exists(cache_file):
+        return pd.read_parquet(cache_file)
+
+    sheets = pd.ExcelFile(workbook, engine="openpyxl").sheet_names
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        tables = list(executor.map(read_drbc_sheet, [workbook] * len(sheets), sheets))
+
+    demand_table = pd.concat([t for t in tables if t is not None], ignore_index=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    demand_table.to_parquet(cache_file, index=False)
+    return demand_table
+
+
+def get_drbc_sheet_demands(demand_table, sheet, designation="SW"):
+    """
+    Gets the WD and CU demands of one sheet and designation for each basin and year.
+
+    Args:
+        demand_table (pd.DataFrame): Output from ingest_drbc_workbook().
+        sheet (str): Sheet name (e.g., 'A-1').
+        designation (str): Either 'SW' or 'GW'.
+
+    Returns:
+        pd.DataFrame: Columns CU_MGD and WD_MGD, indexed by (BASIN_ID, YEAR). None if there is no data.
+    """
+    df = demand_table.loc[
+        (demand_table["sheet"] == sheet) & (demand_table["DESIGNATION"] == designation)
+    ].dropna(subset=["BASIN_ID"])
+    if len(df) == 0:
+        return None
+
+    # sum is to aggregate over the Pennsylvania GWPA subbasins
+    df = df.groupby(["BASIN_ID", "YEAR", "WD_or_CU"])["MGD"].sum().unstack("WD_or_CU")
+    return df
+
+
+def calculate_basin_area_fractions(model_basins, drbc_basins,
+                                   model_basin_id_name="node",
+                                   drbc_basin_id_name="BASIN_ID"):
+    """
+    Calculates the overlapping area fractions between model basins and DRBC basins.
+
+    Candidate pairs are found by querying an STR-tree of the DRBC basins, and the
+    intersection areas of all candidates are calculated in one vectorized operation.
+
+    Args:
+        model_basins (gpd.GeoDataFrame): Model (e.g., Pywr-DRB node) basin geometries.
+        drbc_basins (gpd.GeoDataFrame): DRBC (or other, e.g., HUC12) basin geometries.
+        model_basin_id_name (str): Column with the model basin IDs.
+        drbc_basin_id_name (str): Column with the DRBC basin IDs.
+
+    Returns:
+        pd.DataFrame: Columns 'frac_area_model_basin' and 'frac_area_drbc_basin', indexed by (model basin ID, 'DRBC_BASIN_ID').
     """
+    import geopandas as gpd
+
+    model_basins = model_basins.to_crs(drbc_basins.crs)
+
+    # candidate pairs from the spatial index, ordered by model basin then DRBC basin
+    model_idx, drbc_idx = drbc_basins.sindex.query(model_basins.geometry, predicate="intersects")
+    order = np.lexsort((drbc_idx, model_idx))
+    model_idx, drbc_idx = model_idx[order], drbc_idx[order]
 
-    ### set seed for consistent results
-    np.random.seed(1)
+    model_geoms = gpd.GeoSeries(model_basins.geometry.values[model_idx], crs=drbc_basins.crs)
+    drbc_geoms = gpd.GeoSeries(drbc_basins.geometry.values[drbc_idx], crs=drbc_basins.crs)
+    intersect_area = model_geoms.intersection(drbc_geoms, align=False).area.values
 
-    demand_data_dir = f"{DEMAND_DIR}/"
-    DRB_data_dir = f"{SPATIAL_DIR}/"
+    # basins which only share a border intersect with zero area, and get no weight
+    overlap = intersect_area > 0
+    model_idx, drbc_idx, intersect_area = model_idx[overlap], drbc_idx[overlap], intersect_area[overlap]
+    model_geoms, drbc_geoms = model_geoms[overlap].reset_index(drop=True), drbc_geoms[overlap].reset_index(drop=True)
+
+    indx = pd.MultiIndex.from_arrays(
+        [model_basins[model_basin_id_name].values[model_idx],
+         drbc_basins[drbc_basin_id_name].values[drbc_idx]],
+        names=[model_basin_id_name, "DRBC_BASIN_ID"],
+    )
+    df_areas = pd.DataFrame(
+        {
+            "frac_area_model_basin": intersect_area / model_geoms.area.values,
+            "frac_area_drbc_basin": intersect_area / drbc_geoms.area.values,
+        },
+        index=indx,
+    )
+    return df_areas
+
+
+def _subtract_upstream_basins(args):
+    """Return the marginal basin geometry of a node; used by parallel workers."""
+    from shapely.ops import unary_union
+
+    node, geometry, upstream_geometries = args
+    if len(upstream_geometries) == 0:
+        return node, geometry
+    return node, geometry.difference(unary_union(upstream_geometries))
+
+
+def report_collapsed_basins(collapsed):
+    """Prints the nodes whose marginal basin collapsed, and which are dropped."""
+    for node in collapsed:
+        print(f"Marginal basin for {node} collapses to nothing after subtracting upstream basins; it is dropped.")
+
+
+def build_marginal_basins(g1, upstream_nodes_dict, n_workers=None, min_area_fraction=1e-6):
+    """
+    Subtracts upstream catchments from each node basin to get the marginal basin of each node.
+
+    For each node, its upstream basins are unioned once and a single difference is taken. The
+    original (total) upstream basins are used, so the nodes are independent and processed in
+    parallel worker processes. Nodes whose marginal basin collapses to nothing (e.g., pepacton
+    and its gage are too close together to recognise a difference) are reported and dropped.
+    Since the union of upstream basins can leave floating point slivers, a basin is treated as
+    collapsed if less than min_area_fraction of its total area remains.
+
+    Args:
+        g1 (gpd.GeoDataFrame): Total basin geometry for each node, with pywr node names in the 'node' column.
+        upstream_nodes_dict (dict): Upstream nodes for each downstream node.
+        n_workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        min_area_fraction (float): Fraction of the total basin area below which a marginal basin has collapsed.
+
+    Returns:
+        (gpd.GeoDataFrame, list): Marginal basin geometry for each node, and the nodes which collapsed.
+    """
+    _, majorflow_list, _ = get_pywrdrb_node_lists()
+
+    basin_geometries = dict(zip(g1["node"], g1.geometry))
+
+    tasks = []
+    for node, upstreams in upstream_nodes_dict.items():
+        node_drb = "link_" + node
+        if node_drb not in basin_geometries:
+            continue
+        upstream_geometries = []
+        for upstream in upstreams:
+            if upstream in majorflow_list:
+                upstream_drb = "link_" + upstream
+            else:
+                upstream_drb = "reservoir_" + upstream
+            if upstream_drb in basin_geometries:
+                upstream_geometries.append(basin_geometries[upstream_drb])
+        tasks.append((node_drb, basin_geometries[node_drb], upstream_geometries))
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        marginal_geometries = dict(executor.map(_subtract_upstream_basins, tasks))
+
+    collapsed = [
+        node
+        for node, geometry in marginal_geometries.items()
+        if geometry.area <= min_area_fraction * basin_geometries[node].area
+    ]
+    report_collapsed_basins(collapsed)
+
+    g1 = g1.copy()
+    g1["geometry"] = [marginal_geometries.get(node, geometry) for node, geometry in zip(g1["node"], g1.geometry)]
+    g1 = g1.loc[~g1["node"].isin(collapsed)]
+    g1.reset_index(inplace=True, drop=True)
+    return g1, collapsed
+
+
+def get_node_basin_geometries(DRB_data_dir, cache_dir=CACHE_DIR):
+    """
+    Loads the Pywr-DRB node basins, labels them with pywr node names, and
+    subtracts upstream catchments to get the marginal basin of each node.
+
+    The marginal basins are cached, keyed on the node basin shapefile and the
+    upstream node definitions, so they can be re-used by other consumers. The nodes
+    which collapsed are saved alongside, and reported whether or not the cache is used.
+
+    Args:
+        DRB_data_dir (str): Folder containing node_basin_geometries.shp.
+        cache_dir (str): Folder for the cached marginal basins.
+
+    Returns:
+        gpd.GeoDataFrame: Marginal basin geometry for each node.
+    """
+    import geopandas as gpd
+
+    upstream_nodes_dict, _, reservoir_list = get_pywrdrb_node_lists()
+
+    model_basin_file = f"{DRB_data_dir}node_basin_geometries.shp"
+    key = hash_object({"model_basins": hash_shapefile(model_basin_file),
+                       "upstream_nodes": upstream_nodes_dict})
+    cache_file = f"{cache_dir}marginal_node_basins_{key[:16]}.parquet"
+    collapsed_file = f"{cache_dir}marginal_node_basins_{key[:16]}_collapsed.json"
+    if os.path.exists(cache_file) and os.path.exists(collapsed_file):
+        with open(collapsed_file, "r") as f:
+            report_collapsed_basins(json.load(f))
+        return gpd.read_parquet(cache_file)
 
     ### catchments from model
-    g1 = gpd.GeoDataFrame.from_file(f"{DRB_data_dir}node_basin_geometries.shp")
+    g1 = gpd.GeoDataFrame.from_file(model_basin_file)
 
     ### update names to match pywr nodes
     nodes = g1["node"].values
@@ -53,225 +327,282 @@ def disaggregate_DRBC_demands():
             nodes[i] = "link_" + nodes[i]
     g1["node"] = nodes
 
-    ### subtract upstream catchments from mainstem nodes - note on a few occasions (eg pepacton & its gage), they are too close together and dont recognise a difference,so they disappear from this dataframe.
-    for node, upstreams in upstream_nodes_dict.items():
-        node_drb = "link_" + node
-        for upstream in upstreams:
-            if upstream in majorflow_list:
-                upstream_drb = "link_" + upstream
-            else:
-                upstream_drb = "reservoir_" + upstream
-            overlay = g1.loc[g1["node"] == node_drb].overlay(
-                g1.loc[g1["node"] == upstream_drb], how="difference"
-            )
-            g1 = g1.loc[g1["node"] != node_drb]
-            g1 = pd.concat([g1, overlay])
-
-    g1.reset_index(inplace=True, drop=True)
+    ### subtract upstream catchments from mainstem nodes
+    g1, collapsed = build_marginal_basins(g1, upstream_nodes_dict)
     g1["idx"] = list(g1.index)
 
-    model_basin_id_name = "node"
-    # catchments from DRBC 2021 report
-    g2 = gpd.GeoDataFrame.from_file(
-        DRB_data_dir + "drb147.shp"
-    )  # 147 basins used in report
-
-    g1 = g1.to_crs(g2.crs)
-    indx_list = []
-    data = []
-    for index, model_basin in g1.iterrows():
-        for index2, drbc_basin in g2.iterrows():
-            if model_basin["geometry"].intersects(drbc_basin["geometry"]):
-                intersect_area = (
-                    model_basin["geometry"].intersection(drbc_basin["geometry"]).area
-                )
-                frac_area_model_basin = intersect_area / model_basin["geometry"].area
-                frac_area_drbc_basin = intersect_area / drbc_basin["geometry"].area
-                indx_list.append((model_basin.node, drbc_basin.BASIN_ID))
-                data.append(
-                    {
-                        "frac_area_model_basin": frac_area_model_basin,
-                        "frac_area_drbc_basin": frac_area_drbc_basin,
-                    }
-                )
-
-    indx = pd.MultiIndex.from_tuples(
-        indx_list, names=[model_basin_id_name, "DRBC_BASIN_ID"]
+    os.makedirs(cache_dir, exist_ok=True)
+    g1.to_parquet(cache_file)
+    with open(collapsed_file, "w") as f:
+        json.dump(collapsed, f)
+    return g1
+
+
+def build_area_weight_matrix(df_areas, weight_column="frac_area_drbc_basin"):
+    """
+    Converts the area fraction table into a sparse (model basin x DRBC basin) weight matrix.
+
+    Args:
+        df_areas (pd.DataFrame): Output from calculate_basin_area_fractions().
+        weight_column (str): Column to use as the weights.
+
+    Returns:
+        (sparse.csr_matrix, np.ndarray, np.ndarray): Weight matrix, model basin IDs (rows), and DRBC basin IDs (columns).
+    """
+    from scipy import sparse
+
+    rows, model_basin_ids = pd.factorize(df_areas.index.get_level_values(0))
+    cols, drbc_basin_ids = pd.factorize(df_areas.index.get_level_values(1))
+    weights = sparse.csr_matrix(
+        (df_areas[weight_column].values, (rows, cols)),
+        shape=(len(model_basin_ids), len(drbc_basin_ids)),
     )
-    df_areas = pd.DataFrame(
-        data, columns=["frac_area_model_basin", "frac_area_drbc_basin"], index=indx
+    # explicit zeros would give 0*NaN = NaN for basins with missing years
+    weights.eliminate_zeros()
+    return weights, np.array(model_basin_ids.tolist()), np.array(drbc_basin_ids.tolist())
+
+
+def get_area_weight_matrix(DRB_data_dir, 
+                           drbc_basin_filename="drb147.shp", 
+                           cache_dir=CACHE_DIR):
+    """
+    Returns the sparse area weight matrix between Pywr-DRB node basins and DRBC basins.
+
+    The matrix is cached, keyed on the fingerprints of both shapefiles and the upstream node
+    definitions, so that geometry is only processed when one of these changes.
+
+    Args:
+        DRB_data_dir (str): Folder containing node_basin_geometries.shp and the DRBC basin shapefile.
+        drbc_basin_filename (str): DRBC basin shapefile (147 basins used in the DRBC 2021 report).
+        cache_dir (str): Folder for cached weight matrices.
+
+    Returns:
+        (sparse.csr_matrix, np.ndarray, np.ndarray): Weight matrix, node IDs (rows), and DRBC basin IDs (columns).
+    """
+    import geopandas as gpd
+    from scipy import sparse
+
+    upstream_nodes_dict, _, _ = get_pywrdrb_node_lists()
+
+    model_basin_file = f"{DRB_data_dir}node_basin_geometries.shp"
+    drbc_basin_file = f"{DRB_data_dir}{drbc_basin_filename}"
+    key = hash_object(
+        {
+            "model_basins": hash_shapefile(model_basin_file),
+            "drbc_basins": hash_shapefile(drbc_basin_file),
+            "upstream_nodes": upstream_nodes_dict,
+        }
     )
+    cache_file = f"{cache_dir}area_weights_{key[:16]}.npz"
 
-    # first, load GW and SW for WD and CU for each DB basin and category (2 dataframes: sw and gw; index: db BASIN_ID; column levels: category, WD_or_CU); leave out self-supplied domestic (no gw/sw/designation).
-    usecolnames = ["BASIN_ID", "YEAR", "DESIGNATION", "WD_MGD", "CU_MGD"]
-    # historical (1990-2018)
-    sheetnames = {
-        "PWS": "A-1",
-        "PWR_THERM": "A-6",
-        "PWR_HYDRO": "A-9",
-        "IND": "A-11",
-        "MIN": "A-14",
-        "IRR": "A-17",
-        "OTH": "A-22",
-    }
-    yrbeg, yrend = 2000, 2018  # avg over years from 2000 on
-
-    ##projected (2010-2060)
-    # sheetnames = { 'PWS':'A-2',
-    #'PWR_THERM':'A-7',
-    #'PWR_HYDRO':'A-10',
-    #'IND':'A-12',
-    #'MIN':'A-15',
-    #'IRR':'A-19',  # 18=RCP4.5, 19=RCP8.5
-    #'OTH':'A-23'
-    # }
-    # yrbeg,yrend = 2010,2060
-
-    def mean_over_period(s):
-        t = pd.PeriodIndex(
-            [
-                pd.Period(r)
-                for r in s.droplevel(level=0).index.values.astype(int).tolist()
-            ]
-        )
-        s.index = t
-        v = s  # comment this and uncomment next line to fill in zeros for missing years
-        # v=s.resample('A').asfreq().fillna(0)
-        w = v.loc[str(yrbeg) : str(yrend), :].mean()
-        return w
-
-    sw_list = []
-    # gw_list = []
-    for cat in sheetnames:
-        sheet = sheetnames[cat]
-        df = pd.read_excel(
-            demand_data_dir + "DRBCreport_data-release_v2110.xlsx",
-            sheet,
-            engine="openpyxl",
-            usecols=usecolnames,
-        )
-        df = (
-            df.set_index("DESIGNATION", append=True)
-            .unstack()
-            .swaplevel(1, 0, axis=1)
-            .sort_index(axis=1)
+    if os.path.exists(cache_file):
+        cached = np.load(cache_file, allow_pickle=False)
+        weights = sparse.csr_matrix(
+            (cached["data"], cached["indices"], cached["indptr"]), shape=tuple(cached["shape"])
         )
+        weights.eliminate_zeros()
+        return weights, cached["model_basin_ids"], cached["drbc_basin_ids"]
+
+    g1 = get_node_basin_geometries(DRB_data_dir)
+    g2 = gpd.GeoDataFrame.from_file(drbc_basin_file)
+    df_areas = calculate_basin_area_fractions(g1, g2, model_basin_id_name="node")
+    weights, model_basin_ids, drbc_basin_ids = build_area_weight_matrix(df_areas)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(
+        cache_file,
+        data=weights.data,
+        indices=weights.indices,
+        indptr=weights.indptr,
+        shape=np.array(weights.shape),
+        model_basin_ids=model_basin_ids,
+        drbc_basin_ids=drbc_basin_ids,
+    )
+    return weights, model_basin_ids, drbc_basin_ids
 
-        if "SW" in df.columns.levels[0].values:
-            sw = (
-                df.loc[:, ("SW", slice(None))]
-                .droplevel(axis=1, level=0)
-                .dropna(subset=["BASIN_ID"])
-            )
-            sw = sw.groupby(
-                ["BASIN_ID", "YEAR"]
-            ).sum()  # sum is to aggregate over the Pennsylvania GWPA subbasins
-            sw.columns.name = "WD_or_CU"
-            sw = pd.concat({cat: sw}, names=["Category"], axis=1)
-            sw = sw.groupby("BASIN_ID").apply(mean_over_period)
-            sw_list.append(sw)
-
-        # if 'GW' in df.columns.levels[0].values:
-        #     gw = df.loc[:,('GW',slice(None))].droplevel(axis=1,level=0).dropna(subset=['BASIN_ID'])
-        #     gw = gw.groupby(['BASIN_ID','YEAR']).sum()
-        #     gw.columns.name='WD_or_CU'
-        #     gw = pd.concat({cat: gw}, names=['Category'],axis=1)
-        #     gw = gw.groupby('BASIN_ID').apply(mean_over_period)
-        #     gw_list.append(gw)
+
+def aggregate_demands_to_nodes(weights, model_basin_ids, drbc_basin_ids, df_demand):
+    """
+    Aggregates DRBC basin demands to model basins with a single sparse matrix product.
+
+    Args:
+        weights (sparse.csr_matrix): Weight matrix from get_area_weight_matrix().
+        model_basin_ids (np.ndarray): Model basin IDs (rows of weights).
+        drbc_basin_ids (np.ndarray): DRBC basin IDs (columns of weights).
+        df_demand (pd.DataFrame): Demands indexed by DRBC BASIN_ID; any number of columns (categories, years, etc).
+
+    Returns:
+        pd.DataFrame: Demands for each model basin, with the same columns as df_demand.
+    """
+    # Basins without data are 0 MGD; missing years (NaN) stay missing
+    demand = df_demand.reindex(index=drbc_basin_ids, fill_value=0).values
+    return pd.DataFrame(
+        weights @ demand, index=model_basin_ids, columns=df_demand.columns
+    )
+
+
+def get_scenario_basin_demands(demand_table, sheetnames, yrbeg, yrend,
+                               annual=False, designation="SW"):
+    """
+    Gets DRBC basin demands for a set of sheets and a year window.
+
+    Args:
+        demand_table (pd.DataFrame): Output from ingest_drbc_workbook().
+        sheetnames (dict): Sheet name for each demand category.
+        yrbeg (int): First year of the window.
+        yrend (int): Last year of the window.
+        annual (bool): If True, keep each year; years without data for a basin and category are NaN.
+            Otherwise average over the years with data.
+        designation (str): Either 'SW' or 'GW'.
+
+    Returns:
+        pd.DataFrame: Demands indexed by BASIN_ID, with columns (Category, WD_or_CU) or (Category, WD_or_CU, YEAR) if annual.
+    """
+    df_list = {}
+    for cat, sheet in sheetnames.items():
+        df = get_drbc_sheet_demands(demand_table, sheet, designation=designation)
+        if df is None:
+            continue
+        years = df.index.get_level_values("YEAR").astype(int)
+        df = df.loc[(years >= yrbeg) & (years <= yrend)]
+        if annual:
+            df = df.unstack("YEAR")
+        else:
+            # missing years are not filled with 0 before averaging
+            df = df.groupby("BASIN_ID").mean()
+        df_list[cat] = df
 
     # Unclear whether to fill missing years and missing basins with 0. Currently implemented: years no, basins yes. This was based on data. E.g., sometimes a whole decade is missing in a time series-- unlikely to be all zeros. But some basins have, eg, all their demand in gw and no entries for sw, so it makes sense to assume sw=0 for those basins.
-    df_sw = pd.concat(sw_list, axis=1).fillna(
-        0
-    )  # fillna(0) assumes no data at a site for a category means 0 MGD
-    # df_gw = pd.concat(gw_list,axis=1).fillna(0)
-
-    # now use frac_area_drbc_basin to calculate weighted sums of sw and gw for model catchments
-    model_basin_ids = df_areas.index.get_level_values(level=0).unique()
-    sw_list = []
-    # gw_list = []
-    for model_basin_id in model_basin_ids:
-        frac_areas = df_areas.loc[(model_basin_id, slice(None)), :].droplevel(level=0)[
-            "frac_area_drbc_basin"
-        ]
-        sw_model0 = (
-            df_sw.reindex(index=frac_areas.index)
-            .fillna(0)
-            .multiply(frac_areas, axis=0)
-            .sum()
-        )  # fillna(0) assumes no data at a site for a category means 0 MGD
-        sw_model0.name = model_basin_id
-        # gw_model0 = df_gw.reindex(index=frac_areas.index).fillna(0).multiply(frac_areas,axis=0).sum()
-        # gw_model0.name = model_basin_id
-        sw_list.append(sw_model0)
-        # gw_list.append(gw_model0)
-
-    # results in MGD
-    sw_model = pd.concat(sw_list, axis=1).T
-    sw_model[("Total", "CU_MGD")] = sw_model.loc[:, (slice(None), "CU_MGD")].sum(axis=1)
-    sw_model[("Total", "WD_MGD")] = sw_model.loc[:, (slice(None), "WD_MGD")].sum(axis=1)
-    # gw_model = pd.concat(gw_list,axis=1).T
-    # gw_model[('Total','CU_MGD')] = gw_model.loc[:,(slice(None),'CU_MGD')].sum(axis=1)
-    # gw_model[('Total','WD_MGD')] = gw_model.loc[:,(slice(None),'WD_MGD')].sum(axis=1)
+    # Only basins with no data at all for a category are filled with 0 MGD
+    df = pd.concat(df_list, names=["Category"], axis=1)
+    for cat in df.columns.get_level_values("Category").unique():
+        missing_basins = df[cat].isna().all(axis=1)
+        df.loc[missing_basins, cat] = 0.0
+    return df
+
+
+def format_node_demands(node_demands):
+    """
+    Adds totals and the CU/WD ratio, flattens the column names, and adds zero demands
+    for Pywr-DRB nodes without a marginal catchment.
+
+    Args:
+        node_demands (pd.DataFrame): Node demands (MGD) with columns (Category, WD_or_CU).
+
+    Returns:
+        pd.DataFrame: Node demands as used by Pywr-DRB, indexed by node.
+    """
+    _, majorflow_list, reservoir_list = get_pywrdrb_node_lists()
+
+    sw_model = node_demands.copy()
+    # Totals are missing (NaN) where any category is missing, e.g., years without data
+    sw_model[("Total", "CU_MGD")] = sw_model.loc[:, (slice(None), "CU_MGD")].sum(axis=1, skipna=False)
+    sw_model[("Total", "WD_MGD")] = sw_model.loc[:, (slice(None), "WD_MGD")].sum(axis=1, skipna=False)
 
     ### change columns from multiindex to single index
     sw_model.columns = sw_model.columns.to_flat_index()
     sw_model.columns = [l[0] + "_" + l[1] for l in sw_model.columns]
-    # gw_model.columns = gw_model.columns.to_flat_index()
-    # gw_model.columns = [l[0] + '_' + l[1] for l in gw_model.columns]
 
     ### get ratio of consumption to withdrawal
-    sw_model["Total_CU_WD_Ratio"] = sw_model["Total_CU_MGD"] / sw_model["Total_WD_MGD"]
-    sw_model["Total_CU_WD_Ratio"].loc[np.isnan(sw_model["Total_CU_WD_Ratio"])] = 0.0
-    # gw_model['Total_CU_WD_Ratio'] = gw_model['Total_CU_MGD'] / gw_model['Total_WD_MGD']
-    # gw_model['Total_CU_WD_Ratio'].loc[np.isnan(gw_model['Total_CU_WD_Ratio'])] = 0.
+    sw_model["Total_CU_WD_Ratio"] = (sw_model["Total_CU_MGD"] / sw_model["Total_WD_MGD"]).where(sw_model["Total_WD_MGD"] != 0, 0.0)
 
     ### Set demands to zero in cases where we don't have data either because no USGS gage to use as pour point(merrill creek),
     ###    or because the gage is too close to reservoir to deliniate marginal catchment.
-    for reservoir in reservoir_list:
-        if f"reservoir_{reservoir}" not in sw_model.index:
-            sw_model = pd.concat(
-                [
-                    sw_model,
-                    pd.DataFrame(
-                        {k: 0.0 for k in sw_model.columns},
-                        index=[f"reservoir_{reservoir}"],
-                    ),
-                ]
-            )
-    for majorflow in majorflow_list:
-        if f"link_{majorflow}" not in sw_model.index:
-            sw_model = pd.concat(
-                [
-                    sw_model,
-                    pd.DataFrame(
-                        {k: 0.0 for k in sw_model.columns}, index=[f"link_{majorflow}"]
-                    ),
-                ]
-            )
+    all_nodes = list(sw_model.index)
+    all_nodes += [f"reservoir_{r}" for r in reservoir_list if f"reservoir_{r}" not in all_nodes]
+    all_nodes += [f"link_{m}" for m in majorflow_list if f"link_{m}" not in all_nodes]
+    sw_model = sw_model.reindex(all_nodes, fill_value=0.0)
     sw_model.loc["reservoir_merrillCreek", :] = np.zeros(sw_model.shape[1])
-    # for reservoir in reservoir_list:
-    #     if f'reservoir_{reservoir}' not in gw_model.index:
-    #         gw_model = gw_model.append(pd.DataFrame({k: 0. for k in gw_model.columns}, index=[f'reservoir_{reservoir}']))
-    # for majorflow in majorflow_list:
-    #     if f'link_{majorflow}' not in gw_model.index:
-    #         gw_model = gw_model.append(pd.DataFrame({k: 0. for k in gw_model.columns}, index=[f'link_{majorflow}']))
-    # gw_model.loc['reservoir_merrillCreek', :] = np.zeros(gw_model.shape[1])
+    sw_model.index.name = "node"
+    return sw_model
+
+
+def run_demand_scenarios(scenarios=None, annual=False, designation="SW"):
+    """
+    Disaggregates DRBC demands to Pywr-DRB nodes for several scenarios in one run.
+
+    The area weight matrix and parsed workbook are loaded once (and cached between runs),
+    so each scenario only costs a sparse matrix product.
+
+    Args:
+        scenarios (dict, optional): For each scenario name, a dict with 'sheets' (sheet for each category)
+            and 'years' (first, last). Defaults to drbc_demand_scenarios.
+        annual (bool): If True, give demands for each year. Otherwise give the mean over the years.
+        designation (str): Either 'SW' or 'GW'.
+
+    Returns:
+        pd.DataFrame: Node demands (MGD) indexed by (scenario, node), or (scenario, year, node) if annual.
+    """
+    scenarios = drbc_demand_scenarios if scenarios is None else scenarios
+
+    with span('weights') as s:
+        weights, model_basin_ids, drbc_basin_ids = get_area_weight_matrix(f"{SPATIAL_DIR}/")
+        s.set_shape(weights)
+    with span('load') as s:
+        demand_table = ingest_drbc_workbook(f"{DEMAND_DIR}/{drbc_workbook_filename}")
+        s.set_shape(demand_table)
+
+    results = {}
+    for scenario, options in scenarios.items():
+        yrbeg, yrend = options["years"]
+        basin_demands = get_scenario_basin_demands(demand_table, options["sheets"], yrbeg, yrend,
+                                                   annual=annual, designation=designation)
+        with span('aggregate', scenario=scenario) as s:
+            node_demands = aggregate_demands_to_nodes(weights, model_basin_ids, drbc_basin_ids, basin_demands)
+            s.set_shape(node_demands)
+
+        if annual:
+            node_demands = node_demands.stack("YEAR", future_stack=True)
+            results[scenario] = pd.concat(
+                {int(year): format_node_demands(df.droplevel("YEAR"))
+                 for year, df in node_demands.groupby(level="YEAR")},
+                names=["year", "node"],
+            )
+        else:
+            results[scenario] = format_node_demands(node_demands)
+
+    return pd.concat(results, names=["scenario"])
+
+
+def disaggregate_DRBC_demands():
+    """
+    Disaggregates DRBC water demand data to align with PywrDRB catchments.
+    Uses the historic surface water demands, averaged over 2000-2018.
+
+    Returns:
+        pd.DataFrame: Contains demand data disaggregated to align with PywrDRB catchments.
+    """
+    # first, load GW and SW for WD and CU for each DB basin and category; leave out self-supplied domestic (no gw/sw/designation).
+    # groundwater demands have never been used in the pywrdrb model, but are available with designation='GW'
+    sw_model = run_demand_scenarios(
+        {"historic": drbc_demand_scenarios["historic"]}, designation="SW"
+    ).loc["historic"]
 
     # Save to CSV
     sw_model.to_csv(
         f"{PYWRDRB_DATA_DIR}sw_avg_wateruse_pywrdrb_catchments_mgd.csv", 
         index_label="node"
     )
+    return sw_model
 
 
-if __name__ == "__main__":
+def main():
+    with span("demands"):
+        print("Re-aggregating DRBC demand data to align with pywrdrb node catchments...")
     
-    print("Re-aggregating DRBC demand data to align with pywrdrb node catchments...")
+        try:
+            disaggregate_DRBC_demands()
+        except Exception as e:
+            print(f"Error during demand re-aggregation:\n{e}")
+            raise
     
-    try:
-        disaggregate_DRBC_demands()
-    except Exception as e:
-        print(f"Error during demand re-aggregation:\n{e}")
-        raise
-    
-    print("Done; new demand data saved to src_pywrdrb_data/ folder.")
\ No newline at end of file
+        print("Done; new demand data saved to src_pywrdrb_data/ folder.")
+
+        print("Disaggregating DRBC demand scenarios for each year...")
+        run_demand_scenarios(annual=True).to_csv(
+            f"{PYWRDRB_DATA_DIR}sw_wateruse_scenarios_pywrdrb_catchments_mgd.csv"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -23,20 +23,16 @@ https://www.sciencebase.gov/catalog/item/5d826f6ae4b0c4f70d05913f
 """
 
 import tarfile
-import netCDF4 as nc
 import pandas as pd
 import numpy as np
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-import sys
-import itertools
 
 from directories import PYWRDRB_DIR, NHM_DIR
 OUTPUT_DIR = './datasets/NHMv10/'
 
-sys.path.append(PYWRDRB_DIR)
-from pywrdrb.pywr_drb_node_data import nhm_site_matches, immediate_downstream_nodes_dict, obs_pub_site_matches
+from pywr_drb_node_data import obs_pub_site_matches
+from site_match_registry import get_site_match_registry
+from dataset_io import write_flow_dataset, read_flow_dataset, write_flow_csv, cast_flows
+from instrumentation import span
 
 re_extract = False
 export_to_pywrdrb = True
@@ -45,117 +41,183 @@ export_to_pywrdrb = True
 cms_to_mgd = 22.82
 cm_to_mg = 264.17/1e6
 cfs_to_mgd = 0.64631688969744
-
-# Load DRB and GF geospatial
 crs = 4386
-drb = gpd.read_file(f'{PYWRDRB_DIR}DRB_spatial/DRB_shapefiles/drb_bnd_polygon.shp').to_crs(crs)
-gf = gpd.read_file(f'./GFv1.1.gdb/').to_crs(crs)
-# gf_poi = gpd.read_file(f'./gfv11/gfv11.shp').to_crs(crs)
-
-# Load metadata
-nhm_gage_ids = pd.read_csv(f"{OUTPUT_DIR}/meta/poi_gage_id.csv", 
-                           index_col=0)
-nhm_seg_ids = pd.read_csv(f"{OUTPUT_DIR}/meta/poi_gage_segment.csv", 
-                          index_col=0)
-
-
-nhm_gage_segments = pd.concat([nhm_gage_ids, nhm_seg_ids], axis=1)
-nhm_gage_segments.columns = ['gage_id', 'nhm_segment_id']
-nhm_gage_segments['gage_id'] = [f'0{site_id}' for site_id in nhm_gage_segments['gage_id'].values]
-
-# Clip the GF to DRB
-gf_drb = gpd.clip(gf, drb)
 
-# Store & export DRB relevant segment IDs
-drb_segment_ids = gf_drb['nsegment_v1_1']
-drb_nhm_gage_segments = nhm_gage_segments.loc[nhm_gage_segments['nhm_segment_id'].isin(drb_segment_ids)]
-drb_nhm_gage_segments.to_csv(f'{OUTPUT_DIR}/meta/drb_nhm_gage_segment_ids.csv', 
-                             sep=',')
-
-
-## Load the NHM data from .tar file location
-if re_extract:
+# NHM-PRMS .tar contents
+nhm_tar_filename = 'byHRU_musk_obs.tar'
+extract_member_indices = [7, 33, 36]
+extract_files = ['hru_outflow', 'seg_outflow', 'seg_upstream_inflow']
+nhm_start_date = '1980-10-01'
+nhm_n_days = 13241
+
+
+def get_drb_nhm_gage_segments(drb_shapefile=f'{PYWRDRB_DIR}DRB_spatial/DRB_shapefiles/drb_bnd_polygon.shp',
+                              gf_filename='./GFv1.1.gdb/',
+                              output_dir=OUTPUT_DIR):
+    """
+    Clips the Geospatial Fabric to the DRB, and matches NHM segments to gages.
+
+    Args:
+        drb_shapefile (str): DRB boundary shapefile.
+        gf_filename (str): Geospatial Fabric (GFv1.1) geodatabase.
+        output_dir (str): Folder with meta/poi_gage_id.csv and meta/poi_gage_segment.csv.
+
+    Returns:
+        tuple: (pd.Series of DRB segment IDs, pd.DataFrame of DRB gage_id and nhm_segment_id)
+    """
+    import geopandas as gpd
+
+    # Load DRB and GF geospatial
+    with span('load', filename=gf_filename) as s:
+        drb = gpd.read_file(drb_shapefile).to_crs(crs)
+        gf = gpd.read_file(gf_filename).to_crs(crs)
+        s.set_shape(gf)
+
+        # Load metadata
+        nhm_gage_ids = pd.read_csv(f"{output_dir}/meta/poi_gage_id.csv", 
+                                   index_col=0)
+        nhm_seg_ids = pd.read_csv(f"{output_dir}/meta/poi_gage_segment.csv", 
+                                  index_col=0)
+
+    nhm_gage_segments = pd.concat([nhm_gage_ids, nhm_seg_ids], axis=1)
+    nhm_gage_segments.columns = ['gage_id', 'nhm_segment_id']
+    nhm_gage_segments['gage_id'] = [f'0{site_id}' for site_id in nhm_gage_segments['gage_id'].values]
+
+    # Clip the GF to DRB
+    with span('clip') as s:
+        gf_drb = gpd.clip(gf, drb)
+        s.set_shape(gf_drb)
+
+    # Store DRB relevant segment IDs
+    drb_segment_ids = gf_drb['nsegment_v1_1']
+    drb_nhm_gage_segments = nhm_gage_segments.loc[nhm_gage_segments['nhm_segment_id'].isin(drb_segment_ids)]
+    return drb_segment_ids, drb_nhm_gage_segments
+
+
+def load_nhm_flows(nc_filename, variable, id_variable, ids):
+    """
+    Loads an NHM output variable from NetCDF, for the given IDs, in MGD.
+
+    Args:
+        nc_filename (str): NetCDF file extracted from the NHM .tar.
+        variable (str): Flow variable (e.g., 'seg_outflow').
+        id_variable (str): ID variable (e.g., 'segment').
+        ids (list): IDs to keep.
+
+    Returns:
+        pd.DataFrame: Daily flows (cfs converted to MGD) with ID columns.
+    """
+    import netCDF4 as nc
+
+    with span('load', filename=nc_filename) as s:
+        data = nc.Dataset(nc_filename)
+
+        # Store values
+        vals = data[variable][:]
+        nhm_ids = data[id_variable][:]
+        data.close()
+        s.set_shape(vals)
 
+    # Make a dataframe
+    time_index = pd.date_range(nhm_start_date, periods = nhm_n_days, freq = 'D')
+    df = pd.DataFrame(vals, index = time_index, columns = nhm_ids)
+
+    # Pull just DRB locations; converted in float64 then cast to the precision policy dtype
+    with span('select', variable=variable) as s:
+        df = cast_flows(df.loc[:, ids].astype('float64') * cfs_to_mgd, s=s)
+        s.set_shape(df)
+    return df
+
+
+def extract_nhm_drb_flows(drb_segment_ids,
+                          tar_filename=f'{NHM_DIR}/{nhm_tar_filename}',
+                          output_dir=OUTPUT_DIR):
+    """
+    Extracts the NHM NetCDF files from the .tar, and exports DRB HRU and segment outflows.
+
+    Args:
+        drb_segment_ids (list): DRB segment IDs.
+        tar_filename (str): NHM-PRMS byHRU_musk_obs.tar.
+        output_dir (str): Output folder, with netcdf/ and csv/ subfolders.
+
+    Returns:
+        pd.DataFrame: DRB segment outflows in MGD.
+    """
     # Open and store file names
-    tar = tarfile.open(f'{NHM_DIR}/byHRU_musk_obs.tar')
-    all_names = tar.getnames()
-    all_members = tar.getmembers()
-
-    # Extract just the NetCDF values of interest
-    extract_member_indices = [7, 33, 36]
-    extract_files = ['hru_outflow', 'seg_outflow', 'seg_upstream_inflow']
-
-    for i in extract_member_indices:
-        tar.extract(all_members[i], path = OUTPUT_DIR)
-    tar.close()
+    with span('extract', filename=tar_filename):
+        tar = tarfile.open(tar_filename)
+        all_members = tar.getmembers()
+
+        # Extract just the NetCDF values of interest
+        for i in extract_member_indices:
+            tar.extract(all_members[i], path = output_dir)
+        tar.close()
     print('Extracted files from .tar')
 
     ## HRU Outflow
-    hru_data = nc.Dataset(f'{OUTPUT_DIR}/netcdf/hru_outflow.nc')
-
-    # Store values
-    vals = hru_data['hru_outflow'][:]
-    hru_ids = hru_data['hru'][:]
-
-    # Make a dataframe
-    time_index = pd.date_range('1980-10-01', periods = 13241, freq = 'D')
-    hru_outflow_df = pd.DataFrame(vals, index = time_index, columns = hru_ids)
+    drb_hru_outflow = load_nhm_flows(f'{output_dir}/netcdf/hru_outflow.nc', 'hru_outflow', 'hru', drb_segment_ids)
+    write_flow_csv(drb_hru_outflow, f'{output_dir}/csv/drb_hru_outflow_mgd.csv')
 
-    # Pull just DRB locations
-    drb_hru_outflow = hru_outflow_df.loc[:, drb_segment_ids] * cfs_to_mgd
-
-    # Export
-    drb_hru_outflow.to_csv(f'{OUTPUT_DIR}/csv/drb_hru_outflow_mgd.csv', sep = ',')
-    
     ## Segment Outflow
-    seg_data = nc.Dataset(f'{OUTPUT_DIR}/netcdf/seg_outflow.nc')
-
-    # Store values
-    vals = seg_data['seg_outflow'][:]
-    seg_ids = seg_data['segment'][:]
-
-    # Make a dataframe
-    seg_outflow_df = pd.DataFrame(vals, 
-                                  index = time_index, 
-                                  columns = seg_ids)
-
-    # Pull just DRB locations
-    drb_seg_outflow = seg_outflow_df.loc[:, drb_segment_ids] * cfs_to_mgd
-
-    # Export
-    drb_seg_outflow.to_csv(f'{OUTPUT_DIR}/csv/drb_seg_outflow_mgd.csv', 
-                           sep = ',')
-    drb_seg_outflow.to_hdf(f'{OUTPUT_DIR}/hdf/drb_seg_outflow_mgd.hdf5', 
-                           key = 'df', mode = 'w')
-    
-    
-## Retrieve and export Pywr-DRB nodal inflows
-# Load the segment outflow which was previous extracted
-drb_seg_outflow = pd.read_hdf(f'{OUTPUT_DIR}/hdf/drb_seg_outflow_mgd.hdf5', 
-                              key = 'df')
-
-## Retrieve just Pywr-DRB relevant flows
-# Node inflows
-pywr_drb_sites = []
-for sites in nhm_site_matches.values():
-    for s in sites:
-        pywr_drb_sites.append(s)
-
-# NHM flows that match gages in PywrDRB (Points of Interest)
-for node, gage_ids in obs_pub_site_matches.items():
-    if gage_ids:
-        for g_id in gage_ids:
-            nhm_gage_poi_id = drb_nhm_gage_segments[drb_nhm_gage_segments.gage_id == g_id].nhm_segment_id
-            if len(nhm_gage_poi_id) > 0:
-                print(f'NHM equivalent POI {nhm_gage_poi_id.values[0]} found for {node}')
-                pywr_drb_sites.append(str(nhm_gage_poi_id.values[0]))
-
-pywr_drb_nhm_flows = drb_seg_outflow.loc[:, pywr_drb_sites]
-
-# Get rid of duplicate column from `delDRCanal` and `delTrenton`
-pywr_drb_nhm_flows = pywr_drb_nhm_flows.T.drop_duplicates().T
-
-# Export
-pywr_drb_nhm_flows.to_csv(f'{OUTPUT_DIR}/csv/streamflow_daily_nhmv10_mgd.csv', sep = ',')
-if export_to_pywrdrb:
-    pywr_drb_nhm_flows.to_csv(f'{PYWRDRB_DIR}input_data/modeled_gages/streamflow_daily_nhmv10_mgd.csv', sep = ',')
\ No newline at end of file
+    drb_seg_outflow = load_nhm_flows(f'{output_dir}/netcdf/seg_outflow.nc', 'seg_outflow', 'segment', drb_segment_ids)
+    write_flow_dataset(drb_seg_outflow, f'{output_dir}/csv/drb_seg_outflow_mgd',
+                       units='mgd', source='nhmv10', export_csv=True)
+    return drb_seg_outflow
+
+
+def get_pywrdrb_nhm_flows(drb_seg_outflow, drb_nhm_gage_segments):
+    """
+    Selects the segment outflows for Pywr-DRB nodes and gage points of interest.
+
+    Args:
+        drb_seg_outflow (pd.DataFrame): DRB segment outflows.
+        drb_nhm_gage_segments (pd.DataFrame): DRB gage_id and nhm_segment_id.
+
+    Returns:
+        pd.DataFrame: Segment outflows for Pywr-DRB.
+    """
+    # Node inflows
+    pywr_drb_sites = get_site_match_registry().get_read_list('nhmv10', roles=('node',))
+
+    # NHM flows that match gages in PywrDRB (Points of Interest)
+    for node, gage_ids in obs_pub_site_matches.items():
+        if gage_ids:
+            for g_id in gage_ids:
+                nhm_gage_poi_id = drb_nhm_gage_segments[drb_nhm_gage_segments.gage_id == g_id].nhm_segment_id
+                if len(nhm_gage_poi_id) > 0:
+                    print(f'NHM equivalent POI {nhm_gage_poi_id.values[0]} found for {node}')
+                    if str(nhm_gage_poi_id.values[0]) not in pywr_drb_sites:
+                        pywr_drb_sites.append(str(nhm_gage_poi_id.values[0]))
+
+    # Read list has no duplicate IDs (e.g., shared by `delDRCanal` and `delTrenton`)
+    with span('select') as s:
+        pywr_drb_nhm_flows = drb_seg_outflow.rename(columns=str).loc[:, pywr_drb_sites]
+        s.set_shape(pywr_drb_nhm_flows)
+    return pywr_drb_nhm_flows
+
+
+def main():
+    with span('nhmv10'):
+        drb_segment_ids, drb_nhm_gage_segments = get_drb_nhm_gage_segments()
+        drb_nhm_gage_segments.to_csv(f'{OUTPUT_DIR}/meta/drb_nhm_gage_segment_ids.csv', 
+                                     sep=',')
+
+        ## Load the NHM data from .tar file location
+        if re_extract:
+            drb_seg_outflow = extract_nhm_drb_flows(drb_segment_ids)
+        else:
+            # Load the segment outflow which was previous extracted
+            drb_seg_outflow = read_flow_dataset(f'{OUTPUT_DIR}/csv/drb_seg_outflow_mgd')
+
+        ## Retrieve and export Pywr-DRB nodal inflows
+        pywr_drb_nhm_flows = get_pywrdrb_nhm_flows(drb_seg_outflow, drb_nhm_gage_segments)
+
+        # Export
+        write_flow_dataset(pywr_drb_nhm_flows, f'{OUTPUT_DIR}/csv/streamflow_daily_nhmv10_mgd',
+                           units='mgd', source='nhmv10', site_matches=get_site_match_registry().get_node_matches('nhmv10'))
+        if export_to_pywrdrb:
+            write_flow_csv(pywr_drb_nhm_flows, f'{PYWRDRB_DIR}input_data/modeled_gages/streamflow_daily_nhmv10_mgd.csv')
+
+
+if __name__ == '__main__':
+    main()
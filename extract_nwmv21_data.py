@@ -1,101 +1,203 @@
-import os
-import tarfile
-import netCDF4 as nc
-import xarray
 import pandas as pd
 import numpy as np
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import matplotlib as mpl
-import sys
-import itertools
 
-from directories import PYWRDRB_DIR, NWM_DIR
+from directories import NWM_DIR, necessary_files, check_necessary_files
+from dataset_io import write_flow_dataset, cast_flows, get_max_abs_difference, FLOW_DTYPE
+from instrumentation import span
+from site_match_registry import get_site_match_registry
 OUTPUT_DIR = './datasets/NWMv21/'
 
-sys.path.append(PYWRDRB_DIR)
-
 # Constants
 cms_to_mgd = 22.82
 cm_to_mg = 264.17/1e6
 cfs_to_mgd = 0.64631688969744
 
 crs = 4386
-drb = gpd.read_file(f'{PYWRDRB_DIR}DRB_spatial/DRB_shapefiles/drb_bnd_polygon.shp').to_crs(crs)
-
-# Load NWM dataset 1979-2020
-nwm_nwis = nc.Dataset(f'{NWM_DIR}nwmv21_nwis.nc')
-print('NWMv21 NWIS dataset loaded...')
-
-# Load unmanaged gauge metadata
-unmanaged_gauge_metadata = pd.read_csv(f'./datasets/USGS/drb_unmanaged_usgs_metadata.csv', dtype={'site_no':str})
-all_gauge_metadata = pd.read_csv(f'./datasets/USGS/drb_all_usgs_metadata.csv', dtype={'site_no':str})
-
-# Pull longitude and latitude
-long = nwm_nwis['longitude'][:].data
-lat = nwm_nwis['latitude'][:].data
-feature_id = nwm_nwis['feature_id'][:].data
-time_index = nwm_nwis['time'][:].data
-
-# Find NWM points that match unmanaged gauges
-nwm_gauge_matches = {}
-nwm_gauge_matches['comid'] = []
-nwm_gauge_matches['site_no'] = []
-nwm_gauge_matches['lat'] = []
-nwm_gauge_matches['long'] = []
-
-nwm_gauge_matches_idx = []
-for i,id in enumerate(feature_id):
-    if id in list(all_gauge_metadata['comid']):
-        nwm_gauge_matches['comid'].append(id)
-        nwm_gauge_matches['site_no'].append(all_gauge_metadata.loc[all_gauge_metadata['comid']==id, 'site_no'].values[0])
-        nwm_gauge_matches['lat'].append(lat[i])
-        nwm_gauge_matches['long'].append(long[i])
-        
-        nwm_gauge_matches_idx.append(i)
-
-    # TODO: A new reach for Nockamixon: the original is bad    
-    # elif str(id) == '2591219':
-        
-    
-    elif str(id) == '4147956':
 
-        # Neversink is getting dropped because it is not in the unmanaged gauge list somereason
-        station_no =  '01435000'
-        
-        nwm_gauge_matches['comid'].append(id)
-        nwm_gauge_matches['site_no'].append(station_no)
-        nwm_gauge_matches['lat'].append(lat[i])
-        nwm_gauge_matches['long'].append(long[i])
-        nwm_gauge_matches_idx.append(i)
-        
-# Pull streamflow data
-for i in nwm_gauge_matches_idx:
-    if i == nwm_gauge_matches_idx[0]:
-        nwm_gauge_data = pd.DataFrame(nwm_nwis['streamflow'][i,:].data*cms_to_mgd, index=time_index, columns=[feature_id[i]])
-    else:
-        nwm_gauge_data[feature_id[i]] = pd.DataFrame(nwm_nwis['streamflow'][i,:].data*cms_to_mgd, index=time_index)
-        
-## Aggregate to daily flow in MGD
 # Default time is hours since 1970-02-01 00:00:00
 # source: https://www.sciencebase.gov/catalog/item/612e264ed34e40dd9c091228
-print('Aggregating to daily flow...')
-datetime_index = pd.date_range(start='1979-02-01 00:00:00', end='2020-12-31', 
-                               freq='D')
-
-# Pull data for each day
-nwm_streamflow = pd.DataFrame(index=datetime_index, columns=nwm_gauge_data.columns)
-for i,d in enumerate(datetime_index):
-    nwm_streamflow.loc[d,:] = nwm_gauge_data.iloc[(i*24):(i*24+24),:].mean(axis=0)
-    
-# Change columns to strings
-nwm_streamflow.columns = nwm_streamflow.columns.astype(str)
-
-## Export
-# Streamflow
-nwm_streamflow.to_csv(f'{OUTPUT_DIR}/nwmv21_gauge_streamflow_daily_mgd.csv')
-
-# Metadata
-nwm_gauge_matches = pd.DataFrame(nwm_gauge_matches)
-nwm_gauge_matches.to_csv(f'{OUTPUT_DIR}/nwmv21_gauge_metadata.csv', index=False)
-print(f'NWMv21 NWIS streamflow and metadata exported to {OUTPUT_DIR}!')
\ No newline at end of file
+nwm_start_date = '1979-02-01 00:00:00'
+nwm_end_date = '2020-12-31'
+
+
+def match_nwm_gauges(feature_id, lat, long, all_gauge_metadata):
+    """
+    Finds NWM points that match gauges.
+
+    Args:
+        feature_id (np.array): NWM feature IDs (COMIDs).
+        lat (np.array): Latitude of each feature.
+        long (np.array): Longitude of each feature.
+        all_gauge_metadata (pd.DataFrame): Gauge metadata with comid and site_no.
+
+    Returns:
+        tuple: (dict of matched comid, site_no, lat, long; list of matched feature indices)
+    """
+    nwm_gauge_matches = {}
+    nwm_gauge_matches['comid'] = []
+    nwm_gauge_matches['site_no'] = []
+    nwm_gauge_matches['lat'] = []
+    nwm_gauge_matches['long'] = []
+
+    nwm_gauge_matches_idx = []
+    for i,id in enumerate(feature_id):
+        if id in list(all_gauge_metadata['comid']):
+            nwm_gauge_matches['comid'].append(id)
+            nwm_gauge_matches['site_no'].append(all_gauge_metadata.loc[all_gauge_metadata['comid']==id, 'site_no'].values[0])
+            nwm_gauge_matches['lat'].append(lat[i])
+            nwm_gauge_matches['long'].append(long[i])
+            
+            nwm_gauge_matches_idx.append(i)
+
+        # TODO: A new reach for Nockamixon: the original is bad    
+        # elif str(id) == '2591219':
+            
+        
+        elif str(id) == '4147956':
+
+            # Neversink is getting dropped because it is not in the unmanaged gauge list somereason
+            station_no =  '01435000'
+            
+            nwm_gauge_matches['comid'].append(id)
+            nwm_gauge_matches['site_no'].append(station_no)
+            nwm_gauge_matches['lat'].append(lat[i])
+            nwm_gauge_matches['long'].append(long[i])
+            nwm_gauge_matches_idx.append(i)
+    return nwm_gauge_matches, nwm_gauge_matches_idx
+
+
+def aggregate_to_daily(nwm_gauge_data, start_date=nwm_start_date, end_date=nwm_end_date, s=None):
+    """
+    Aggregates hourly NWM flows to daily means.
+
+    The hours are reshaped to (day, hour, gauge) and averaged in one pass, accumulating in float64.
+    Hours missing at the end of the record are treated as NaN, and NaN hours are skipped.
+
+    Args:
+        nwm_gauge_data (pd.DataFrame): Hourly flows, starting at start_date.
+        start_date (str): First day.
+        end_date (str): Last day.
+        s (instrumentation.Span, optional): Span to record the precision difference on (see dataset_io.cast_flows).
+
+    Returns:
+        pd.DataFrame: Daily flows with string feature ID columns.
+    """
+    datetime_index = pd.date_range(start=start_date, end=end_date, 
+                                   freq='D')
+
+    # (day, hour, gauge) blocks of hourly flow; only padded (copied) if hours are missing at the end
+    hourly = nwm_gauge_data.to_numpy()
+    n_hours = len(datetime_index)*24
+    if len(hourly) < n_hours:
+        hourly = np.concatenate([hourly, np.full((n_hours - len(hourly), hourly.shape[1]), np.nan, dtype=hourly.dtype)])
+    blocks = hourly[:n_hours].reshape(len(datetime_index), 24, hourly.shape[1])
+
+    valid = ~np.isnan(blocks)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        daily = blocks.sum(axis=1, dtype='float64', where=valid) / valid.sum(axis=1)
+
+    # Change columns to strings
+    nwm_streamflow = cast_flows(pd.DataFrame(daily, index=datetime_index, columns=nwm_gauge_data.columns.astype(str)), s=s)
+    return nwm_streamflow
+
+
+def extract_nwm_gauge_streamflow(nwm_filename=f'{NWM_DIR}nwmv21_nwis.nc',
+                                 gauge_metadata_filename='./datasets/USGS/drb_all_usgs_metadata.csv'):
+    """
+    Extracts daily NWMv2.1 streamflow (MGD) at gauges from the NWIS retrospective NetCDF.
+
+    Args:
+        nwm_filename (str): nwmv21_nwis.nc file.
+        gauge_metadata_filename (str): Gauge metadata with comid and site_no.
+
+    Returns:
+        tuple: (pd.DataFrame of daily streamflow, pd.DataFrame of gauge matches)
+    """
+    import netCDF4 as nc
+
+    # Load NWM dataset 1979-2020
+    with span('load', filename=nwm_filename) as s:
+        nwm_nwis = nc.Dataset(nwm_filename)
+        print('NWMv21 NWIS dataset loaded...')
+
+        # Load gauge metadata
+        all_gauge_metadata = pd.read_csv(gauge_metadata_filename, dtype={'site_no':str})
+
+        # Pull longitude and latitude
+        long = nwm_nwis['longitude'][:].data
+        lat = nwm_nwis['latitude'][:].data
+        feature_id = nwm_nwis['feature_id'][:].data
+        time_index = nwm_nwis['time'][:].data
+        s.set(rows=len(time_index), columns=len(feature_id))
+
+    # Find NWM points that match gauges
+    with span('select') as s:
+        nwm_gauge_matches, nwm_gauge_matches_idx = match_nwm_gauges(feature_id, lat, long, all_gauge_metadata)
+        s.set(columns=len(nwm_gauge_matches_idx))
+
+    # Pull streamflow data; each gauge is converted in float64 and stored as the precision policy dtype
+    with span('load', variable='streamflow') as s:
+        hourly = np.empty((len(time_index), len(nwm_gauge_matches_idx)), dtype=FLOW_DTYPE)
+        max_abs_diff = 0.0
+        for j, i in enumerate(nwm_gauge_matches_idx):
+            gauge_flow = nwm_nwis['streamflow'][i,:].data.astype('float64')*cms_to_mgd
+            hourly[:, j] = gauge_flow
+            max_abs_diff = max(max_abs_diff, get_max_abs_difference(hourly[:, j], gauge_flow))
+        nwm_nwis.close()
+        nwm_gauge_data = pd.DataFrame(hourly, index=time_index, columns=feature_id[nwm_gauge_matches_idx])
+        s.set(dtype=FLOW_DTYPE, max_abs_diff=max_abs_diff)
+        s.set_shape(nwm_gauge_data)
+
+    ## Aggregate to daily flow in MGD
+    print('Aggregating to daily flow...')
+    with span('aggregate') as s:
+        nwm_streamflow = aggregate_to_daily(nwm_gauge_data, s=s)
+        s.set_shape(nwm_streamflow)
+    return nwm_streamflow, pd.DataFrame(nwm_gauge_matches)
+
+
+def get_unmanaged_gauge_streamflow(nwm_streamflow, nwm_gauge_matches,
+                                   unmanaged_metadata_filename='./datasets/USGS/drb_unmanaged_usgs_metadata.csv'):
+    """
+    Selects the NWM gauge flows at unmanaged gauges, and at the gauges used for inflow scaling.
+
+    Args:
+        nwm_streamflow (pd.DataFrame): Daily streamflow with feature ID (COMID) columns.
+        nwm_gauge_matches (pd.DataFrame): Gauge matches with comid and site_no.
+        unmanaged_metadata_filename (str): Unmanaged gauge metadata with site_no.
+
+    Returns:
+        tuple: (pd.DataFrame of daily streamflow, pd.DataFrame of gauge matches) for the unmanaged gauges
+    """
+    unmanaged_gauge_metadata = pd.read_csv(unmanaged_metadata_filename, dtype={'site_no':str})
+
+    # Scaling gauges are kept even if labelled as managed (e.g., Neversink)
+    keep_stations = set(unmanaged_gauge_metadata['site_no']) | set(get_site_match_registry().get_read_list('nwmv21', roles=('scaling_gauge',)))
+    unmanaged_gauge_matches = nwm_gauge_matches.loc[nwm_gauge_matches['site_no'].isin(keep_stations)]
+    unmanaged_streamflow = nwm_streamflow.loc[:, unmanaged_gauge_matches['comid'].astype(str).values]
+    return unmanaged_streamflow, unmanaged_gauge_matches
+
+
+def main():
+    with span('nwmv21'):
+        check_necessary_files(NWM_DIR, necessary_files)
+        nwm_streamflow, nwm_gauge_matches = extract_nwm_gauge_streamflow()
+
+        ## Export
+        # Streamflow
+        write_flow_dataset(nwm_streamflow, f'{OUTPUT_DIR}/nwmv21_gauge_streamflow_daily_mgd',
+                           units='mgd', source='nwmv21')
+
+        # Metadata
+        nwm_gauge_matches.to_csv(f'{OUTPUT_DIR}/nwmv21_gauge_metadata.csv', index=False)
+
+        # Unmanaged gauges, for inflow scaling
+        unmanaged_streamflow, unmanaged_gauge_matches = get_unmanaged_gauge_streamflow(nwm_streamflow, nwm_gauge_matches)
+        write_flow_dataset(unmanaged_streamflow, f'{OUTPUT_DIR}/nwmv21_unmanaged_gauge_streamflow_daily_mgd',
+                           units='mgd', source='nwmv21')
+        unmanaged_gauge_matches.to_csv(f'{OUTPUT_DIR}/nwmv21_unmanaged_gauge_metadata.csv', index=False)
+        print(f'NWMv21 NWIS streamflow and metadata exported to {OUTPUT_DIR}!')
+
+
+if __name__ == '__main__':
+    main()
@@ -20,11 +20,12 @@ The output files will have the names:
     This contains the lake inflow for reservoirs nodes
 
 """
-import netCDF4 as nc
 import pandas as pd
-import sys
 import os
-from inflow_scaling_regression import scaling_site_matches
+from pywr_drb_node_data import wrf_hydro_site_matches, pywrdrb_wrf_hydro_flowtypes
+from site_match_registry import get_site_match_registry
+from dataset_io import write_flow_dataset, cast_flows, FLOW_DTYPE
+from instrumentation import span
 from directories import WRFHYDRO_DIR, PYWRDRB_DIR
 
 # Constants
@@ -57,92 +58,13 @@ date_ranges = {
 }
 
 
-## WRF-Hydro COMID numbers; taken from nhm_site_matches
-wrf_hydro_site_matches = {'cannonsville': ['2613174'],    # Lake inflow
-                    'pepacton': ['1748473'],        # Lake inflow
-                    'neversink': ['4146742'],       # Lake inflow
-                    'wallenpaupack': ['2741600'],   # Lake inflow
-                    'prompton': ['2739068'],        # Lake inflow
-                    'shoholaMarsh': ['120052035'],  # Lake inflow
-                    'mongaupeCombined': ['4148582'],    # Lake inflow
-                    'beltzvilleCombined': ['4186689'],  # Lake inflow
-                    'fewalter': ['4185065'],        # Lake inflow
-                    'merrillCreek': ['2588031'],    # No NWM lake; using available segment flow
-                    'hopatcong': ['2585287'],       # Lake inflow
-                    'nockamixon': ['2591099'],      # No NWM lake; using available segment flow  2591187 2591219
-                    'assunpink': ['2589015'],       # Lake inflow
-                    'ontelaunee': ['4779981'],      # Lake inflow
-                    'stillCreek': ['4778721'],      # Lake inflow
-                    'blueMarsh': ['4782813'],       # Lake inflow
-                    'greenLane': ['4780087'],       # Lake inflow 
-                    '01425000': ['2614238'],
-                    '01417000': ['1748727'],
-                    'delLordville': ['2617364'],
-                    '01436000': ['4147432'],
-                    '01433500': ['4150156'],
-                    'delMontague': ['4151628'],
-                    '01449800': ['4187341'],
-                    '01447800': ['4186403'],
-                    'delDRCanal': ['2590277'],
-                    'delTrenton': ['2590277'],
-                    '01463620': ['2590117'],
-                    'outletAssunpink': ['2590137'],
-                    '01470960': ['4783213'],
-                    'outletSchuylkill': ['4784841']
-                    }
-
 ## Sites used for obs inflow scaling
-wrf_scaling_gauges = []
-wrf_scaling_hrus = []
-for reservoir, match_dict in scaling_site_matches.items():
-    for flow_type, ids in match_dict.items():
-        if 'wrf' in flow_type:
-            for id in ids:
-                if 'gauge' in flow_type:
-                    if id not in wrf_scaling_gauges:
-                        wrf_scaling_gauges.append(id)
-                elif 'hru' in flow_type:
-                    if id not in wrf_scaling_hrus:
-                        wrf_scaling_hrus.append(id)
-print(f'WRF-Hydro inflow scaling reaches: {wrf_scaling_gauges}')
-print(f'WRF-Hydro inflow scaling HRUs: {wrf_scaling_hrus}')
-
-pywrdrb_wrf_hydro_flowtypes = {
-    'cannonsville': 'lakes',    # Lake inflow
-    'pepacton': 'lakes',        # Lake inflow
-    'neversink': 'lakes',       # Lake inflow
-    'wallenpaupack': 'lakes',   # Lake inflow
-    'prompton': 'lakes',        # Lake inflow
-    'shoholaMarsh': 'lakes',  # Lake inflow
-    'mongaupeCombined': 'lakes',    # Lake inflow
-    'beltzvilleCombined': 'lakes',  # Lake inflow
-    'fewalter': 'lakes',        # Lake inflow
-    'merrillCreek': 'reaches',    # No NWM lake; using available segment flow
-    'hopatcong': 'lakes',       # Lake inflow
-    'nockamixon': 'reaches',      # No NWM lake; using available segment flow  2591187 2591219
-    'assunpink': 'lakes',       # Lake inflow
-    'ontelaunee': 'lakes',      # Lake inflow
-    'stillCreek': 'lakes',      # Lake inflow
-    'blueMarsh': 'lakes',       # Lake inflow
-    'greenLane': 'lakes',       # Lake inflow 
-    '01425000': 'reaches',
-    '01417000': 'reaches',
-    'delLordville': 'reaches',
-    '01436000': 'reaches',
-    '01433500': 'reaches',
-    'delMontague': 'reaches',
-    '01449800': 'reaches',
-    '01447800': 'reaches',
-    'delDRCanal': 'reaches',
-    'delTrenton': 'reaches',
-    '01463620': 'reaches',
-    'outletAssunpink': 'reaches',
-    '01470960': 'reaches',
-    'outletSchuylkill': 'reaches'
-    }
+registry = get_site_match_registry()
+wrf_scaling_gauges = registry.get_read_list('wrf', roles=('scaling_gauge',))
+wrf_scaling_hrus = registry.get_read_list('wrf', roles=('scaling_hru',))
 
 # Function to get full filepath for a specific config
-def get_WRF_Hydro_output_filename(config):
+def get_WRF_Hydro_output_filename(config, wrf_dir=WRFHYDRO_DIR):
     inval_option_msg = 'Invalid option specified for {0}. Options: {1}'
     assert(config['climate'] in climate_opts), inval_option_msg.format('climate', climate_opts)
     assert(config['calibration'] in calibration_opts), inval_option_msg.format('calibration', calibration_opts)
@@ -160,7 +82,7 @@ def get_WRF_Hydro_output_filename(config):
         subfolder = '2050s_climate/'
         climate_src = 'wrf' + config["climate"]
     
-    dir = WRFHYDRO_DIR + subfolder
+    dir = wrf_dir + subfolder
     if config['levelpool'] == 'pool':
         fname = f'{dir}{config["flowtype"]}_daily_{config["calibration"]}_{config["landcover"]}_{climate_src}.nc'      
     else:
@@ -170,35 +92,42 @@ def get_WRF_Hydro_output_filename(config):
 
 def load_WRF_Hydro_data_from_config(config, 
                                     units='mgd', cms_to_mgd=cms_to_mgd,
-                                    date_ranges=date_ranges):
+                                    date_ranges=date_ranges,
+                                    wrf_dir=WRFHYDRO_DIR):
     """
     Extracts WRF-Hydro data for a specific configuration and date range.
     """
     
-    src_fname = get_WRF_Hydro_output_filename(config)
+    src_fname = get_WRF_Hydro_output_filename(config, wrf_dir=wrf_dir)
     
     # make sure file exists
     os.path.exists(src_fname), f'File {src_fname} not found.'
         
+    import netCDF4 as nc
+
     # load
-    wrf = nc.Dataset(src_fname)
+    with span('load', filename=src_fname) as s:
+        wrf = nc.Dataset(src_fname)
     
-    # pull features
-    if config['flowtype'] == 'reaches':
-        streamflow = wrf['streamflow'][:].data
-    elif config['flowtype'] == 'lakes':
-        streamflow = wrf['inflow'][:].data
+        # pull features
+        if config['flowtype'] == 'reaches':
+            streamflow = wrf['streamflow'][:].data
+        elif config['flowtype'] == 'lakes':
+            streamflow = wrf['inflow'][:].data
         
-    if units == 'mgd':
-        streamflow = streamflow * cms_to_mgd
-    elif units == 'cms':
-        pass
-    else:
-        raise ValueError('Invalid units specified. Options: "mgd", "cms"')
+        if units == 'mgd':
+            streamflow = streamflow.astype('float64') * cms_to_mgd
+        elif units == 'cms':
+            pass
+        else:
+            raise ValueError('Invalid units specified. Options: "mgd", "cms"')
     
-    feature_id = wrf['feature_id'][:].data
+        feature_id = wrf['feature_id'][:].data
     
-    time = wrf['time'][:].data
+        time = wrf['time'][:].data
+        wrf.close()
+        streamflow = cast_flows(streamflow, s=s)
+        s.set_shape(streamflow)
     datetime = pd.date_range(start=date_ranges[config['climate']][0],
                                 end=date_ranges[config['climate']][1],
                                 freq='D')
@@ -215,7 +144,8 @@ def retrieve_pywrdrb_inputs_from_WRF_Hydro(climate, calib, landcover,
                                           wrf_hydro_site_matches,
                                           pywrdrb_wrf_hydro_flowtypes=pywrdrb_wrf_hydro_flowtypes,
                                           date_ranges=date_ranges,
-                                          labelby_pywrdrb_nodes=False):
+                                          labelby_pywrdrb_nodes=False,
+                                          wrf_dir=WRFHYDRO_DIR):
     """
     Extracts Pywr-DRB input data from WRF-Hydro model results.
     """
@@ -228,44 +158,42 @@ def retrieve_pywrdrb_inputs_from_WRF_Hydro(climate, calib, landcover,
     # Load WRF-Hydro data for reaches with levelpool off
     config['flowtype'] = 'reaches'
     config['levelpool'] = 'no_pool'
-    wrf_reaches_df = load_WRF_Hydro_data_from_config(config, date_ranges=date_ranges)
+    wrf_reaches_df = load_WRF_Hydro_data_from_config(config, date_ranges=date_ranges, wrf_dir=wrf_dir)
     
     # Load WRF-Hydro data for lake inflows
     config['flowtype'] = 'lakes'
     config['levelpool'] = 'pool'
-    wrf_lakes_df = load_WRF_Hydro_data_from_config(config, date_ranges=date_ranges)
+    wrf_lakes_df = load_WRF_Hydro_data_from_config(config, date_ranges=date_ranges, wrf_dir=wrf_dir)
     
-    output_columns = list(wrf_hydro_site_matches.keys()) if labelby_pywrdrb_nodes else [item for sublist in list(wrf_hydro_site_matches.values()) for item in sublist]
-    for fid in wrf_scaling_gauges:
-        output_columns.append(fid)
-    for fid in wrf_scaling_hrus:
-        output_columns.append(fid)     
-    output_columns = list(set(output_columns))
+    output_columns = list(wrf_hydro_site_matches.keys()) if labelby_pywrdrb_nodes else registry.get_read_list('wrf', roles=('reach', 'lake'))
+    output_columns += [fid for fid in wrf_scaling_gauges + wrf_scaling_hrus if fid not in output_columns]
     
-    wrf_pywrdrb_df = pd.DataFrame(index=wrf_reaches_df.index, columns=output_columns)
+    with span('select') as s:
+        wrf_pywrdrb_df = pd.DataFrame(index=wrf_reaches_df.index, columns=output_columns, dtype=FLOW_DTYPE)
     
-    for node, fid in wrf_hydro_site_matches.items():
-        if pywrdrb_wrf_hydro_flowtypes[node] == 'reaches':
-            node_flow = wrf_reaches_df[fid]
-        elif pywrdrb_wrf_hydro_flowtypes[node] == 'lakes':
-            node_flow = wrf_lakes_df[fid]
+        for node, fid in wrf_hydro_site_matches.items():
+            if pywrdrb_wrf_hydro_flowtypes[node] == 'reaches':
+                node_flow = wrf_reaches_df[fid]
+            elif pywrdrb_wrf_hydro_flowtypes[node] == 'lakes':
+                node_flow = wrf_lakes_df[fid]
         
-        if labelby_pywrdrb_nodes:
-            wrf_pywrdrb_df.loc[:,node] = node_flow.values
-        else:
-            wrf_pywrdrb_df.loc[:,fid] = node_flow.values
+            if labelby_pywrdrb_nodes:
+                wrf_pywrdrb_df.loc[:,node] = node_flow.values
+            else:
+                wrf_pywrdrb_df.loc[:,fid] = node_flow.values
     
-    # Add scaling for reaches with inflow scaling
-    for fid in wrf_scaling_gauges:
-        if fid in wrf_pywrdrb_df.columns:
-            wrf_pywrdrb_df.loc[:, fid] = wrf_reaches_df[fid].values
-    for fid in wrf_scaling_hrus:
-        if fid in wrf_pywrdrb_df.columns:
-            wrf_pywrdrb_df.loc[:, fid] = wrf_lakes_df[fid].values
+        # Add scaling for reaches with inflow scaling
+        for fid in wrf_scaling_gauges:
+            if fid in wrf_pywrdrb_df.columns:
+                wrf_pywrdrb_df.loc[:, fid] = wrf_reaches_df[fid].values
+        for fid in wrf_scaling_hrus:
+            if fid in wrf_pywrdrb_df.columns:
+                wrf_pywrdrb_df.loc[:, fid] = wrf_lakes_df[fid].values
+        s.set_shape(wrf_pywrdrb_df)
     return wrf_pywrdrb_df
 
-def get_export_filename(config):
-    fname = f'{WRFHYDRO_DIR}streamflow_daily_wrf{config["climate"]}_{config["calibration"]}_{config["landcover"]}.csv'
+def get_export_filename(config, output_dir=WRFHYDRO_DIR):
+    fname = f'{output_dir}streamflow_daily_wrf{config["climate"]}_{config["calibration"]}_{config["landcover"]}.csv'
     return fname
 
 
@@ -274,29 +202,26 @@ def retrieve_and_export_pywrdrb_input_from_WRF_Hydro_output(config,
                                                             pywrdrb_wrf_hydro_flowtypes=pywrdrb_wrf_hydro_flowtypes,
                                                             labelby_pywrdrb_nodes=False,
                                                             date_ranges=date_ranges,
-                                                            return_df=False):
+                                                            return_df=False,
+                                                            wrf_dir=WRFHYDRO_DIR,
+                                                            output_dir=WRFHYDRO_DIR):
     """
-    Exports Pywr-DRB input data to a CSV file.
+    Exports Pywr-DRB input data (see dataset_io.write_flow_dataset).
     """
-    export_fname = get_export_filename(config)
+    with span('wrf_hydro', config=f'{config["climate"]}_{config["calibration"]}_{config["landcover"]}'):
+        export_fname = get_export_filename(config, output_dir=output_dir)
     
-    df = retrieve_pywrdrb_inputs_from_WRF_Hydro(config['climate'], config['calibration'], config['landcover'], wrf_hydro_site_matches,
-                                                pywrdrb_wrf_hydro_flowtypes=pywrdrb_wrf_hydro_flowtypes, labelby_pywrdrb_nodes=labelby_pywrdrb_nodes, 
-                                                date_ranges=date_ranges)
-    df.to_csv(export_fname)
-    print(f'Exported Pywr-DRB input data to {export_fname}')
+        df = retrieve_pywrdrb_inputs_from_WRF_Hydro(config['climate'], config['calibration'], config['landcover'], wrf_hydro_site_matches,
+                                                    pywrdrb_wrf_hydro_flowtypes=pywrdrb_wrf_hydro_flowtypes, labelby_pywrdrb_nodes=labelby_pywrdrb_nodes, 
+                                                    date_ranges=date_ranges, wrf_dir=wrf_dir)
+        export_fname = write_flow_dataset(df, export_fname, units='mgd',
+                                          source=f'wrf{config["climate"]}_{config["calibration"]}_{config["landcover"]}',
+                                          site_matches=wrf_hydro_site_matches)
+        print(f'Exported Pywr-DRB input data to {export_fname}')
     return df if return_df else None
 
 
-
-
-
-
-
-if __name__ == '__main__':
-    
-    
-    
+def main():
     ### Process different model configurations
     
     ## Current climate (AORC)
@@ -337,4 +262,8 @@ if __name__ == '__main__':
         'landcover': 'nlcd2016',
     }
     retrieve_and_export_pywrdrb_input_from_WRF_Hydro_output(config, wrf_hydro_site_matches, 
-                                                            labelby_pywrdrb_nodes=False, return_df=False)
\ No newline at end of file
+                                                            labelby_pywrdrb_nodes=False, return_df=False)
+
+
+if __name__ == '__main__':
+    main()
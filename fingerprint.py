@@ -0,0 +1,50 @@
+"""
+Helper functions used to fingerprint input files and parameters, 
+so that cached intermediate results can be re-used until their inputs change.
+"""
+import os
+import json
+import hashlib
+
+
+def hash_file(filename, chunk_size=2**20):
+    """Return the sha256 hex digest of a file's contents.
+
+    Args:
+        filename (str): Path to the file.
+        chunk_size (int): Number of bytes to read at a time.
+
+    Returns:
+        str: Hex digest.
+    """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_object(obj):
+    """Return the sha256 hex digest of a JSON-serializable object (e.g., a dict of parameters).
+
+    Args:
+        obj: Object to hash. Keys are sorted, so dict order does not matter.
+
+    Returns:
+        str: Hex digest.
+    """
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def hash_shapefile(filename):
+    """Return the sha256 hex digest of all components (.shp, .shx, .dbf, .prj, .cpg) of a shapefile.
+
+    Args:
+        filename (str): Path to the .shp file.
+
+    Returns:
+        str: Hex digest.
+    """
+    stem = os.path.splitext(filename)[0]
+    components = [f'{stem}{ext}' for ext in ['.shp', '.shx', '.dbf', '.prj', '.cpg']]
+    return hash_object([hash_file(f) for f in components if os.path.exists(f)])
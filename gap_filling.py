@@ -0,0 +1,300 @@
+"""
+Fills gaps in the observed USGS gauge flows used by Pywr-DRB, using donor regressions.
+
+Some Pywr-DRB gauges have gaps (e.g., 01463620) or start late (e.g., 0142400103 and
+01414000 begin in 1996). Rather than excluding them, each gap is filled from a donor:
+- the nearest unmanaged gauges with observed flows (drb_unmanaged_usgs_metadata.csv), and
+- modeled flows at the same gauge (NHMv10 gage segments and NWMv2.1 gauge reaches).
+
+For every (target, donor) pair a log-log regression, log(Q_target) = a + b*log(Q_donor),
+is fit on the days both have positive flow. All pairs are fit at once as batched closed-form
+least squares over the (time x pair) arrays, with Duan's smearing factor to correct the bias
+of the back-transform. Donors are ranked for each target by R^2, and each missing day is filled
+from the best ranked donor with data on that day, in one vectorized pass over all gaps and targets.
+
+Outputs (in the units of the observed dataset):
+- <obs dataset>_filled: Observed flows with gaps filled
+- usgs_gap_fill_flags.csv: 0 where observed, the rank (1 = best) of the donor used where filled,
+  and -1 where no donor had data
+- usgs_gap_fill_donors.csv: Regression fit (n_overlap, a, b, r2, smearing) and rank of each pair
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from site_match_registry import get_site_match_registry
+from dataset_io import read_flow_dataset, write_flow_dataset, get_flow_dataset_filename
+from instrumentation import span
+
+OUTPUT_DIR = './datasets/USGS/'
+OBS_FLOW_DATASET = f'{OUTPUT_DIR}streamflow_daily_usgs_1950_2022_cms'
+FILLED_SUFFIX = '_filled'
+
+unmanaged_metadata_filename = f'{OUTPUT_DIR}drb_unmanaged_usgs_metadata.csv'
+all_metadata_filename = f'{OUTPUT_DIR}drb_all_usgs_metadata.csv'
+nhm_flow_dataset = './datasets/NHMv10/csv/streamflow_daily_nhmv10_mgd'
+nhm_gage_segments_filename = './datasets/NHMv10/meta/drb_nhm_gage_segment_ids.csv'
+nwm_flow_dataset = './datasets/NWMv21/nwmv21_gauge_streamflow_daily_mgd'
+nwm_gauge_metadata_filename = './datasets/NWMv21/nwmv21_gauge_metadata.csv'
+
+# Donor selection
+N_NEAREST_DONORS = 3
+MIN_OVERLAP_DAYS = 365
+MIN_DONOR_R2 = 0.5
+
+earth_radius_km = 6371.0
+
+
+def load_obs_flows(filename=OBS_FLOW_DATASET):
+    """
+    Loads observed USGS gauge flows, labeled by site number.
+
+    Args:
+        filename (str): Observed flow dataset, with or without extension.
+
+    Returns:
+        pd.DataFrame: Daily observed flows, with site number columns.
+    """
+    Q_obs = read_flow_dataset(filename, dtype='float64')
+    Q_obs.columns = [c.split('-')[1] if '-' in c else c for c in Q_obs.columns.astype(str)]
+    Q_obs.index = pd.to_datetime(Q_obs.index.date)
+    return Q_obs
+
+
+def load_modeled_equivalents(index):
+    """
+    Loads modeled flows at USGS gauges, from the NHMv10 gage segments and NWMv2.1 gauge reaches
+    which are available. Columns are labeled '{model}-{site_no}'.
+
+    Args:
+        index (pd.DatetimeIndex): Dates to align the flows to.
+
+    Returns:
+        pd.DataFrame: Modeled daily flows.
+    """
+    modeled = []
+    if os.path.exists(nhm_gage_segments_filename):
+        segments = pd.read_csv(nhm_gage_segments_filename, dtype={'gage_id': str, 'nhm_segment_id': str})
+        try:
+            nhm_flows = read_flow_dataset(nhm_flow_dataset, dtype='float64')
+        except FileNotFoundError:
+            nhm_flows = None
+        if nhm_flows is not None:
+            segments = segments.loc[segments['nhm_segment_id'].isin(nhm_flows.columns)]
+            modeled.append(pd.DataFrame(nhm_flows[segments['nhm_segment_id']].values, index=nhm_flows.index,
+                                        columns=[f'nhmv10-{site}' for site in segments['gage_id']]))
+
+    if os.path.exists(nwm_gauge_metadata_filename):
+        gauges = pd.read_csv(nwm_gauge_metadata_filename, dtype={'site_no': str, 'comid': str})
+        try:
+            nwm_flows = read_flow_dataset(nwm_flow_dataset, dtype='float64')
+        except FileNotFoundError:
+            nwm_flows = None
+        if nwm_flows is not None:
+            gauges = gauges.loc[gauges['comid'].isin(nwm_flows.columns)]
+            modeled.append(pd.DataFrame(nwm_flows[gauges['comid']].values, index=nwm_flows.index,
+                                        columns=[f'nwmv21-{site}' for site in gauges['site_no']]))
+
+    if not modeled:
+        return pd.DataFrame(index=index)
+    modeled = pd.concat(modeled, axis=1)
+    return modeled.loc[:, ~modeled.columns.duplicated()].reindex(index)
+
+
+def get_distances_km(lat, long, other_lat, other_long):
+    """Return the (n x m) great circle distances between two sets of points, in km."""
+    lat, long, other_lat, other_long = (np.radians(np.asarray(x, dtype='float64')) for x in (lat, long, other_lat, other_long))
+    dlat = other_lat[None, :] - lat[:, None]
+    dlong = other_long[None, :] - long[:, None]
+    h = np.sin(dlat/2)**2 + np.cos(lat)[:, None]*np.cos(other_lat)[None, :]*np.sin(dlong/2)**2
+    return 2*earth_radius_km*np.arcsin(np.sqrt(h))
+
+
+def get_donor_pairs(targets, obs_columns, modeled_columns,
+                    all_metadata, unmanaged_metadata,
+                    n_nearest=N_NEAREST_DONORS):
+    """
+    Lists the candidate donors of each target gauge: the nearest unmanaged gauges with
+    observed flows, and modeled flows at the same gauge.
+
+    Args:
+        targets (list): Target site numbers.
+        obs_columns (list): Site numbers with observed flows.
+        modeled_columns (list): Modeled flow columns ('{model}-{site_no}').
+        all_metadata (pd.DataFrame): Gauge long and lat, indexed by site_no (must include the targets).
+        unmanaged_metadata (pd.DataFrame): Unmanaged gauge long and lat, indexed by site_no.
+        n_nearest (int): Number of nearest unmanaged gauges to use for each target.
+
+    Returns:
+        list: (target, donor) pairs, where observed donors are site numbers.
+    """
+    candidates = unmanaged_metadata.loc[unmanaged_metadata.index.isin(obs_columns)]
+    located = [t for t in targets if t in all_metadata.index]
+    pairs = []
+    if len(candidates) and located:
+        distances = get_distances_km(all_metadata.loc[located, 'lat'], all_metadata.loc[located, 'long'],
+                                     candidates['lat'], candidates['long'])
+        for target, target_distances in zip(located, distances):
+            order = [candidates.index[i] for i in np.argsort(target_distances) if candidates.index[i] != target]
+            pairs += [(target, donor) for donor in order[:n_nearest]]
+    for target in targets:
+        pairs += [(target, c) for c in modeled_columns if c.split('-', 1)[1] == target]
+    return pairs
+
+
+def fit_donor_regressions(target_flows, donor_flows, pairs):
+    """
+    Fits log(Q_target) = a + b*log(Q_donor) for all (target, donor) pairs at once.
+
+    Args:
+        target_flows (pd.DataFrame): Target flows.
+        donor_flows (pd.DataFrame): Donor flows, on the same index.
+        pairs (list): (target, donor) pairs.
+
+    Returns:
+        pd.DataFrame: n_overlap, a, b, r2 and smearing for each pair, indexed by (target, donor).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Y = np.log(target_flows[[t for t, _ in pairs]].to_numpy(dtype='float64'))
+        X = np.log(donor_flows[[d for _, d in pairs]].to_numpy(dtype='float64'))
+    overlap = np.isfinite(Y) & np.isfinite(X)
+    X = np.where(overlap, X, 0.0)
+    Y = np.where(overlap, Y, 0.0)
+
+    n = overlap.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = X.sum(axis=0)/n
+        y_mean = Y.sum(axis=0)/n
+        dX = np.where(overlap, X - x_mean, 0.0)
+        dY = np.where(overlap, Y - y_mean, 0.0)
+        Sxx = (dX*dX).sum(axis=0)
+        Syy = (dY*dY).sum(axis=0)
+        Sxy = (dX*dY).sum(axis=0)
+        b = Sxy/Sxx
+        a = y_mean - b*x_mean
+        r2 = Sxy**2/(Sxx*Syy)
+
+        # Duan's smearing estimate for the bias of exp(prediction)
+        residuals = np.where(overlap, Y - (a + b*X), 0.0)
+        smearing = np.where(overlap, np.exp(residuals), 0.0).sum(axis=0)/n
+
+    return pd.DataFrame({'n_overlap': n, 'a': a, 'b': b, 'r2': r2, 'smearing': smearing},
+                        index=pd.MultiIndex.from_tuples(pairs, names=['target', 'donor']))
+
+
+def rank_donors(fits, min_overlap=MIN_OVERLAP_DAYS, min_r2=MIN_DONOR_R2):
+    """
+    Ranks the donors of each target by R^2, dropping fits with too little overlap or skill.
+
+    Returns:
+        pd.DataFrame: fits with a 'rank' column (1 = best), or 0 for donors which are not used.
+    """
+    fits = fits.copy()
+    usable = (fits['n_overlap'] >= min_overlap) & (fits['r2'] >= min_r2) & np.isfinite(fits['b'])
+    fits['rank'] = 0
+    fits.loc[usable, 'rank'] = (fits.loc[usable, 'r2'].groupby(level='target').rank(ascending=False, method='first')
+                                .astype(int))
+    return fits
+
+
+def fill_gaps(target_flows, donor_flows, fits):
+    """
+    Fills all missing days of all targets from their best ranked donor with data on each day.
+
+    Args:
+        target_flows (pd.DataFrame): Target flows.
+        donor_flows (pd.DataFrame): Donor flows, on the same index.
+        fits (pd.DataFrame): Output from rank_donors().
+
+    Returns:
+        (pd.DataFrame, pd.DataFrame): Filled flows, and flags (0 observed, donor rank if filled, -1 missing).
+    """
+    targets = list(target_flows.columns)
+    used = fits.loc[fits['rank'] > 0]
+    n_ranks = int(used['rank'].max()) if len(used) else 0
+
+    # Predictions of each used pair, in a (time x target x rank) array
+    predictions = np.full((len(target_flows), len(targets), max(n_ranks, 1)), np.nan)
+    if len(used):
+        donors = donor_flows[used.index.get_level_values('donor')].to_numpy(dtype='float64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            donor_predictions = np.exp(used['a'].values + used['b'].values*np.log(np.where(donors >= 0, donors, np.nan)))
+        donor_predictions *= used['smearing'].values
+        target_idx = pd.Index(targets).get_indexer(used.index.get_level_values('target'))
+        predictions[:, target_idx, used['rank'].values - 1] = donor_predictions
+
+    # Best ranked donor with data on each day
+    available = ~np.isnan(predictions)
+    best = available.argmax(axis=2)
+    has_donor = available.any(axis=2)
+    best_prediction = np.take_along_axis(predictions, best[:, :, None], axis=2)[:, :, 0]
+
+    observed = target_flows.to_numpy(dtype='float64')
+    is_observed = ~np.isnan(observed)
+    filled = np.where(is_observed, observed, np.where(has_donor, best_prediction, np.nan))
+    flags = np.where(is_observed, 0, np.where(has_donor, best + 1, -1)).astype('int8')
+    return (pd.DataFrame(filled, index=target_flows.index, columns=targets),
+            pd.DataFrame(flags, index=target_flows.index, columns=targets))
+
+
+def fill_usgs_gauge_flows(obs_filename=OBS_FLOW_DATASET, targets=None, export=True):
+    """
+    Fills the gaps of the Pywr-DRB gauges in the observed USGS flows.
+
+    Args:
+        obs_filename (str): Observed flow dataset.
+        targets (list, optional): Site numbers to fill. Defaults to all Pywr-DRB obs and obs_pub gauges.
+        export (bool): If True, export the filled flows, flags and donor fits.
+
+    Returns:
+        (pd.DataFrame, pd.DataFrame, pd.DataFrame): Filled flows, flags, and donor fits.
+    """
+    with span('load') as s:
+        Q_obs = load_obs_flows(obs_filename)
+        modeled = load_modeled_equivalents(Q_obs.index)
+        all_metadata = pd.read_csv(all_metadata_filename, dtype={'site_no': str}).set_index('site_no')
+        unmanaged_metadata = pd.read_csv(unmanaged_metadata_filename, dtype={'site_no': str}).set_index('site_no')
+        s.set_shape(Q_obs)
+
+    if targets is None:
+        registry = get_site_match_registry()
+        targets = list(dict.fromkeys(registry.get_read_list('obs') + registry.get_read_list('obs_pub')))
+    missing_targets = [t for t in targets if t not in Q_obs.columns]
+    if missing_targets:
+        print(f'No observed flows for {missing_targets}; they are not filled.')
+    targets = [t for t in targets if t in Q_obs.columns]
+
+    donor_flows = pd.concat([Q_obs, modeled], axis=1)
+    pairs = get_donor_pairs(targets, list(Q_obs.columns), list(modeled.columns), all_metadata, unmanaged_metadata)
+
+    with span('regression', n_pairs=len(pairs)):
+        fits = rank_donors(fit_donor_regressions(Q_obs, donor_flows, pairs))
+
+    with span('fill') as s:
+        Q_filled, flags = fill_gaps(Q_obs[targets], donor_flows, fits)
+        s.set_shape(Q_filled)
+
+    n_filled = (flags > 0).sum()
+    n_missing = (flags < 0).sum()
+    for target in targets:
+        if n_filled[target] or n_missing[target]:
+            print(f'{target}: filled {n_filled[target]} days, {n_missing[target]} days still missing')
+
+    if export:
+        units = 'cms' if obs_filename.endswith('cms') else None
+        write_flow_dataset(Q_filled, f'{obs_filename}{FILLED_SUFFIX}', units=units,
+                           source=f'usgs gap filled ({os.path.basename(get_flow_dataset_filename(obs_filename))})')
+        flags.to_csv(f'{OUTPUT_DIR}usgs_gap_fill_flags.csv', sep=',')
+        fits.to_csv(f'{OUTPUT_DIR}usgs_gap_fill_donors.csv', sep=',')
+    return Q_filled, flags, fits
+
+
+def main():
+    with span('gap_filling'):
+        fill_usgs_gauge_flows()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+Block-bootstrap uncertainty estimates for the inflow scaling regressions
+in inflow_scaling_regression.py.
+
+Whole water years (Oct-Sep) are resampled with replacement. Instead of refitting
+the statsmodels OLS models for each replicate, the seasonal regressions are reduced
+to sufficient statistics for every (water year, quarter) group. The bootstrap resamples
+are drawn as an index matrix, converted to a (replicate x water year) count matrix,
+and multiplied against the grouped statistics to get the normal equations of every
+replicate at once. These are then solved in a single batch.
+
+The outputs are:
+- Distributions of the regression coefficients (const, slope) for each reservoir and quarter
+- Ensembles of scaled reservoir inflows, one member per bootstrap replicate
+"""
+
+import numpy as np
+import pandas as pd
+
+from inflow_scaling_regression import scaled_reservoirs, scaling_site_matches, quarters
+from inflow_scaling_regression import OUTPUT_DIR
+from inflow_scaling_regression import prep_inflow_scaling_data, get_scaling_regression_data, load_usgs_obs_flows
+from instrumentation import span, instrumented
+
+# Quarter index (position in `quarters`) for each month 1-12
+month_quarter_idx = np.array([0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 0])
+
+# Order of the grouped sufficient statistics
+sufficient_stat_names = ('n', 'sum_x', 'sum_y', 'sum_xx', 'sum_xy', 'sum_yy')
+
+
+def get_water_year(index):
+    """Return the water year (Oct 1 - Sep 30, labeled by the ending year) for each date.
+
+    Args:
+        index (pd.DatetimeIndex): Dates.
+
+    Returns:
+        np.ndarray: Water year of each date.
+    """
+    return np.asarray(index.year + (index.month >= 10).astype(int))
+
+
+def get_quarter_index(index):
+    """Return the position in `quarters` for each date.
+
+    Args:
+        index (pd.DatetimeIndex): Dates.
+
+    Returns:
+        np.ndarray: Quarter index (0-3) of each date.
+    """
+    return month_quarter_idx[np.asarray(index.month) - 1]
+
+
+def calculate_grouped_sufficient_statistics(x, y, group_idx, n_groups):
+    """
+    Calculates the OLS sufficient statistics [n, sum_x, sum_y, sum_xx, sum_xy, sum_yy]
+    for each group. Non-finite pairs are excluded.
+
+    Args:
+        x (np.ndarray): Regressor values.
+        y (np.ndarray): Response values.
+        group_idx (np.ndarray): Integer group label of each value.
+        n_groups (int): Total number of groups.
+
+    Returns:
+        np.ndarray: Array with shape (n_groups, 6).
+    """
+    valid = np.isfinite(x) & np.isfinite(y)
+    x, y, group_idx = x[valid], y[valid], group_idx[valid]
+    terms = (np.ones_like(x), x, y, x*x, x*y, y*y)
+    return np.stack([np.bincount(group_idx, weights=t, minlength=n_groups) for t in terms], axis=-1)
+
+
+def solve_scaling_regressions(stats):
+    """
+    Solves the normal equations of y = const + slope*x for every set of sufficient statistics.
+
+    Args:
+        stats (np.ndarray): Array of sufficient statistics with shape (..., 6).
+
+    Returns:
+        np.ndarray: Array of [const, slope] with shape (..., 2). NaN where the regression is singular.
+    """
+    n, sum_x, sum_y, sum_xx, sum_xy = [stats[..., i] for i in range(5)]
+    det = n*sum_xx - sum_x**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(det > 0, (n*sum_xy - sum_x*sum_y) / det, np.nan)
+        const = (sum_y - slope*sum_x) / n
+    return np.stack([const, slope], axis=-1)
+
+
+def get_scaling_regression_statistics(reservoir, inflows, water_years,
+                                      dataset='nhmv10',
+                                      window=3):
+    """
+    Calculates the sufficient statistics of the inflow scaling regression for each
+    water year and quarter of a reservoir.
+
+    Args:
+        reservoir (str): Name of the reservoir.
+        inflows (pd.DataFrame): Inflow data from prep_inflow_scaling_data().
+        water_years (np.ndarray): Sorted water years used to label the groups.
+        dataset (str): Dataset used to estimate the scaling relationship.
+        window (int): Number of days to use for rolling mean inflow.
+
+    Returns:
+        np.ndarray: Array with shape (n_water_years, n_quarters, 6).
+    """
+    data = get_scaling_regression_data(reservoir, inflows.copy(),
+                                       dataset=dataset,
+                                       rolling=True,
+                                       window=window)
+
+    x = np.log(data[f'{reservoir}_{dataset}_gauges'].values.astype('float64'))
+    y = data[f'{reservoir}_{dataset}_scaling'].values.astype('float64')
+
+    wy = get_water_year(data.index)
+    keep = np.isin(wy, water_years)
+    group_idx = np.searchsorted(water_years, wy[keep])*len(quarters) + get_quarter_index(data.index)[keep]
+
+    stats = calculate_grouped_sufficient_statistics(x[keep], y[keep], group_idx,
+                                                    n_groups=len(water_years)*len(quarters))
+    return stats.reshape(len(water_years), len(quarters), -1)
+
+
+def draw_water_year_bootstrap_indices(n_water_years, n_replicates=1000, seed=None):
+    """
+    Draws block-bootstrap resamples of whole water years.
+
+    Args:
+        n_water_years (int): Number of water years in the training record.
+        n_replicates (int): Number of bootstrap replicates.
+        seed (int, optional): Seed for the random number generator.
+
+    Returns:
+        np.ndarray: Index matrix with shape (n_replicates, n_water_years).
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, n_water_years, size=(n_replicates, n_water_years))
+
+
+def get_bootstrap_counts(indices, n_water_years):
+    """
+    Converts a bootstrap index matrix into the number of times each water year is drawn.
+
+    Args:
+        indices (np.ndarray): Index matrix with shape (n_replicates, n_samples).
+        n_water_years (int): Number of water years in the training record.
+
+    Returns:
+        np.ndarray: Count matrix with shape (n_replicates, n_water_years).
+    """
+    n_replicates = indices.shape[0]
+    offsets = np.arange(n_replicates)[:, np.newaxis] * n_water_years
+    counts = np.bincount((indices + offsets).ravel(), minlength=n_replicates*n_water_years)
+    return counts.reshape(n_replicates, n_water_years)
+
+
+@instrumented('regression')
+def bootstrap_inflow_scaling_coefficients(inflows=None,
+                                          donor_model='nhmv10',
+                                          window=3,
+                                          n_replicates=1000,
+                                          seed=None,
+                                          reservoirs=scaled_reservoirs):
+    """
+    Fits the seasonal inflow scaling regressions for every block-bootstrap replicate.
+    The same water year resamples are used for all reservoirs, so the cross-reservoir
+    dependence of the coefficients is kept.
+
+    Args:
+        inflows (pd.DataFrame, optional): Inflow data from prep_inflow_scaling_data(). Loaded if not provided.
+        donor_model (str): Dataset to use for estimating the scaling relationship.
+        window (int): Number of days to use for rolling mean inflow.
+        n_replicates (int): Number of bootstrap replicates.
+        seed (int, optional): Seed for the random number generator.
+        reservoirs (list): Reservoirs to include.
+
+    Returns:
+        pd.DataFrame: Coefficients for each replicate (index), with columns (reservoir, quarter, ['const', 'slope']).
+    """
+    if inflows is None:
+        inflows = prep_inflow_scaling_data()
+
+    water_years = np.unique(get_water_year(inflows.dropna(how='all').index))
+    indices = draw_water_year_bootstrap_indices(len(water_years),
+                                                n_replicates=n_replicates,
+                                                seed=seed)
+    counts = get_bootstrap_counts(indices, len(water_years)).astype('float64')
+
+    params = []
+    for reservoir in reservoirs:
+        stats = get_scaling_regression_statistics(reservoir, inflows, water_years,
+                                                  dataset=donor_model,
+                                                  window=window)
+        # (replicate x water year) @ (water year x quarter x stat)
+        replicate_stats = np.tensordot(counts, stats, axes=(1, 0))
+        params.append(solve_scaling_regressions(replicate_stats).reshape(n_replicates, -1))
+
+    columns = pd.MultiIndex.from_product([reservoirs, quarters, ['const', 'slope']],
+                                         names=['reservoir', 'quarter', 'param'])
+    bootstrap_coefs = pd.DataFrame(np.hstack(params), columns=columns)
+    bootstrap_coefs.index.name = 'replicate'
+    return bootstrap_coefs
+
+
+def generate_bootstrap_scaled_inflows(bootstrap_coefs, start_date, end_date,
+                                      scaling_rolling_window=3,
+                                      Q_obs=None):
+    """
+    Generates an ensemble of scaled reservoir inflows, one member for each bootstrap replicate.
+    Follows the same approach as generate_scaled_inflows().
+
+    Args:
+        bootstrap_coefs (pd.DataFrame): Coefficients from bootstrap_inflow_scaling_coefficients().
+        start_date (str): Start date of the prediction period.
+        end_date (str): End date of the prediction period.
+        scaling_rolling_window (int): Number of days to use for rolling mean inflow.
+        Q_obs (pd.DataFrame, optional): Observed USGS flows in MGD. Loaded if not provided.
+
+    Returns:
+        dict: Scaled inflow ensemble (dates x replicates) for each reservoir.
+    """
+    if Q_obs is None:
+        Q_obs = load_usgs_obs_flows()
+    Q_obs = Q_obs.loc[start_date:end_date, :]
+    quarter_idx = get_quarter_index(Q_obs.index)
+    n_replicates = len(bootstrap_coefs)
+
+    ensemble = {}
+    with span('scale', n_replicates=n_replicates) as s:
+        s.set_shape(Q_obs)
+        for reservoir in bootstrap_coefs.columns.get_level_values('reservoir').unique():
+            inflow_gauges = scaling_site_matches[reservoir]['obs_gauges']
+            unscaled_inflows = Q_obs.loc[:, inflow_gauges].sum(axis=1, min_count=len(inflow_gauges))
+            rolling_log_inflows = np.log(unscaled_inflows.rolling(window=scaling_rolling_window,
+                                                                  min_periods=1).mean().values.astype('float64'))
+
+            params = bootstrap_coefs[reservoir].values.reshape(n_replicates, len(quarters), 2)
+            scaling = params[:, quarter_idx, 0] + params[:, quarter_idx, 1]*rolling_log_inflows
+            scaling[scaling < 1] = 1
+
+            ensemble[reservoir] = pd.DataFrame((scaling * unscaled_inflows.values).T,
+                                               index=Q_obs.index,
+                                               columns=bootstrap_coefs.index)
+    return ensemble
+
+
+def summarize_bootstrap_ensemble(ensemble, quantiles=(0.05, 0.5, 0.95)):
+    """
+    Calculates quantiles of a scaled inflow ensemble for each day.
+
+    Args:
+        ensemble (dict): Output from generate_bootstrap_scaled_inflows().
+        quantiles (tuple): Quantiles to calculate.
+
+    Returns:
+        pd.DataFrame: Quantiles with columns (reservoir, quantile).
+    """
+    summary = {}
+    for reservoir, flows in ensemble.items():
+        summary[reservoir] = pd.DataFrame(np.nanquantile(flows.values, quantiles, axis=1).T,
+                                          index=flows.index, columns=list(quantiles))
+    return pd.concat(summary, axis=1, names=['reservoir', 'quantile'])
+
+
+def main():
+    with span('inflow_scaling_bootstrap'):
+        inflow_data = prep_inflow_scaling_data()
+        for donor_model in ['nhmv10', 'nwmv21', 'wrf']:
+            bootstrap_coefs = bootstrap_inflow_scaling_coefficients(inflow_data,
+                                                                    donor_model=donor_model,
+                                                                    window=3,
+                                                                    n_replicates=1000,
+                                                                    seed=1)
+            ensemble = generate_bootstrap_scaled_inflows(bootstrap_coefs,
+                                                         start_date='1983-10-01', end_date='2021-12-31',
+                                                         scaling_rolling_window=3)
+
+            with span('export', donor_model=donor_model):
+                bootstrap_coefs.to_csv(f'{OUTPUT_DIR}/Hybrid/scaling_coefs_bootstrap_{donor_model}.csv', sep=',')
+                summarize_bootstrap_ensemble(ensemble).to_csv(f'{OUTPUT_DIR}/Hybrid/scaled_inflows_{donor_model}_bootstrap_quantiles.csv',
+                                                              sep=',')
+
+
+if __name__ == '__main__':
+    main()
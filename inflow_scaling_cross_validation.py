@@ -0,0 +1,175 @@
+"""
+Leave-one-water-year-out cross-validation of the inflow scaling regressions.
+
+Used to compare the rolling mean window and donor model options of inflow_scaling_regression.py
+using out-of-sample skill, rather than the in-sample R^2 shown in the regression figures.
+
+The regression for each fold is not refit. The sufficient statistics are grouped by
+(water year, quarter) once, and the statistics of each fold are found by subtracting
+the held-out water year from the totals. All folds are then solved at once.
+
+Skill is reported as NSE and KGE of the scaled reservoir inflow (scaling coefficient x gauge flow)
+relative to the modeled HRU total inflow of the donor model. Since each donor model has
+its own target, windows are compared within a donor model, not across donor models.
+"""
+
+import numpy as np
+import pandas as pd
+
+from inflow_scaling_regression import scaled_reservoirs, quarters
+from inflow_scaling_regression import OUTPUT_DIR
+from inflow_scaling_regression import prep_inflow_scaling_data, get_scaling_regression_data
+from inflow_scaling_bootstrap import get_water_year, get_quarter_index
+from inflow_scaling_bootstrap import calculate_grouped_sufficient_statistics, solve_scaling_regressions
+from instrumentation import span, instrumented
+
+donor_model_opts = ('nhmv10', 'nwmv21', 'wrf')
+rolling_window_opts = (1, 3, 5, 7)
+
+
+def calculate_grouped_skill(sim, obs, group_idx, n_groups):
+    """
+    Calculates NSE and KGE of simulated relative to observed values for each group.
+    Pairs with non-finite values are excluded.
+
+    Args:
+        sim (np.ndarray): Simulated values.
+        obs (np.ndarray): Observed values.
+        group_idx (np.ndarray): Integer group label of each value.
+        n_groups (int): Total number of groups.
+
+    Returns:
+        pd.DataFrame: Columns 'n', 'nse' and 'kge' for each group.
+    """
+    valid = np.isfinite(sim) & np.isfinite(obs)
+    sim, obs, group_idx = sim[valid], obs[valid], group_idx[valid]
+
+    def group_sum(values):
+        return np.bincount(group_idx, weights=values, minlength=n_groups)
+
+    n = group_sum(np.ones_like(obs))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_obs = group_sum(obs) / n
+        mean_sim = group_sum(sim) / n
+        var_obs = group_sum(obs**2) / n - mean_obs**2
+        var_sim = group_sum(sim**2) / n - mean_sim**2
+        cov = group_sum(sim*obs) / n - mean_obs*mean_sim
+
+        nse = 1 - group_sum((sim - obs)**2) / (n*var_obs)
+        r = cov / np.sqrt(var_obs*var_sim)
+        alpha = np.sqrt(var_sim / var_obs)
+        beta = mean_sim / mean_obs
+        kge = 1 - np.sqrt((r - 1)**2 + (alpha - 1)**2 + (beta - 1)**2)
+    return pd.DataFrame({'n': n.astype(int), 'nse': nse, 'kge': kge})
+
+
+def cross_validate_reservoir_scaling(reservoir, inflows,
+                                     dataset='nhmv10',
+                                     window=3):
+    """
+    Calculates leave-one-water-year-out skill of the seasonal scaling regressions for a reservoir.
+
+    Args:
+        reservoir (str): Name of the reservoir.
+        inflows (pd.DataFrame): Inflow data from prep_inflow_scaling_data().
+        dataset (str): Dataset used to estimate the scaling relationship.
+        window (int): Number of days to use for rolling mean inflow.
+
+    Returns:
+        pd.DataFrame: Columns 'n', 'nse' and 'kge' for each quarter, and 'all' quarters combined.
+    """
+    data = get_scaling_regression_data(reservoir, inflows.copy(),
+                                       dataset=dataset,
+                                       rolling=True,
+                                       window=window)
+
+    x = np.log(data[f'{reservoir}_{dataset}_gauges'].values.astype('float64'))
+    y = data[f'{reservoir}_{dataset}_scaling'].values.astype('float64')
+
+    water_years, wy_idx = np.unique(get_water_year(data.index), return_inverse=True)
+    quarter_idx = get_quarter_index(data.index)
+    n_quarters = len(quarters)
+    group_idx = wy_idx*n_quarters + quarter_idx
+
+    # Fold statistics: totals minus the held-out water year
+    stats = calculate_grouped_sufficient_statistics(x, y, group_idx,
+                                                    n_groups=len(water_years)*n_quarters)
+    stats = stats.reshape(len(water_years), n_quarters, -1)
+    fold_params = solve_scaling_regressions(stats.sum(axis=0) - stats)
+
+    # Out-of-sample prediction for each day, using the fold which held out its water year
+    scaling = fold_params[wy_idx, quarter_idx, 0] + fold_params[wy_idx, quarter_idx, 1]*x
+    scaling[scaling < 1] = 1
+
+    # Scaled daily inflows vs modeled HRU totals
+    daily_flows = inflows.loc[data.index, :]
+    sim = scaling * daily_flows[f'{reservoir}_{dataset}_gauges'].values.astype('float64')
+    obs = daily_flows[f'{reservoir}_{dataset}_hru'].values.astype('float64')
+
+    skill = pd.concat([calculate_grouped_skill(sim, obs, quarter_idx, n_quarters),
+                       calculate_grouped_skill(sim, obs, np.zeros_like(quarter_idx), 1)])
+    skill.index = pd.Index(list(quarters) + ['all'], name='quarter')
+    return skill
+
+
+@instrumented('regression')
+def cross_validate_inflow_scaling(inflows=None,
+                                  donor_models=donor_model_opts,
+                                  windows=rolling_window_opts,
+                                  reservoirs=scaled_reservoirs):
+    """
+    Runs leave-one-water-year-out cross-validation for every combination of
+    reservoir, donor model, and rolling mean window.
+
+    Args:
+        inflows (pd.DataFrame, optional): Inflow data from prep_inflow_scaling_data(). Loaded if not provided.
+        donor_models (tuple): Datasets to use for estimating the scaling relationship.
+        windows (tuple): Rolling mean windows (days) to test.
+        reservoirs (list): Reservoirs to include.
+
+    Returns:
+        pd.DataFrame: Columns 'n', 'nse' and 'kge', indexed by (reservoir, donor_model, window, quarter).
+    """
+    if inflows is None:
+        inflows = prep_inflow_scaling_data()
+
+    results = {}
+    for reservoir in reservoirs:
+        for donor_model in donor_models:
+            for window in windows:
+                results[(reservoir, donor_model, window)] = cross_validate_reservoir_scaling(reservoir, inflows,
+                                                                                             dataset=donor_model,
+                                                                                             window=window)
+    return pd.concat(results, names=['reservoir', 'donor_model', 'window'])
+
+
+def select_best_scaling_configuration(cv_results, metric='kge'):
+    """
+    Selects the rolling mean window with the best out-of-sample skill across all quarters,
+    for each reservoir and donor model.
+
+    Each donor model is scored against its own HRU total inflow, so skill is only
+    comparable between windows of the same donor model, not between donor models.
+
+    Args:
+        cv_results (pd.DataFrame): Output from cross_validate_inflow_scaling().
+        metric (str): Either 'nse' or 'kge'.
+
+    Returns:
+        pd.DataFrame: Best window and skill for each reservoir and donor model.
+    """
+    all_quarters = cv_results.xs('all', level='quarter')
+    best = all_quarters[metric].groupby(level=['reservoir', 'donor_model']).idxmax()
+    return all_quarters.loc[best.values].reset_index(level='window')
+
+
+def main():
+    with span('inflow_scaling_cross_validation'):
+        cv_results = cross_validate_inflow_scaling()
+        with span('export'):
+            cv_results.to_csv(f'{OUTPUT_DIR}/Hybrid/inflow_scaling_cross_validation.csv', sep=',')
+        print(select_best_scaling_configuration(cv_results, metric='kge'))
+
+
+if __name__ == '__main__':
+    main()
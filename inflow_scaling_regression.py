@@ -1,55 +1,19 @@
 import sys
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-import statsmodels.api as sm
-import matplotlib.pyplot as plt
+
+from pywr_drb_node_data import scaling_site_matches
+from dataset_io import read_flow_dataset, write_flow_dataset
+from instrumentation import span, instrumented
 
 cms_to_mgd = 22.82
 
 fig_dir = f'./figures/usgs_inflow_scaling/' 
 OUTPUT_DIR = f'./datasets/'
 
-### Dict of different gauge/HRU IDs for different datasets
-# Notes:
-# 1. For scaling, we must have model flows at (i) obs gauges and (ii) total catchment/HRU
-# 2. NWM gauge IDs use USGS site numbers, since the NWM data we have is labeled with USGS site numbers
-# 3. NWM HRU IDs are the reachcodes
-# 4. WRF has the same reachcodes as NWM, but we need to use reachcodes for the wrf_gauges
-scaling_site_matches = {'cannonsville':{'nhmv10_gauges': ['1556'],   # '1559' matches '0142400103' but is not used (see lower comment)
-                                'nhmv10_hru': ['1562'],
-                                'nwmv21_gauges': ['01423000'],  # '0142400103' should be incuded but does not begin till 1996
-                                'nwmv21_hru': ['2613174'],
-                                'wrf_gauges': ['2613578'],
-                                'wrf_hru': ['2613174'],
-                                'obs_gauges': ['01423000']},     # '0142400103' should be incuded but does not begin till 1996
-                        'neversink': {'nhmv10_gauges': ['1645'],
-                                      'nhmv10_hru': ['1638'],
-                                      'nwmv21_gauges': ['01435000'],
-                                      'nwmv21_hru': ['4146742'],
-                                      'wrf_gauges': ['4147956'],
-                                      'wrf_hru': ['4146742'],
-                                      'obs_gauges': ['01435000']},
-                        'pepacton': {'nhmv10_gauges': ['1440', '1441', '1437'],  # '1443' matches '01414000' but is not used (see lower comment)
-                                        'nhmv10_hru': ['1449'],
-                                        'nwmv21_gauges': ['01415000', '01414500', '01413500'], # '01414000' should be incuded but does not begin till 1996
-                                        'nwmv21_hru': ['1748473'],
-                                        'wrf_gauges': ['1748589', '1748611', '1748583'],
-                                        'wrf_hru': ['1748473'],
-                                        'obs_gauges': ['01415000', '01414500', '01413500']},  # '01414000' should be incuded but does not begin till 1996
-                        'fewalter': {'nhmv10_gauges': ['1684', '1691'],
-                                        'nhmv10_hru': ['1684', '1691', '1694'],
-                                        'nwmv21_gauges': ['01447720', '01447500'],
-                                        'nwmv21_hru': ['4185065'],
-                                        'wrf_gauges': ['4185779', '4185679'],
-                                        'wrf_hru': ['4185065'],
-                                        'obs_gauges': ['01447720', '01447500']},
-                        'beltzvilleCombined': {'nhmv10_gauges': ['1703'],
-                                        'nhmv10_hru': ['1710'],
-                                        'nwmv21_gauges': ['01449360'],
-                                        'nwmv21_hru': ['4186689'],
-                                        'wrf_gauges': ['4187925'],
-                                        'wrf_hru': ['4186689'],
-                                        'obs_gauges': ['01449360']}}
+# Use the gap filled gauge flows (see gap_filling.py) where they exist
+USE_FILLED_OBS_FLOWS = True
 
 # List of all reservoirs able to be scaled
 scaled_reservoirs = list(scaling_site_matches.keys())
@@ -58,7 +22,40 @@ scaled_reservoirs = list(scaling_site_matches.keys())
 quarters = ('DJF','MAM','JJA','SON')
 
 
+def load_usgs_obs_flows(use_filled=USE_FILLED_OBS_FLOWS):
+    """
+    Loads historic USGS gauge flows, labeled by site number.
+
+    Args:
+        use_filled (bool): If True, replace the gauges in the gap filled dataset with their filled flows.
+
+    Returns:
+        pd.DataFrame: Daily observed flows in MGD.
+
+    Raises:
+        FileNotFoundError: If use_filled, and the gap filled dataset has not been made (see gap_filling.py).
+    """
+    obs_filename = f'{OUTPUT_DIR}USGS/streamflow_daily_usgs_1950_2022_cms'
+    Q_obs = read_flow_dataset(obs_filename, dtype='float64')*cms_to_mgd
+    if '-' in Q_obs.columns[0]:
+        usgs_gauge_ids = [c.split('-')[1] for c in Q_obs.columns]
+        Q_obs.columns = usgs_gauge_ids
+    Q_obs.index = pd.to_datetime(Q_obs.index.date)
+
+    if use_filled:
+        try:
+            Q_filled = read_flow_dataset(f'{obs_filename}_filled', dtype='float64')*cms_to_mgd
+        except FileNotFoundError:
+            raise FileNotFoundError('No gap filled USGS flows found. Run gap_filling.py, '
+                                    'or set USE_FILLED_OBS_FLOWS = False to use the observed flows with gaps.')
+        Q_filled.index = pd.to_datetime(Q_filled.index.date)
+        filled_gauges = Q_filled.columns.intersection(Q_obs.columns)
+        Q_obs.loc[:, filled_gauges] = Q_filled.reindex(Q_obs.index)[filled_gauges]
+    return Q_obs
+
+
 # Function for compiling flow data for regression
+@instrumented('load')
 def prep_inflow_scaling_data():
     """
     Prepares the data for the inflow scaling regression:
@@ -70,16 +67,9 @@ def prep_inflow_scaling_data():
         pd.DataFrame: Dataframe with inflows for each reservoir and dataset.
     """
 
-    # Load observed, NHM, and NWM flow
+    # Load observed, NHM, and NWM flow; the regressions use float64 regardless of the storage precision
     ## USGS
-    obs_flows = pd.read_csv(f'{OUTPUT_DIR}/USGS/streamflow_daily_usgs_1950_2022_cms.csv', 
-                            index_col=0, parse_dates=True)*cms_to_mgd
-    if '-' in obs_flows.columns[0]:
-        usgs_gauge_ids = [c.split('-')[1] for c in obs_flows.columns]
-    else: 
-        usgs_gauge_ids = obs_flows.columns
-    obs_flows.columns = usgs_gauge_ids
-    obs_flows.index = pd.to_datetime(obs_flows.index.date)
+    obs_flows = load_usgs_obs_flows()
 
     # Metadata: USGS site number, longitude, latitude, comid, etc.
     unmanaged_gauge_meta = pd.read_csv(f'{OUTPUT_DIR}/USGS/drb_unmanaged_usgs_metadata.csv', sep = ',', 
@@ -88,15 +78,13 @@ def prep_inflow_scaling_data():
 
     ## NHM
     # Streamflow
-    nhmv10_flows = pd.read_csv(f'{OUTPUT_DIR}/NHMv10/csv/streamflow_daily_nhmv10_mgd.csv', 
-                            index_col=0, parse_dates=True)
+    nhmv10_flows = read_flow_dataset(f'{OUTPUT_DIR}/NHMv10/csv/streamflow_daily_nhmv10_mgd', dtype='float64')
     nhmv10_flows = nhmv10_flows.loc['1983-10-01':, :]
 
 
     ## NWMv2.1
     # modeled gauge flows
-    nwm_gauge_flows = pd.read_csv(f'{OUTPUT_DIR}/NWMv21/nwmv21_unmanaged_gauge_streamflow_daily_mgd.csv', 
-                                        sep = ',', index_col=0, parse_dates=True)
+    nwm_gauge_flows = read_flow_dataset(f'{OUTPUT_DIR}/NWMv21/nwmv21_unmanaged_gauge_streamflow_daily_mgd', dtype='float64')
     nwm_gauge_flows= nwm_gauge_flows.loc['1983-10-01':, :]
 
 
@@ -112,30 +100,28 @@ def prep_inflow_scaling_data():
                                    inplace=True)
 
     # modeled lake inflows and segment flows
-    nwm_lake_inflows = pd.read_csv(f'{OUTPUT_DIR}/NWMv21/streamflow_daily_nwmv21_mgd.csv', 
-                                        index_col=0, parse_dates=True)
+    nwm_lake_inflows = read_flow_dataset(f'{OUTPUT_DIR}/NWMv21/streamflow_daily_nwmv21_mgd', dtype='float64')
     nwm_lake_inflows = nwm_lake_inflows.loc['1983-10-01':, :]
     
     # Combine NWM data
     nwmv21_flows = pd.concat([nwm_gauge_flows, nwm_lake_inflows], axis=1)
 
     ## WRF-Hydro
-    wrf_flows = pd.read_csv(f'{OUTPUT_DIR}/WRF-Hydro/streamflow_daily_wrfaorc_calib_nlcd2016.csv',
-                            index_col=0, parse_dates=True)
+    wrf_flows = read_flow_dataset(f'{OUTPUT_DIR}/WRF-Hydro/streamflow_daily_wrfaorc_calib_nlcd2016', dtype='float64')
     
 
-    # Compile data for each reservoir in df
+    # Compile data for each reservoir in df; days with any gauge missing are NaN, rather than a low sum
     data = pd.DataFrame()
     for node, flowtype_ids in scaling_site_matches.items():
         for flowtype, ids in flowtype_ids.items():
             if 'nhm' in flowtype:            
-                data[f'{node}_{flowtype}'] = nhmv10_flows[ids].sum(axis=1)
+                data[f'{node}_{flowtype}'] = nhmv10_flows[ids].sum(axis=1, min_count=len(ids))
             elif 'obs' in flowtype:
-                data[f'{node}_{flowtype}'] = obs_flows[ids].sum(axis=1)
+                data[f'{node}_{flowtype}'] = obs_flows[ids].sum(axis=1, min_count=len(ids))
             elif 'nwm' in flowtype:
-                data[f'{node}_{flowtype}'] = nwmv21_flows[ids].sum(axis=1)
+                data[f'{node}_{flowtype}'] = nwmv21_flows[ids].sum(axis=1, min_count=len(ids))
             elif 'wrf' in flowtype:
-                data[f'{node}_{flowtype}'] = wrf_flows[ids].sum(axis=1)
+                data[f'{node}_{flowtype}'] = wrf_flows[ids].sum(axis=1, min_count=len(ids))
                 
     return data
 
@@ -159,20 +145,22 @@ def get_quarter(m):
     elif m in (9,10,11):
         return 'SON'
 
-def train_inflow_scale_regression_models(reservoir, inflows, 
-                                         dataset='nhmv10',
-                                         rolling = True, 
-                                         window =3):
+def get_scaling_regression_data(reservoir, inflows, 
+                                dataset='nhmv10',
+                                rolling = True, 
+                                window = 3):
     """
-    Trains multiple linear regression models used to predict inflow scaling coefficients.
-    A unique model for each season for the specified reservoir.
+    Prepares the (rolling mean) flows used to train the inflow scaling regressions.
 
     Args:
         reservoir (str): Name of the reservoir.
         inflows (pd.DataFrame): pd.DataFrame with inflows for the reservoir and dataset.
+        dataset (str): Dataset used to estimate the scaling relationship.
+        rolling (bool): Whether to use rolling mean flows.
+        window (int): Number of days to use for rolling mean inflow.
 
     Returns:
-        (dict, dict): Tuple with OLS model, and fit model
+        pd.DataFrame: Inflows with added 'month', 'quarter' and '{reservoir}_{dataset}_scaling' columns.
     """
     dataset_opts = ['nhmv10', 'nwmv21', 'wrf']
     assert(dataset in dataset_opts), f'Specified dataset invalid. Options: {dataset_opts}'
@@ -181,11 +169,36 @@ def train_inflow_scale_regression_models(reservoir, inflows,
     if rolling:
         inflows = inflows.rolling(f'{window}D').mean()
         inflows = inflows[window:-window]
-        inflows = inflows.dropna()
+        # Obs gauges are not used in training, and may be missing (NaN) for some years
+        inflows = inflows.dropna(subset=[c for c in inflows.columns if '_obs_' not in c])
     
     inflows.loc[:,['month']] = inflows.index.month.values
     inflows.loc[:, ['quarter']] = [get_quarter(m) for m in inflows['month']]
     inflows.loc[:, [f'{reservoir}_{dataset}_scaling']] = inflows[f'{reservoir}_{dataset}_hru'] / inflows[f'{reservoir}_{dataset}_gauges']
+    return inflows
+
+
+def train_inflow_scale_regression_models(reservoir, inflows, 
+                                         dataset='nhmv10',
+                                         rolling = True, 
+                                         window =3):
+    """
+    Trains multiple linear regression models used to predict inflow scaling coefficients.
+    A unique model for each season for the specified reservoir.
+
+    Args:
+        reservoir (str): Name of the reservoir.
+        inflows (pd.DataFrame): pd.DataFrame with inflows for the reservoir and dataset.
+
+    Returns:
+        (dict, dict): Tuple with OLS model, and fit model
+    """
+    import statsmodels.api as sm
+
+    inflows = get_scaling_regression_data(reservoir, inflows, 
+                                          dataset=dataset, 
+                                          rolling=rolling, 
+                                          window=window)
     
     lrms = {q: sm.OLS(inflows[f'{reservoir}_{dataset}_scaling'].loc[inflows['quarter'] == q].values.flatten(),
                     sm.add_constant(np.log(inflows[f'{reservoir}_{dataset}_gauges'].loc[inflows['quarter'] == q].values.flatten()))) for q in quarters}
@@ -202,6 +215,7 @@ def predict_inflow_scaling(lrr, log_flow):
         lrr (statsmodels.regression.linear_model.RegressionResultsWrapper): Regression model.
         log_flow (pd.Series): Log of the inflow.
     """
+    import statsmodels.api as sm
 
     X = sm.add_constant(log_flow)
     scaling = lrr.predict(X)
@@ -213,10 +227,37 @@ def predict_inflow_scaling(lrr, log_flow):
 
 
 
+@instrumented('regression')
+def train_all_inflow_scale_regression_models(inflows,
+                                             dataset='nhmv10',
+                                             window=3):
+    """
+    Trains the seasonal inflow scaling regression models for all scaled reservoirs.
+
+    Args:
+        inflows (pd.DataFrame): pd.DataFrame with inflows from prep_inflow_scaling_data().
+        dataset (str): Dataset to use for estimating the scaling relationship.
+        window (int): Number of days to use for rolling mean inflow.
+
+    Returns:
+        (dict, dict): Tuple with OLS models, and fit models, for each reservoir.
+    """
+    linear_models = {}
+    linear_results = {}
+    for reservoir in scaled_reservoirs:
+        linear_models[reservoir], linear_results[reservoir] = train_inflow_scale_regression_models(reservoir,
+                                                                                                inflows.copy(),
+                                                                                                dataset=dataset,
+                                                                                                rolling=True,
+                                                                                                window=window)
+    return linear_models, linear_results
+
+
 def generate_scaled_inflows(start_date, end_date, 
                             scaling_rolling_window=3, 
                             donor_model='nhmv10', 
-                            export=True):
+                            export=True,
+                            linear_results=None):
     """
     Goes through the process of generating scaled inflows for all reservoirs using a specific
     dataset (donor_model) to estimate the scaling relationship.
@@ -226,116 +267,158 @@ def generate_scaled_inflows(start_date, end_date,
         end_date (str): End date of the prediction period.
         scaling_rolling_window (int): Number of days to use for rolling mean inflow.
         donor_model (str): Dataset to use for estimating the scaling relationship.
-        export (bool): Whether to export the scaled inflows to a csv file.
+        export (bool): Whether to export the scaled inflows (see dataset_io.write_flow_dataset).
+        linear_results (dict, optional): Fit models for each reservoir and quarter. Trained if not provided.
     Returns:
         pd.DataFrame: Scaled inflows for all reservoirs.
     """
 
     # Load historic USGS obs
-    Q_obs = pd.read_csv(f'{OUTPUT_DIR}USGS/streamflow_daily_usgs_1950_2022_cms.csv',
-                                    index_col=0, parse_dates=True)*cms_to_mgd
-    if '-' in Q_obs.columns[0]:
-        usgs_gauge_ids = [c.split('-')[1] for c in Q_obs.columns]
-        Q_obs.columns = usgs_gauge_ids
-    Q_obs.index = pd.to_datetime(Q_obs.index.date)
+    Q_obs = load_usgs_obs_flows()
     Q_obs = Q_obs.loc[start_date:end_date, :]
     Q_obs_scaled = Q_obs.copy()
     
     # Train models
-    
-    linear_models = {}
-    linear_results = {}
-    for reservoir in scaled_reservoirs:
+    if linear_results is None:
         scaling_training_flows = prep_inflow_scaling_data()
-        linear_models[reservoir], linear_results[reservoir] = train_inflow_scale_regression_models(reservoir,
-                                                                                                scaling_training_flows,
-                                                                                                dataset=donor_model,
-                                                                                                rolling=True,
-                                                                                                window=scaling_rolling_window)
+        _, linear_results = train_all_inflow_scale_regression_models(scaling_training_flows,
+                                                                     dataset=donor_model,
+                                                                     window=scaling_rolling_window)
             
-    for reservoir in scaled_reservoirs:
-        inflow_gauges = scaling_site_matches[reservoir][f'obs_gauges']
-        unscaled_inflows = Q_obs.loc[:, inflow_gauges].sum(axis=1)
+    with span('scale', donor_model=donor_model) as s:
+        for reservoir in scaled_reservoirs:
+            inflow_gauges = scaling_site_matches[reservoir][f'obs_gauges']
+            unscaled_inflows = Q_obs.loc[:, inflow_gauges].sum(axis=1, min_count=len(inflow_gauges))
         
-        # Use linear regression to find inflow scaling coefficient
-        # Different models are used for each quarter; done by month batches
-        for m in range(1,13):
-            quarter = get_quarter(m)
-            rolling_unscaled_inflows = unscaled_inflows.rolling(window=scaling_rolling_window,
-                                                                min_periods=1).mean()
-            rolling_unscaled_month_inflows = rolling_unscaled_inflows.loc[unscaled_inflows.index.month == m]
-            rolling_unscaled_month_log_inflows = np.log(rolling_unscaled_month_inflows.astype('float64'))
+            # Use linear regression to find inflow scaling coefficient
+            # Different models are used for each quarter; done by month batches
+            for m in range(1,13):
+                quarter = get_quarter(m)
+                rolling_unscaled_inflows = unscaled_inflows.rolling(window=scaling_rolling_window,
+                                                                    min_periods=1).mean()
+                rolling_unscaled_month_inflows = rolling_unscaled_inflows.loc[unscaled_inflows.index.month == m]
+                rolling_unscaled_month_log_inflows = np.log(rolling_unscaled_month_inflows.astype('float64'))
             
-            month_scaling_coefs = predict_inflow_scaling(linear_results[reservoir][quarter], 
-                                                        log_flow= rolling_unscaled_month_log_inflows)
+                month_scaling_coefs = predict_inflow_scaling(linear_results[reservoir][quarter], 
+                                                            log_flow= rolling_unscaled_month_log_inflows)
                             
-            ## Apply scaling across gauges for full month batch 
-            # Match column names to map to df
-            for site in inflow_gauges:
-                month_scaling_coefs[site] = month_scaling_coefs.loc[:,'scale']
-                # Multiply
-                Q_obs_scaled.loc[Q_obs.index.month==m, site] = Q_obs.loc[Q_obs.index.month==m, site] * month_scaling_coefs[site]
+                ## Apply scaling across gauges for full month batch 
+                # Match column names to map to df
+                for site in inflow_gauges:
+                    month_scaling_coefs[site] = month_scaling_coefs.loc[:,'scale']
+                    # Multiply
+                    Q_obs_scaled.loc[Q_obs.index.month==m, site] = Q_obs.loc[Q_obs.index.month==m, site] * month_scaling_coefs[site]
     
-        Q_obs_scaled.loc[:, reservoir] = Q_obs_scaled.loc[:, inflow_gauges].sum(axis=1)
+            Q_obs_scaled.loc[:, reservoir] = Q_obs_scaled.loc[:, inflow_gauges].sum(axis=1, min_count=len(inflow_gauges))
+        s.set_shape(Q_obs_scaled)
 
     Q_obs_scaled = Q_obs_scaled.loc[start_date:end_date, scaled_reservoirs]    
     # Export
     if export:
-        Q_obs_scaled.to_csv(f'{OUTPUT_DIR}/Hybrid/scaled_inflows_{donor_model}.csv', sep=',')
+        write_flow_dataset(Q_obs_scaled, f'{OUTPUT_DIR}/Hybrid/scaled_inflows_{donor_model}',
+                           units='mgd', source=f'usgs scaled with {donor_model}', site_matches=scaling_site_matches)
         return Q_obs_scaled
     else:
         return Q_obs_scaled 
 
 
 
+def summarize_inflow_scaling_regression(linear_results, n_bins=60):
+    """
+    Reduces the fit regression models to the binned point density and fit statistics
+    needed to plot them. The summary is small, so it is cheap to send to plotting workers.
+
+    Args:
+        linear_results (dict): Fit models for each reservoir and quarter.
+        n_bins (int): Number of bins along each axis of the 2-D histogram.
+
+    Returns:
+        dict: Plotting summary for each reservoir and quarter.
+    """
+    summary = {}
+    for reservoir, lrrs in linear_results.items():
+        summary[reservoir] = {}
+        for quarter in quarters:
+            lrr = lrrs[quarter]
+
+            # Extracting log_flow and scaling_coeff from the OLS result object
+            log_flow = lrr.model.exog[:, 1]  # Exclude constant term
+            scaling_coeff = lrr.model.endog
+            counts, x_edges, y_edges = np.histogram2d(log_flow, scaling_coeff, bins=n_bins)
+
+            line_x = np.array([log_flow.min(), log_flow.max()])
+            summary[reservoir][quarter] = {'counts': counts,
+                                           'x_edges': x_edges,
+                                           'y_edges': y_edges,
+                                           'line_x': line_x,
+                                           'line_y': lrr.params[0] + lrr.params[1]*line_x,
+                                           'params': np.asarray(lrr.params),
+                                           'rsquared': lrr.rsquared,
+                                           'pvalue': lrr.pvalues[1]}
+    return summary
+
+
 def plot_inflow_scaling_regression(donor_model = 'nhmv10', 
-                                   roll_window = 3):
+                                   roll_window = 3,
+                                   linear_results = None,
+                                   regression_summary = None,
+                                   dpi = 300):
     """
     Creates a plot with all inflow scaling regressions for a specific dataset.
+    Daily points are shown as binned density rather than individual markers.
     
     Args:
         donor_model (str): Dataset to use for estimating the scaling relationship.
         roll_window (int): Number of days to use for rolling mean inflow.
+        linear_results (dict, optional): Fit models for each reservoir and quarter. Trained if neither
+            this nor regression_summary is provided.
+        regression_summary (dict, optional): Output from summarize_inflow_scaling_regression().
+        dpi (int): Resolution of the saved figure.
     Returns:
         None
     """
-    
-    # Prepare the inflow scaling data
-    inflow_data = prep_inflow_scaling_data()
-    scatter_colors= {'DJF':'cornflowerblue', 'MAM':'darkgreen', 'JJA':'maroon', 'SON':'gold'}
-    n_rows = len(scaled_reservoirs)
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+
+    if regression_summary is None:
+        if linear_results is None:
+            inflow_data = prep_inflow_scaling_data()
+            _, linear_results = train_all_inflow_scale_regression_models(inflow_data,
+                                                                         dataset=donor_model,
+                                                                         window=roll_window)
+        regression_summary = summarize_inflow_scaling_regression(linear_results)
+
+    density_colors = {'DJF':'cornflowerblue', 'MAM':'darkgreen', 'JJA':'maroon', 'SON':'gold'}
+    reservoirs = list(regression_summary.keys())
+    n_rows = len(reservoirs)
     n_cols = len(quarters)
     
     # Initialize the plot
-    fig, axes = plt.subplots(n_rows, n_cols, figsize=(n_cols*2.5, n_rows*2.5))
+    fig, axes = plt.subplots(n_rows, n_cols, figsize=(n_cols*2.5, n_rows*2.5), squeeze=False)
     
-    # Loop through each reservoir and train regression models
-    for i, reservoir in enumerate(scaled_reservoirs):
-        lrms, lrrs = train_inflow_scale_regression_models(reservoir, inflow_data,
-                                                          dataset=donor_model,
-                                                          window=roll_window)
+    for i, reservoir in enumerate(reservoirs):
         
         # Plotting for each quarter
         for j, quarter in enumerate(quarters):
             ax = axes[i, j]
-            lrr = lrrs[quarter]
-            
-            # Extracting log_flow and scaling_coeff from the OLS result object
-            log_flow = lrr.model.exog[:, 1]  # Exclude constant term
-            scaling_coeff = lrr.model.endog
+            q_summary = regression_summary[reservoir][quarter]
             
-            ax.scatter(log_flow, scaling_coeff, c = scatter_colors[quarter], 
-                       alpha = 0.1, s=10)
-            ax.plot(log_flow, lrr.predict(), c='k', 
+            cmap = mpl.colors.LinearSegmentedColormap.from_list(quarter, ['white', density_colors[quarter]])
+            counts = np.ma.masked_equal(q_summary['counts'].T, 0)
+            ax.imshow(counts, origin='lower', aspect='auto', interpolation='nearest',
+                      extent=(q_summary['x_edges'][0], q_summary['x_edges'][-1],
+                              q_summary['y_edges'][0], q_summary['y_edges'][-1]),
+                      cmap=cmap, norm=mpl.colors.LogNorm())
+            ax.plot(q_summary['line_x'], q_summary['line_y'], c='k', 
                     linestyle='-', lw=1, zorder=4)
             
             # Annotate R-squared value
             # Get p value of regression model
-            ax.annotate(f"R^2 = {lrr.rsquared:.2f}\np-val = {lrr.pvalues[1]:.4f}", 
+            ax.annotate(f"R^2 = {q_summary['rsquared']:.2f}\np-val = {q_summary['pvalue']:.4f}", 
                         xy=(0.1, 0.7), xycoords='axes fraction', fontsize=12)
         
             # Annotate regression equation
-            ax.annotate(f"y = {lrr.params[1]:.2f}x + {lrr.params[0]:.2f}", 
+            ax.annotate(f"y = {q_summary['params'][1]:.2f}x + {q_summary['params'][0]:.2f}", 
                         xy=(0.1, 0.9), xycoords='axes fraction', fontsize=12)
         
             # Setting labels and title for the subplot
@@ -345,38 +428,72 @@ def plot_inflow_scaling_regression(donor_model = 'nhmv10',
                 ax.set_ylabel(f"{reservoir.capitalize()}\nScaling Coefficient")
             if i == n_rows - 1:
                 ax.set_xlabel("Log Flow (MGD)")
-        i += 1
     
     plt.suptitle((f'Inflow Scaling Coefficient Regressions\n'+
                   f'{donor_model.upper()} used to estimate scaling coefficient dependent on {roll_window} day rolling mean log-flow'),
                  fontsize=14)
     plt.tight_layout()
-    plt.savefig(f'{fig_dir}inflow_scaling_regression_{donor_model}_rolling{roll_window}.png', dpi=300)
+    plt.savefig(f'{fig_dir}inflow_scaling_regression_{donor_model}_rolling{roll_window}.png', dpi=dpi)
     plt.close()
     return
 
-if __name__ == '__main__':
 
-    for rolling_mean_window in [1, 3, 5, 7]:
-        # ### Scale based on NHMv10    
-        # export_scaled_inflows = True if rolling_mean_window == 3 else False
-        # generate_scaled_inflows(start_date='1983-10-01', end_date='2020-12-31', 
-        #                         scaling_rolling_window=rolling_mean_window, 
-        #                         donor_model='nhmv10',
-        #                         export=export_scaled_inflows)
-        # plot_inflow_scaling_regression(donor_model = 'nhmv10', roll_window = rolling_mean_window)
-
-        # ### Scale based on NWMv2.1
-        # generate_scaled_inflows(start_date='1983-10-01', end_date='2020-12-31', 
-        #                         scaling_rolling_window=rolling_mean_window, 
-        #                         donor_model='nwmv21',
-        #                         export=export_scaled_inflows)
-        # plot_inflow_scaling_regression(donor_model = 'nwmv21', roll_window = rolling_mean_window)
+def _plot_inflow_scaling_regression_worker(args):
+    """Renders one regression figure in a worker process using a non-interactive backend."""
+    import matplotlib.pyplot as plt
+
+    plt.switch_backend('Agg')
+    donor_model, roll_window, regression_summary, dpi = args
+    plot_inflow_scaling_regression(donor_model=donor_model, 
+                                   roll_window=roll_window,
+                                   regression_summary=regression_summary,
+                                   dpi=dpi)
+    return donor_model, roll_window
+
+
+def plot_all_inflow_scaling_regressions(regression_summaries, 
+                                        n_workers=None,
+                                        dpi=300):
+    """
+    Renders the inflow scaling regression figures in parallel worker processes.
+
+    Args:
+        regression_summaries (dict): Output from summarize_inflow_scaling_regression() for each (donor_model, roll_window).
+        n_workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        dpi (int): Resolution of the saved figures.
+    Returns:
+        None
+    """
+    args = [(donor_model, roll_window, summary, dpi) for (donor_model, roll_window), summary in regression_summaries.items()]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for donor_model, roll_window in executor.map(_plot_inflow_scaling_regression_worker, args):
+            print(f'Saved inflow scaling regression figure for {donor_model} with {roll_window} day rolling window.')
+    return
+
+
+def main():
+    with span('inflow_scaling'):
+        inflow_data = prep_inflow_scaling_data()
+        regression_summaries = {}
+        for rolling_mean_window in [1, 3, 5, 7]:
+            export_scaled_inflows = True if rolling_mean_window == 3 else False
         
-        ### Scale based on WRF-Hydro 
-        export_scaled_inflows = True if rolling_mean_window == 3 else False
-        generate_scaled_inflows(start_date='1983-10-01', end_date='2021-12-31', 
-                                scaling_rolling_window=rolling_mean_window, 
-                                donor_model='wrf',
-                                export=export_scaled_inflows)
-        plot_inflow_scaling_regression(donor_model = 'wrf', roll_window = rolling_mean_window)
\ No newline at end of file
+            for donor_model in ['nhmv10', 'nwmv21', 'wrf']:
+                _, linear_results = train_all_inflow_scale_regression_models(inflow_data,
+                                                                             dataset=donor_model,
+                                                                             window=rolling_mean_window)
+            
+                ### Scaled inflows are currently only generated based on WRF-Hydro
+                if donor_model == 'wrf':
+                    generate_scaled_inflows(start_date='1983-10-01', end_date='2021-12-31', 
+                                            scaling_rolling_window=rolling_mean_window, 
+                                            donor_model=donor_model,
+                                            export=export_scaled_inflows,
+                                            linear_results=linear_results)
+                regression_summaries[(donor_model, rolling_mean_window)] = summarize_inflow_scaling_regression(linear_results)
+    
+    plot_all_inflow_scaling_regressions(regression_summaries)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Lightweight timing and I/O instrumentation for the data retrieval and processing scripts.
+
+Stages (load, clip, select, aggregate, export) are wrapped in spans, e.g.:
+
+    with span('nhmv10'):
+        with span('load', filename=nc_filename) as s:
+            df = ...
+            s.set_shape(df)
+
+Each span records wall time, CPU time, the change in peak RSS, bytes read and written
+(/proc/self/io, Linux) and, if set, row/column counts and the max abs difference from float64.
+Spans are written as JSON lines, and nested spans are named by their parents (e.g., 'nhmv10/load').
+
+Instrumentation is enabled with the PYWRDRB_INSTRUMENT environment variable:
+- PYWRDRB_INSTRUMENT=1 writes to INSTRUMENT_LOG
+- PYWRDRB_INSTRUMENT=<filename.jsonl> writes to that file
+Setting PYWRDRB_INSTRUMENT_SUMMARY=1 also prints a summary table when the process exits.
+When disabled, span() returns a shared no-op object, so the overhead is one function call.
+
+Summarize a log with: python instrumentation.py <filename.jsonl>
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from functools import wraps
+
+INSTRUMENT_ENV = 'PYWRDRB_INSTRUMENT'
+SUMMARY_ENV = 'PYWRDRB_INSTRUMENT_SUMMARY'
+INSTRUMENT_LOG = './datasets/cache/logs/instrumentation.jsonl'
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_log_filename = None
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def read_proc_io():
+    """Return the /proc/self/io counters (e.g., rchar, wchar), or an empty dict if unavailable."""
+    try:
+        with open('/proc/self/io') as f:
+            return {k: int(v) for k, v in (line.split(':') for line in f)}
+    except OSError:
+        return {}
+
+
+def get_peak_rss_mb():
+    """Return the peak resident set size of this process in MB, or None if unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+class _NoOpSpan:
+    """Span returned when instrumentation is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **fields):
+        pass
+
+    def set_shape(self, data):
+        pass
+
+
+_NO_OP_SPAN = _NoOpSpan()
+
+
+class Span:
+    """
+    Context manager which measures one stage and writes a JSON line on exit.
+
+    Args:
+        name (str): Stage name (e.g., 'nhmv10/load').
+        **fields: Extra fields for the record (e.g., source filename).
+    """
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        """Add fields to the record (e.g., rows=..., n_requests=...)."""
+        self.fields.update(fields)
+
+    def set_shape(self, data):
+        """Record the rows and columns of a DataFrame or array."""
+        shape = getattr(data, 'shape', None)
+        if shape is not None:
+            self.fields['rows'] = int(shape[0]) if len(shape) > 0 else 1
+            self.fields['columns'] = int(shape[1]) if len(shape) > 1 else 1
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.path = '/'.join([s.name for s in stack] + [self.name]) if stack else self.name
+        stack.append(self)
+
+        self._io = read_proc_io()
+        self._rss = get_peak_rss_mb()
+        self._cpu = time.process_time()
+        self._start = time.perf_counter()
+        self._timestamp = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall_time = time.perf_counter() - self._start
+        cpu_time = time.process_time() - self._cpu
+        io = read_proc_io()
+        rss = get_peak_rss_mb()
+        _local.stack.pop()
+
+        record = {'span': self.path,
+                  'timestamp': self._timestamp,
+                  'pid': os.getpid(),
+                  'wall_time_s': wall_time,
+                  'cpu_time_s': cpu_time,
+                  'peak_rss_mb': rss,
+                  'peak_rss_delta_mb': None if rss is None else rss - self._rss,
+                  'bytes_read': io['rchar'] - self._io['rchar'] if io else None,
+                  'bytes_written': io['wchar'] - self._io['wchar'] if io else None}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        record.update(self.fields)
+        write_record(record)
+        return False
+
+
+def write_record(record):
+    """Append one record to the instrumentation log."""
+    line = json.dumps(record, default=str) + '\n'
+    with _write_lock:
+        with open(_log_filename, 'a') as f:
+            f.write(line)
+
+
+def enable(filename=INSTRUMENT_LOG):
+    """Enable instrumentation, writing to filename."""
+    global _log_filename
+    folder = os.path.dirname(filename)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    _log_filename = filename
+
+
+def disable():
+    """Disable instrumentation."""
+    global _log_filename
+    _log_filename = None
+
+
+def is_enabled():
+    """Return True if instrumentation is enabled."""
+    return _log_filename is not None
+
+
+def span(name, **fields):
+    """
+    Gets a span for a stage, or a no-op span if instrumentation is disabled.
+
+    Args:
+        name (str): Stage name (e.g., 'nhmv10/load').
+        **fields: Extra fields for the record.
+
+    Returns:
+        Span: Context manager.
+    """
+    if _log_filename is None:
+        return _NO_OP_SPAN
+    return Span(name, **fields)
+
+
+def instrumented(name):
+    """Decorator which wraps each call of a function in a span."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _log_filename is None:
+                return func(*args, **kwargs)
+            with Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summarize(filename=None, pid=None):
+    """
+    Summarizes an instrumentation log by span.
+
+    Args:
+        filename (str, optional): Log file. Defaults to the current log.
+        pid (int, optional): Only include spans from this process.
+
+    Returns:
+        pd.DataFrame: Count and totals of wall time, CPU time and bytes, and the max peak RSS delta
+            and precision difference from float64 (see dataset_io.cast_flows), by span.
+    """
+    import pandas as pd
+    records = pd.read_json(filename or _log_filename, lines=True)
+    if pid is not None:
+        records = records.loc[records['pid'] == pid]
+    for column in ('bytes_read', 'bytes_written', 'peak_rss_delta_mb', 'rows', 'max_abs_diff'):
+        if column not in records.columns:
+            records[column] = float('nan')
+    summary = records.groupby('span', sort=False).agg(count=('wall_time_s', 'size'),
+                                                      wall_time_s=('wall_time_s', 'sum'),
+                                                      cpu_time_s=('cpu_time_s', 'sum'),
+                                                      peak_rss_delta_mb=('peak_rss_delta_mb', 'max'),
+                                                      mb_read=('bytes_read', 'sum'),
+                                                      mb_written=('bytes_written', 'sum'),
+                                                      rows=('rows', 'max'),
+                                                      max_abs_diff=('max_abs_diff', 'max'))
+    summary[['mb_read', 'mb_written']] /= 1024**2
+    return summary
+
+
+def _print_summary():
+    if _log_filename is not None and os.path.exists(_log_filename):
+        print(summarize(pid=os.getpid()).to_string(float_format='{:.6g}'.format))
+
+
+_env_value = os.environ.get(INSTRUMENT_ENV, '')
+if _env_value and _env_value != '0':
+    enable(INSTRUMENT_LOG if _env_value == '1' else _env_value)
+    if os.environ.get(SUMMARY_ENV, '') not in ('', '0'):
+        atexit.register(_print_summary)
+
+
+if __name__ == '__main__':
+    print(summarize(sys.argv[1] if len(sys.argv) > 1 else INSTRUMENT_LOG).to_string(float_format='{:.6g}'.format))
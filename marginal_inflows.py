@@ -0,0 +1,181 @@
+"""
+Derives marginal catchment inflows for Pywr-DRB nodes from modeled node total flows.
+
+The extraction scripts export total flow at each node (e.g., NHM segment outflow, NWM and
+WRF-Hydro reach streamflow). Pywr-DRB needs the marginal inflow of each node's catchment:
+the node total minus the lagged totals of its immediate upstream nodes.
+
+All datasets and scenarios are stacked along the time axis and handled in one pass. For each
+distinct lag in downstream_node_lags, the totals are lagged once, and each upstream node's lagged
+total is subtracted from its downstream node's column. Missing (NaN) totals therefore only affect
+the node and its immediate downstream node. Lagged values never cross from one dataset into the next.
+
+Negative marginal flows (e.g., where modeled routing or reservoir effects put more flow upstream
+than at the node) are counted for each dataset and node, and clipped to zero.
+"""
+
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+from pywr_drb_node_data import nhm_site_matches, nwm_site_matches, wrf_hydro_site_matches
+from pywr_drb_network import get_pywrdrb_network
+from directories import WRFHYDRO_DIR, PYWRDRB_DATA_DIR
+from dataset_io import read_flow_dataset, write_flow_dataset, get_dataset_stem
+from instrumentation import span, instrumented
+
+NHM_OUTPUT_DIR = './datasets/NHMv10/'
+NWM_OUTPUT_DIR = './datasets/NWMv21/'
+
+
+def get_node_flows(dataset_flows, site_matches, id_aliases=None):
+    """
+    Gets the total flow at each Pywr-DRB node from a dataset with one column per dataset ID.
+    Nodes matched to several IDs (e.g., tributaries) are given the sum of the IDs.
+
+    Args:
+        dataset_flows (pd.DataFrame): Flows with dataset ID columns.
+        site_matches (dict): Dataset IDs for each node.
+        id_aliases (dict, optional): Alternative ID (e.g., USGS site number) for dataset columns.
+
+    Returns:
+        pd.DataFrame: Flows with node columns. NaN for nodes with IDs missing from the dataset.
+    """
+    dataset_flows = dataset_flows.copy()
+    dataset_flows.columns = dataset_flows.columns.astype(str)
+    if id_aliases is not None:
+        aliases = {str(k): str(v) for k, v in id_aliases.items()}
+        dataset_flows = pd.concat([dataset_flows,
+                                   dataset_flows.loc[:, dataset_flows.columns.isin(list(aliases))].rename(columns=aliases)],
+                                  axis=1)
+        dataset_flows = dataset_flows.loc[:, ~dataset_flows.columns.duplicated()]
+
+    node_flows = {}
+    missing = {}
+    for node, ids in site_matches.items():
+        ids = [str(i) for i in ids] if ids else []
+        missing_ids = [i for i in ids if i not in dataset_flows.columns]
+        if not ids or missing_ids:
+            missing[node] = missing_ids
+            node_flows[node] = pd.Series(np.nan, index=dataset_flows.index)
+        else:
+            node_flows[node] = dataset_flows[ids].astype(float).sum(axis=1, min_count=len(ids))
+    if missing:
+        print(f'No dataset flows for nodes (missing IDs): {missing}')
+    return pd.DataFrame(node_flows)
+
+
+def get_lag_connections(nodes, network=None):
+    """
+    Gets the immediate (upstream, downstream) connections between the given nodes, grouped by lag.
+
+    Args:
+        nodes (list): Nodes, in column order.
+        network (PywrDRBNetwork, optional): Node network. Defaults to get_pywrdrb_network().
+
+    Returns:
+        dict: For each lag (days), a list of (upstream column, downstream column) pairs.
+    """
+    network = get_pywrdrb_network() if network is None else network
+    column = {node: i for i, node in enumerate(nodes)}
+
+    connections = {}
+    for node in nodes:
+        downstream = network.downstream_idx[network.node_index[node]]
+        if downstream < 0 or network.nodes[downstream] not in column:
+            continue
+        lag = int(network.lags[network.node_index[node]])
+        connections.setdefault(lag, []).append((column[node], column[network.nodes[downstream]]))
+    return connections
+
+
+@instrumented('aggregate')
+def derive_marginal_inflows(node_flows, network=None, fill_value=None, clip_negative=True):
+    """
+    Derives marginal catchment inflows for several datasets at once.
+
+    Args:
+        node_flows (dict): Node total flows (time x node) for each dataset, e.g., from get_node_flows().
+        network (PywrDRBNetwork, optional): Node network. Defaults to get_pywrdrb_network().
+        fill_value (float, optional): Upstream total assumed before the start of each dataset.
+            Defaults to the first value of each dataset.
+        clip_negative (bool): If True, set negative marginal flows to zero.
+
+    Returns:
+        tuple: (dict of marginal inflows for each dataset, pd.DataFrame of negative flow counts indexed by (dataset, node))
+    """
+    nodes = list(next(iter(node_flows.values())).columns)
+    stacked = pd.concat({name: flows[nodes] for name, flows in node_flows.items()}, names=['dataset', 'datetime'])
+    totals = stacked.values.astype('float64')
+
+    ### position of each row within its dataset, so lags do not cross datasets
+    lengths = np.array([len(flows) for flows in node_flows.values()])
+    starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    position = np.arange(len(totals)) - starts
+
+    marginal = totals.copy()
+    for lag, connections in get_lag_connections(nodes, network).items():
+        lagged = np.empty_like(totals)
+        lagged[lag:] = totals[:len(totals) - lag]
+        before_start = position < lag
+        lagged[before_start] = totals[starts[before_start]] if fill_value is None else fill_value
+        # one column at a time, so a NaN node does not spread to unconnected nodes
+        for up, down in connections:
+            marginal[:, down] -= lagged[:, up]
+
+    marginal = pd.DataFrame(marginal, index=stacked.index, columns=nodes)
+    negative = (marginal < 0).groupby(level='dataset', sort=False)
+    negative_report = pd.concat({'n_negative': negative.sum().stack(),
+                                 'fraction_negative': negative.mean().stack(),
+                                 'min_flow_mgd': marginal.groupby(level='dataset', sort=False).min().stack()},
+                                axis=1)
+    negative_report.index.names = ['dataset', 'node']
+
+    if clip_negative:
+        marginal = marginal.clip(lower=0)
+    return {name: marginal.loc[name] for name in node_flows}, negative_report
+
+
+def load_node_total_flows():
+    """
+    Loads the node total flows exported by the NHM, NWM and WRF-Hydro extraction scripts.
+
+    Returns:
+        dict: For each dataset, a tuple (source filename, node flows).
+    """
+    datasets = {}
+    fname = f'{NHM_OUTPUT_DIR}/csv/streamflow_daily_nhmv10_mgd'
+    datasets['nhmv10'] = (fname, get_node_flows(read_flow_dataset(fname), nhm_site_matches))
+
+    fname = f'{NWM_OUTPUT_DIR}/nwmv21_gauge_streamflow_daily_mgd'
+    nwm_meta = pd.read_csv(f'{NWM_OUTPUT_DIR}/nwmv21_gauge_metadata.csv', dtype={'site_no': str})
+    datasets['nwmv21'] = (fname, get_node_flows(read_flow_dataset(fname), nwm_site_matches,
+                                                id_aliases=dict(zip(nwm_meta['comid'], nwm_meta['site_no']))))
+
+    wrf_stems = dict.fromkeys(get_dataset_stem(f) for f in sorted(glob.glob(f'{WRFHYDRO_DIR}streamflow_daily_wrf*.*')))
+    for fname in wrf_stems:
+        name = os.path.basename(fname)[len('streamflow_daily_'):]
+        datasets[name] = (fname, get_node_flows(read_flow_dataset(fname), wrf_hydro_site_matches))
+    return datasets
+
+
+def main():
+    with span('marginal_inflows'):
+        datasets = load_node_total_flows()
+        marginal_inflows, negative_report = derive_marginal_inflows({name: flows for name, (_, flows) in datasets.items()})
+
+        for name, (fname, _) in datasets.items():
+            export_fname = write_flow_dataset(marginal_inflows[name],
+                                              os.path.join(os.path.dirname(fname), f'catchment_inflow_{name}_mgd'),
+                                              units='mgd', source=f'{name} marginal catchment inflow')
+            print(f'Exported {name} marginal catchment inflows to {export_fname}')
+
+        negative_report.to_csv(f'{PYWRDRB_DATA_DIR}marginal_inflow_negative_report.csv')
+        print('Nodes with negative marginal inflows (clipped to zero):')
+        print(negative_report.loc[negative_report['n_negative'] > 0])
+
+
+if __name__ == '__main__':
+    main()
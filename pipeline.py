@@ -0,0 +1,415 @@
+"""
+Runs the data processing scripts of this repo in dependency order.
+
+Each stage declares:
+- script: Script in the repo root, run as `python <script>` in a subprocess
+- inputs: Files (or glob patterns) the script reads
+- outputs: Files (or glob patterns) the script writes
+- params: Names of the dicts in pywr_drb_node_data.py which the script uses (e.g., site matches)
+
+Stage order comes from matching inputs to the outputs of other stages; inputs which no stage produces
+(e.g., the NHM .tar) must already exist, or the stage is reported as missing inputs. A glob input which
+matches no files is missing. A stage with missing inputs whose outputs all exist (e.g., checked-in
+datasets) is treated as up to date, with a warning. Stages downstream of a stage with missing
+inputs are checked on their own inputs, so they run if the outputs they read already exist.
+
+A stage is skipped when its fingerprint (the contents of its script and the repo modules it imports,
+input files, and param values) matches the last successful run, recorded in a state JSON file, and all
+of its outputs exist. Files larger than LARGE_FILE_BYTES (e.g., the NHM .tar, NWM .nc) are fingerprinted
+by size and modification time rather than contents.
+Since params are fingerprinted dict-by-dict, editing one site match dict only re-runs the stages which
+use it, and the stages downstream of their changed outputs.
+
+Stages whose dependencies are done are run in parallel (e.g., the NHM, NWM and WRF-Hydro extraction).
+
+Usage:
+    python pipeline.py                    # run all stages which are out of date
+    python pipeline.py inflow_scaling     # run a stage and the stages it depends on
+    python pipeline.py --dry-run          # show which stages would run
+    python pipeline.py --check            # also check the flow datasets written by each stage
+"""
+
+import os
+import sys
+import ast
+import json
+import glob
+import fnmatch
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import pywr_drb_node_data
+from fingerprint import hash_file, hash_object
+from instrumentation import span
+from directories import PYWRDRB_DIR, NHM_DIR, NWM_DIR, WRFHYDRO_DIR, CACHE_DIR
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = f'{CACHE_DIR}pipeline_state.json'
+LOG_DIR = f'{CACHE_DIR}pipeline_logs/'
+
+# Files larger than this are fingerprinted by size and modification time
+LARGE_FILE_BYTES = 100 * 2**20
+
+pipeline_stages = {
+    'usgs': {
+        'script': 'retrieve_usgs_data.py',
+        'inputs': [f'{PYWRDRB_DIR}DRB_spatial/DRB_shapefiles/drb_bnd_polygon.shp'],
+        'outputs': ['./datasets/USGS/streamflow_daily_usgs_1950_2022_cms.csv',
+                    './datasets/USGS/drb_all_usgs_metadata.csv',
+                    './datasets/USGS/drb_unmanaged_usgs_metadata.csv'],
+        'params': ['obs_site_matches', 'obs_pub_site_matches', 'scaling_site_matches'],
+    },
+    'nhmv10': {
+        'script': 'extract_nhmv10_data.py',
+        'inputs': [f'{NHM_DIR}/byHRU_musk_obs.tar',
+                   './GFv1.1.gdb/',
+                   './datasets/NHMv10/meta/poi_gage_id.csv',
+                   './datasets/NHMv10/meta/poi_gage_segment.csv',
+                   './datasets/NHMv10/csv/drb_seg_outflow_mgd.*'],
+        'outputs': ['./datasets/NHMv10/csv/streamflow_daily_nhmv10_mgd.*',
+                    './datasets/NHMv10/meta/drb_nhm_gage_segment_ids.csv'],
+        'params': ['nhm_site_matches', 'obs_pub_site_matches'],
+    },
+    'nwmv21': {
+        'script': 'extract_nwmv21_data.py',
+        'inputs': [f'{NWM_DIR}nwmv21_nwis.nc',
+                   './datasets/USGS/drb_all_usgs_metadata.csv',
+                   './datasets/USGS/drb_unmanaged_usgs_metadata.csv'],
+        'outputs': ['./datasets/NWMv21/nwmv21_gauge_streamflow_daily_mgd.*',
+                    './datasets/NWMv21/nwmv21_gauge_metadata.csv',
+                    './datasets/NWMv21/nwmv21_unmanaged_gauge_streamflow_daily_mgd.*',
+                    './datasets/NWMv21/nwmv21_unmanaged_gauge_metadata.csv'],
+        'params': ['scaling_site_matches'],
+    },
+    'wrf_hydro': {
+        'script': 'extract_wrf_hydro_data.py',
+        'inputs': [f'{WRFHYDRO_DIR}*_climate/*.nc'],
+        'outputs': [f'{WRFHYDRO_DIR}streamflow_daily_wrf*.*'],
+        'params': ['wrf_hydro_site_matches', 'pywrdrb_wrf_hydro_flowtypes', 'scaling_site_matches'],
+    },
+    'gap_filling': {
+        'script': 'gap_filling.py',
+        'inputs': ['./datasets/USGS/streamflow_daily_usgs_1950_2022_cms.csv',
+                   './datasets/USGS/drb_all_usgs_metadata.csv',
+                   './datasets/USGS/drb_unmanaged_usgs_metadata.csv',
+                   './datasets/NHMv10/csv/streamflow_daily_nhmv10_mgd.*',
+                   './datasets/NHMv10/meta/drb_nhm_gage_segment_ids.csv',
+                   './datasets/NWMv21/nwmv21_gauge_streamflow_daily_mgd.*',
+                   './datasets/NWMv21/nwmv21_gauge_metadata.csv'],
+        'outputs': ['./datasets/USGS/streamflow_daily_usgs_1950_2022_cms_filled.*',
+                    './datasets/USGS/usgs_gap_fill_flags.csv',
+                    './datasets/USGS/usgs_gap_fill_donors.csv'],
+        'params': ['obs_site_matches', 'obs_pub_site_matches', 'scaling_site_matches'],
+    },
+    'inflow_scaling': {
+        'script': 'inflow_scaling_regression.py',
+        'inputs': ['./datasets/USGS/streamflow_daily_usgs_1950_2022_cms.csv',
+                   './datasets/USGS/streamflow_daily_usgs_1950_2022_cms_filled.*',
+                   './datasets/USGS/drb_unmanaged_usgs_metadata.csv',
+                   './datasets/NHMv10/csv/streamflow_daily_nhmv10_mgd.*',
+                   './datasets/NWMv21/nwmv21_unmanaged_gauge_streamflow_daily_mgd.*',
+                   './datasets/NWMv21/nwmv21_unmanaged_gauge_metadata.csv',
+                   # NWM lake inflows and segment flows, provided by NCAR (not produced by a stage)
+                   './datasets/NWMv21/streamflow_daily_nwmv21_mgd.csv',
+                   f'{WRFHYDRO_DIR}streamflow_daily_wrfaorc_calib_nlcd2016.*'],
+        'outputs': ['./datasets/Hybrid/scaled_inflows_*.*'],
+        'params': ['scaling_site_matches'],
+    },
+    'synthetic_inflows': {
+        'script': 'synthetic_generator.py',
+        'inputs': ['./datasets/NHMv10/csv/streamflow_daily_nhmv10_mgd.*',
+                   './datasets/Hybrid/scaled_inflows_wrf.*'],
+        'outputs': ['./datasets/synthetic/synthetic_inflows_kirsch_nowak_mgd.npy',
+                    './datasets/synthetic/synthetic_inflows_kirsch_nowak_mgd.json'],
+        'params': ['nhm_site_matches'],
+    },
+    'marginal_inflows': {
+        'script': 'marginal_inflows.py',
+        'inputs': ['./datasets/NHMv10/csv/streamflow_daily_nhmv10_mgd.*',
+                   './datasets/NWMv21/nwmv21_gauge_streamflow_daily_mgd.*',
+                   './datasets/NWMv21/nwmv21_gauge_metadata.csv',
+                   f'{WRFHYDRO_DIR}streamflow_daily_wrf*.*'],
+        'outputs': ['./datasets/NHMv10/csv/catchment_inflow_*.*',
+                    './datasets/NWMv21/catchment_inflow_*.*',
+                    f'{WRFHYDRO_DIR}catchment_inflow_*.*'],
+        'params': ['nhm_site_matches', 'nwm_site_matches', 'wrf_hydro_site_matches',
+                   'immediate_downstream_nodes_dict', 'downstream_node_lags', 'upstream_nodes_dict'],
+    },
+}
+
+
+def get_path(filename):
+    """Return the absolute path of a repo-relative filename."""
+    return os.path.normpath(os.path.join(ROOT_DIR, filename))
+
+
+def expand_files(patterns):
+    """Return the sorted files matching a list of filenames or glob patterns."""
+    files = []
+    for pattern in patterns:
+        files += sorted(glob.glob(get_path(pattern))) if glob.has_magic(pattern) else [get_path(pattern)]
+    return files
+
+
+def fingerprint_file(filename):
+    """
+    Fingerprints a file (by contents, or by size and modification time if large) or a folder.
+
+    Args:
+        filename (str): File or folder.
+
+    Returns:
+        str: Fingerprint.
+    """
+    if os.path.isdir(filename):
+        stats = [(os.path.relpath(os.path.join(d, f), filename), os.stat(os.path.join(d, f)))
+                 for d, _, files in os.walk(filename) for f in files]
+        return hash_object(sorted((f, s.st_size, s.st_mtime_ns) for f, s in stats))
+    stat = os.stat(filename)
+    if stat.st_size > LARGE_FILE_BYTES:
+        return f'{stat.st_size}-{stat.st_mtime_ns}'
+    return hash_file(filename)
+
+
+def get_local_modules(script):
+    """
+    Finds the repo modules which a script imports, directly or through other repo modules.
+
+    pywr_drb_node_data.py is left out, since the dicts a stage uses are fingerprinted as its params.
+
+    Args:
+        script (str): Script filename.
+
+    Returns:
+        list: Module filenames.
+    """
+    modules = set()
+    pending = [script]
+    while pending:
+        with open(get_path(pending.pop())) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = f'{name.split(".")[0]}.py'
+                if module not in modules and module != 'pywr_drb_node_data.py' and os.path.exists(get_path(module)):
+                    modules.add(module)
+                    pending.append(module)
+    return sorted(modules)
+
+
+def get_missing_inputs(stage):
+    """Return the stage's input files which do not exist, and glob patterns which match no files."""
+    missing = []
+    for pattern in stage['inputs']:
+        files = expand_files([pattern])
+        if not files:
+            missing.append(get_path(pattern))
+        missing += [f for f in files if not os.path.exists(f)]
+    return missing
+
+
+def get_stage_fingerprint(stage):
+    """
+    Fingerprints a stage from its script, the repo modules it imports, its inputs and params.
+
+    Args:
+        stage (dict): Stage definition.
+
+    Returns:
+        str: Fingerprint, or None if any input is missing.
+    """
+    if get_missing_inputs(stage):
+        return None
+    inputs = {}
+    for filename in [get_path(stage['script'])] + [get_path(m) for m in get_local_modules(stage['script'])] + expand_files(stage['inputs']):
+        inputs[os.path.relpath(filename, ROOT_DIR)] = fingerprint_file(filename)
+    params = {name: getattr(pywr_drb_node_data, name) for name in stage['params']}
+    return hash_object({'inputs': inputs, 'params': params})
+
+
+def get_stage_dependencies(stages):
+    """
+    Finds the stages which produce each stage's inputs.
+
+    Args:
+        stages (dict): Stage definitions.
+
+    Returns:
+        dict: Set of upstream stage names for each stage.
+    """
+    def matches(filename, pattern):
+        return fnmatch.fnmatch(get_path(filename), get_path(pattern)) or fnmatch.fnmatch(get_path(pattern), get_path(filename))
+
+    return {name: {other for other, other_stage in stages.items() if other != name and
+                   any(matches(i, o) for i in stage['inputs'] for o in other_stage['outputs'])}
+            for name, stage in stages.items()}
+
+
+def get_required_stages(stages, targets):
+    """Return the target stages and all stages they depend on."""
+    dependencies = get_stage_dependencies(stages)
+    required = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending += list(dependencies[name])
+    return required
+
+
+def load_state(state_file=STATE_FILE):
+    """Return the fingerprints of the last successful run of each stage."""
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state, state_file=STATE_FILE):
+    """Save the fingerprints of the last successful run of each stage."""
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    with open(state_file, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def run_stage(name, stage, log_dir=LOG_DIR):
+    """
+    Runs a stage script in a subprocess, from the repo root.
+
+    Args:
+        name (str): Stage name.
+        stage (dict): Stage definition.
+        log_dir (str): Folder for the stage's stdout/stderr log.
+
+    Returns:
+        int: Return code of the script.
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    with open(f'{log_dir}{name}.log', 'w') as log, span(f'pipeline/{name}') as s:
+        returncode = subprocess.run([sys.executable, stage['script']], cwd=ROOT_DIR,
+                                    stdout=log, stderr=subprocess.STDOUT).returncode
+        s.set(returncode=returncode)
+    return returncode
+
+
+def check_stage_outputs(name, stage):
+    """
+    Runs the data quality checks (see data_quality.py) on the flow datasets written by a stage.
+
+    Args:
+        name (str): Stage name.
+        stage (dict): Stage definition.
+    """
+    from data_quality import check_datasets, is_flow_dataset
+
+    filenames = [os.path.relpath(f, ROOT_DIR) for f in expand_files(stage['outputs'])]
+    datasets = list(dict.fromkeys(os.path.splitext(f)[0] for f in filenames if os.path.exists(f) and is_flow_dataset(f)))
+    if datasets:
+        with span(f'pipeline/{name}/quality'):
+            check_datasets(datasets)
+
+
+def run_pipeline(stages=pipeline_stages, targets=None, force=False, dry_run=False,
+                 n_workers=3, state_file=STATE_FILE, check=False):
+    """
+    Runs out-of-date stages in dependency order, with independent stages in parallel.
+
+    Args:
+        stages (dict): Stage definitions.
+        targets (list, optional): Stages to bring up to date. Defaults to all stages.
+        force (bool): If True, run the stages even if they are up to date.
+        dry_run (bool): If True, only print the stages which would run. Stages downstream
+            of a stage which would run are assumed to run too.
+        n_workers (int): Maximum number of stages to run at a time.
+        state_file (str): JSON file with the fingerprints of the last successful runs.
+        check (bool): If True, run the data quality checks on each completed stage's flow datasets.
+
+    Returns:
+        dict: Status of each stage ('up to date', 'done', 'failed', 'missing inputs', 'skipped', or 'would run').
+    """
+    required = get_required_stages(stages, targets or list(stages))
+    dependencies = {name: deps & required for name, deps in get_stage_dependencies(stages).items() if name in required}
+    state = load_state(state_file)
+    status = {}
+    rerun = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while len(status) < len(required):
+            n_started = len(status) + len(running)
+            for name in sorted(required):
+                if name in status or name in running.values() or not dependencies[name] <= set(status):
+                    continue
+                if any(status[d] in ('failed', 'skipped') for d in dependencies[name]):
+                    status[name] = 'skipped'
+                    print(f'{name}: skipped (upstream stage did not complete)')
+                    continue
+
+                fingerprint = get_stage_fingerprint(stages[name])
+                outputs_exist = all(any(os.path.exists(f) for f in expand_files([o])) for o in stages[name]['outputs'])
+                upstream_rerun = dry_run and bool(dependencies[name] & rerun)
+                if fingerprint is None and not upstream_rerun and outputs_exist:
+                    status[name] = 'up to date'
+                    print(f'{name}: up to date; WARNING: missing inputs {get_missing_inputs(stages[name])}, '
+                          f'so the existing outputs are used')
+                elif fingerprint is None and not upstream_rerun:
+                    status[name] = 'missing inputs'
+                    print(f'{name}: missing inputs {get_missing_inputs(stages[name])}')
+                elif not force and not upstream_rerun and state.get(name) == fingerprint and outputs_exist:
+                    status[name] = 'up to date'
+                    print(f'{name}: up to date')
+                elif dry_run:
+                    status[name] = 'would run'
+                    rerun.add(name)
+                    print(f'{name}: would run')
+                else:
+                    print(f'{name}: running {stages[name]["script"]}...')
+                    running[executor.submit(run_stage, name, stages[name])] = name
+
+            if not running:
+                if len(status) == n_started:
+                    raise ValueError(f'Stage dependencies have a cycle: {sorted(required - set(status))}')
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.result() == 0:
+                    status[name] = 'done'
+                    rerun.add(name)
+                    state[name] = get_stage_fingerprint(stages[name])
+                    save_state(state, state_file)
+                    print(f'{name}: done')
+                    if check:
+                        check_stage_outputs(name, stages[name])
+                else:
+                    status[name] = 'failed'
+                    print(f'{name}: failed; see {LOG_DIR}{name}.log')
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the data processing stages which are out of date.')
+    parser.add_argument('targets', nargs='*', help=f'Stages to bring up to date (default: all). Options: {list(pipeline_stages)}')
+    parser.add_argument('--force', action='store_true', help='Run stages even if they are up to date.')
+    parser.add_argument('--dry-run', action='store_true', help='Only show which stages would run.')
+    parser.add_argument('-j', '--n-workers', type=int, default=3, help='Maximum number of stages to run at a time.')
+    parser.add_argument('--check', action='store_true', help='Check the flow datasets written by each stage (see data_quality.py).')
+    args = parser.parse_args(argv)
+    unknown = [t for t in args.targets if t not in pipeline_stages]
+    if unknown:
+        parser.error(f'Unknown stages: {unknown}')
+
+    run_pipeline(targets=args.targets, force=args.force, dry_run=args.dry_run, n_workers=args.n_workers,
+                 check=args.check)
+
+
+if __name__ == '__main__':
+    main()
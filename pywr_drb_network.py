@@ -0,0 +1,179 @@
+"""
+Compiled Pywr-DRB network topology.
+
+The node connections in pywr_drb_node_data.py are kept as hand-maintained dicts. PywrDRBNetwork
+is built once from immediate_downstream_nodes_dict and downstream_node_lags, and holds the
+topology as arrays:
+- Nodes in topological order (every node comes after all of its upstream nodes)
+- Immediate downstream node index of each node (-1 for outlets)
+- Immediate upstream nodes in CSR form (upstream_indptr, upstream_indices)
+- Transitive closure as a packed bitset; row i has bit j set if node j is upstream of node i
+- Lag (days) to the downstream node, and cumulative lag to the outlet
+
+Upstream, downstream and lag queries are then array lookups. The derived upstream sets are
+checked against upstream_nodes_dict.
+
+Example:
+    network = get_pywrdrb_network()
+    network.get_upstream_nodes('delMontague')
+    network.get_lag('cannonsville', 'delTrenton')
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+from pywr_drb_node_data import immediate_downstream_nodes_dict, downstream_node_lags, upstream_nodes_dict
+
+
+class PywrDRBNetwork:
+    """
+    Pywr-DRB node network, compiled to arrays.
+
+    Args:
+        immediate_downstream_nodes (dict): Immediate downstream node of each node.
+        lags (dict): Lag (days) between each node and its immediate downstream node.
+        upstream_nodes (dict, optional): Set of all upstream nodes for every downstream node, to validate against.
+    """
+
+    def __init__(self, immediate_downstream_nodes, lags, upstream_nodes=None):
+        self.nodes = self._get_topological_order(immediate_downstream_nodes)
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        n_nodes = len(self.nodes)
+
+        ### immediate downstream node and lag, with -1 and 0 for outlets
+        self.downstream_idx = np.array([self.node_index.get(immediate_downstream_nodes.get(node), -1)
+                                        for node in self.nodes], dtype=int)
+        self.lags = np.array([lags.get(node, 0) for node in self.nodes], dtype=int)
+
+        ### immediate upstream nodes as CSR arrays
+        has_downstream = np.flatnonzero(self.downstream_idx >= 0)
+        order = np.argsort(self.downstream_idx[has_downstream], kind='stable')
+        self.upstream_indices = has_downstream[order]
+        self.upstream_indptr = np.zeros(n_nodes + 1, dtype=int)
+        np.cumsum(np.bincount(self.downstream_idx[has_downstream], minlength=n_nodes),
+                  out=self.upstream_indptr[1:])
+
+        ### transitive closure, walking upstream to downstream
+        upstream = np.zeros((n_nodes, n_nodes), dtype=bool)
+        for i in range(n_nodes):
+            for j in self.upstream_indices[self.upstream_indptr[i]:self.upstream_indptr[i + 1]]:
+                upstream[i] |= upstream[j]
+                upstream[i, j] = True
+        self.upstream_bits = np.packbits(upstream, axis=1)
+
+        ### cumulative lag to the outlet, walking downstream to upstream
+        self.lag_to_outlet = np.zeros(n_nodes, dtype=int)
+        for i in range(n_nodes - 1, -1, -1):
+            if self.downstream_idx[i] >= 0:
+                self.lag_to_outlet[i] = self.lags[i] + self.lag_to_outlet[self.downstream_idx[i]]
+
+        if upstream_nodes is not None:
+            self.validate(upstream_nodes, model_nodes=immediate_downstream_nodes.keys())
+
+    @staticmethod
+    def _get_topological_order(immediate_downstream_nodes):
+        """
+        Orders nodes so that each node comes after all of its upstream nodes.
+        Ties keep the order of the dict.
+
+        Args:
+            immediate_downstream_nodes (dict): Immediate downstream node of each node.
+
+        Returns:
+            np.ndarray: Node names in topological order.
+        """
+        nodes = list(immediate_downstream_nodes.keys())
+        nodes += [node for node in dict.fromkeys(immediate_downstream_nodes.values()) if node not in immediate_downstream_nodes]
+        n_upstream = {node: 0 for node in nodes}
+        for downstream in immediate_downstream_nodes.values():
+            n_upstream[downstream] += 1
+
+        order = [node for node in nodes if n_upstream[node] == 0]
+        for node in order:
+            downstream = immediate_downstream_nodes.get(node)
+            if downstream is not None:
+                n_upstream[downstream] -= 1
+                if n_upstream[downstream] == 0:
+                    order.append(downstream)
+
+        if len(order) < len(nodes):
+            cycle_nodes = [node for node in nodes if n_upstream[node] > 0]
+            raise ValueError(f'Node network has a cycle through: {cycle_nodes}')
+        return np.array(order)
+
+    @property
+    def upstream_matrix(self):
+        """Boolean (node x node) matrix, True where the column node is upstream of the row node."""
+        return np.unpackbits(self.upstream_bits, axis=1, count=len(self.nodes)).astype(bool)
+
+    def get_index(self, nodes):
+        """Return the index of a node, or an array of indices for a list of nodes."""
+        if isinstance(nodes, str):
+            return self.node_index[nodes]
+        return np.array([self.node_index[node] for node in nodes], dtype=int)
+
+    def is_upstream(self, node, of):
+        """Return True if `node` is upstream of node `of`."""
+        j = self.node_index[node]
+        return bool(self.upstream_bits[self.node_index[of], j >> 3] & (0x80 >> (j & 7)))
+
+    def get_upstream_nodes(self, node):
+        """Return all nodes upstream of a node, in topological order."""
+        upstream = np.unpackbits(self.upstream_bits[self.node_index[node]], count=len(self.nodes)).astype(bool)
+        return self.nodes[upstream].tolist()
+
+    def get_downstream_nodes(self, node):
+        """Return all nodes downstream of a node, from nearest to the outlet."""
+        downstream_nodes = []
+        i = self.downstream_idx[self.node_index[node]]
+        while i >= 0:
+            downstream_nodes.append(str(self.nodes[i]))
+            i = self.downstream_idx[i]
+        return downstream_nodes
+
+    def get_immediate_upstream_nodes(self, node):
+        """Return the nodes directly upstream of a node."""
+        i = self.node_index[node]
+        return self.nodes[self.upstream_indices[self.upstream_indptr[i]:self.upstream_indptr[i + 1]]].tolist()
+
+    def get_lag(self, upstream_node, downstream_node):
+        """
+        Gets the total lag (days) from one node to a node downstream of it.
+
+        Args:
+            upstream_node (str): Upstream node.
+            downstream_node (str): Downstream node.
+
+        Returns:
+            int: Sum of the lags along the path between the nodes.
+        """
+        if upstream_node != downstream_node and not self.is_upstream(upstream_node, downstream_node):
+            raise ValueError(f'{upstream_node} is not upstream of {downstream_node}.')
+        return int(self.lag_to_outlet[self.node_index[upstream_node]] - self.lag_to_outlet[self.node_index[downstream_node]])
+
+    def validate(self, upstream_nodes, model_nodes=None):
+        """
+        Checks that the upstream sets derived from the immediate downstream connections match a
+        hand-maintained upstream_nodes_dict. Nodes without upstream nodes may be left out of the dict.
+
+        Args:
+            upstream_nodes (dict): Set of all upstream nodes for every downstream node.
+            model_nodes (iterable, optional): Nodes to check. Defaults to all nodes.
+        """
+        model_nodes = self.nodes if model_nodes is None else model_nodes
+        mismatches = {}
+        for node in model_nodes:
+            derived = set(self.get_upstream_nodes(node))
+            listed = set(upstream_nodes.get(node, []))
+            if derived != listed:
+                mismatches[node] = {'missing': sorted(derived - listed), 'extra': sorted(listed - derived)}
+        if mismatches:
+            raise ValueError(f'upstream_nodes_dict does not match immediate_downstream_nodes_dict: {mismatches}')
+
+
+@lru_cache(maxsize=None)
+def get_pywrdrb_network():
+    """Return the PywrDRBNetwork for the dicts in pywr_drb_node_data.py, built once per process."""
+    return PywrDRBNetwork(immediate_downstream_nodes_dict, downstream_node_lags,
+                          upstream_nodes=upstream_nodes_dict)
@@ -7,7 +7,10 @@ There are unique node source matches depending on whether the dataset is:
 - Reconstructed historic data with PUB
 - NHMv10
 - NWMv2.1
+- WRF-Hydro
 - WEAP
+
+and the gauge/HRU IDs used for inflow scaling.
 """
 
 ## Set of all upstream nodes for every downstream node
@@ -237,7 +240,117 @@ nwm_site_matches = {'cannonsville': ['2613174'],    # Lake inflow
                     }
 
 
+## WRF-Hydro COMID numbers; taken from nhm_site_matches
+wrf_hydro_site_matches = {'cannonsville': ['2613174'],    # Lake inflow
+                    'pepacton': ['1748473'],        # Lake inflow
+                    'neversink': ['4146742'],       # Lake inflow
+                    'wallenpaupack': ['2741600'],   # Lake inflow
+                    'prompton': ['2739068'],        # Lake inflow
+                    'shoholaMarsh': ['120052035'],  # Lake inflow
+                    'mongaupeCombined': ['4148582'],    # Lake inflow
+                    'beltzvilleCombined': ['4186689'],  # Lake inflow
+                    'fewalter': ['4185065'],        # Lake inflow
+                    'merrillCreek': ['2588031'],    # No NWM lake; using available segment flow
+                    'hopatcong': ['2585287'],       # Lake inflow
+                    'nockamixon': ['2591099'],      # No NWM lake; using available segment flow  2591187 2591219
+                    'assunpink': ['2589015'],       # Lake inflow
+                    'ontelaunee': ['4779981'],      # Lake inflow
+                    'stillCreek': ['4778721'],      # Lake inflow
+                    'blueMarsh': ['4782813'],       # Lake inflow
+                    'greenLane': ['4780087'],       # Lake inflow 
+                    '01425000': ['2614238'],
+                    '01417000': ['1748727'],
+                    'delLordville': ['2617364'],
+                    '01436000': ['4147432'],
+                    '01433500': ['4150156'],
+                    'delMontague': ['4151628'],
+                    '01449800': ['4187341'],
+                    '01447800': ['4186403'],
+                    'delDRCanal': ['2590277'],
+                    'delTrenton': ['2590277'],
+                    '01463620': ['2590117'],
+                    'outletAssunpink': ['2590137'],
+                    '01470960': ['4783213'],
+                    'outletSchuylkill': ['4784841']
+                    }
+
+## WRF-Hydro flow type used for each node
+pywrdrb_wrf_hydro_flowtypes = {
+    'cannonsville': 'lakes',    # Lake inflow
+    'pepacton': 'lakes',        # Lake inflow
+    'neversink': 'lakes',       # Lake inflow
+    'wallenpaupack': 'lakes',   # Lake inflow
+    'prompton': 'lakes',        # Lake inflow
+    'shoholaMarsh': 'lakes',  # Lake inflow
+    'mongaupeCombined': 'lakes',    # Lake inflow
+    'beltzvilleCombined': 'lakes',  # Lake inflow
+    'fewalter': 'lakes',        # Lake inflow
+    'merrillCreek': 'reaches',    # No NWM lake; using available segment flow
+    'hopatcong': 'lakes',       # Lake inflow
+    'nockamixon': 'reaches',      # No NWM lake; using available segment flow  2591187 2591219
+    'assunpink': 'lakes',       # Lake inflow
+    'ontelaunee': 'lakes',      # Lake inflow
+    'stillCreek': 'lakes',      # Lake inflow
+    'blueMarsh': 'lakes',       # Lake inflow
+    'greenLane': 'lakes',       # Lake inflow 
+    '01425000': 'reaches',
+    '01417000': 'reaches',
+    'delLordville': 'reaches',
+    '01436000': 'reaches',
+    '01433500': 'reaches',
+    'delMontague': 'reaches',
+    '01449800': 'reaches',
+    '01447800': 'reaches',
+    'delDRCanal': 'reaches',
+    'delTrenton': 'reaches',
+    '01463620': 'reaches',
+    'outletAssunpink': 'reaches',
+    '01470960': 'reaches',
+    'outletSchuylkill': 'reaches'
+    }
 
+### Dict of different gauge/HRU IDs for different datasets
+# Notes:
+# 1. For scaling, we must have model flows at (i) obs gauges and (ii) total catchment/HRU
+# 2. NWM gauge IDs use USGS site numbers, since the NWM data we have is labeled with USGS site numbers
+# 3. NWM HRU IDs are the reachcodes
+# 4. WRF has the same reachcodes as NWM, but we need to use reachcodes for the wrf_gauges
+# 5. '0142400103' (cannonsville) and '01414000' (pepacton) begin in 1996; earlier obs flows are filled by gap_filling.py
+scaling_site_matches = {'cannonsville':{'nhmv10_gauges': ['1556', '1559'],
+                                'nhmv10_hru': ['1562'],
+                                'nwmv21_gauges': ['01423000', '0142400103'],
+                                'nwmv21_hru': ['2613174'],
+                                'wrf_gauges': ['2613578', '2614018'],
+                                'wrf_hru': ['2613174'],
+                                'obs_gauges': ['01423000', '0142400103']},
+                        'neversink': {'nhmv10_gauges': ['1645'],
+                                      'nhmv10_hru': ['1638'],
+                                      'nwmv21_gauges': ['01435000'],
+                                      'nwmv21_hru': ['4146742'],
+                                      'wrf_gauges': ['4147956'],
+                                      'wrf_hru': ['4146742'],
+                                      'obs_gauges': ['01435000']},
+                        'pepacton': {'nhmv10_gauges': ['1440', '1441', '1443', '1437'],
+                                        'nhmv10_hru': ['1449'],
+                                        'nwmv21_gauges': ['01415000', '01414500', '01414000', '01413500'],
+                                        'nwmv21_hru': ['1748473'],
+                                        'wrf_gauges': ['1748589', '1748611', '1748723', '1748583'],
+                                        'wrf_hru': ['1748473'],
+                                        'obs_gauges': ['01415000', '01414500', '01414000', '01413500']},
+                        'fewalter': {'nhmv10_gauges': ['1684', '1691'],
+                                        'nhmv10_hru': ['1684', '1691', '1694'],
+                                        'nwmv21_gauges': ['01447720', '01447500'],
+                                        'nwmv21_hru': ['4185065'],
+                                        'wrf_gauges': ['4185779', '4185679'],
+                                        'wrf_hru': ['4185065'],
+                                        'obs_gauges': ['01447720', '01447500']},
+                        'beltzvilleCombined': {'nhmv10_gauges': ['1703'],
+                                        'nhmv10_hru': ['1710'],
+                                        'nwmv21_gauges': ['01449360'],
+                                        'nwmv21_hru': ['4186689'],
+                                        'wrf_gauges': ['4187925'],
+                                        'wrf_hru': ['4186689'],
+                                        'obs_gauges': ['01449360']}}
 
 
 ### match for WEAP results file (24Apr2023, gridmet, NatFlows) corresponding to each node in Pywr-DRB.
@@ -0,0 +1,180 @@
+"""
+Retrieves the upstream basin geometry of each Pywr-DRB node from the NLDI,
+and exports node_basin_geometries.shp (or .parquet).
+
+Replaces Get_node_basin_geometry.ipynb. The method follows:
+1.0 Load the nodes (name, lat, long, comid) from drb_nodes.csv
+2.0 Re-use the geometries of nodes which are unchanged (same comid) in the existing output
+3.0 Get basins for the remaining COMIDs:
+    3.1 From the per-COMID cache, if available
+    3.2 Otherwise from the NLDI, in small batches sent concurrently, and added to the cache
+4.0 Export, only if any node was added, removed or changed
+
+Adding one node therefore costs one basin request. The NLDI client can be replaced
+(e.g., with a local stand-in for testing); it must provide
+get_basins(comids, fsource='comid', split_catchment=True) returning a GeoDataFrame indexed by comid.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from directories import SPATIAL_DIR, CACHE_DIR
+from instrumentation import span
+
+# Constants
+# As in Get_node_basin_geometry.ipynb, NLDI (lat/long) geometries are labelled with crs, not reprojected
+crs = 4386
+
+nodes_filename = f'{SPATIAL_DIR}model_components/drb_nodes.csv'
+node_basin_filename = f'{SPATIAL_DIR}DRB_shapefiles/node_basin_geometries.shp'
+basin_cache_dir = f'{CACHE_DIR}nldi_basins/'
+node_basin_columns = ['node', 'lat', 'long', 'comid', 'geometry']
+
+
+def get_basin_cache_filename(comid, split_catchment=True, cache_dir=basin_cache_dir):
+    """Return the cache filename for the basin of a COMID."""
+    split = '_split' if split_catchment else ''
+    return f'{cache_dir}basin_{comid}{split}.parquet'
+
+
+def fetch_basins(nldi, comids, split_catchment=True):
+    """
+    Requests the basins of a batch of COMIDs from the NLDI.
+
+    Args:
+        nldi: NLDI client (e.g., pynhd.NLDI()).
+        comids (list): COMIDs to request.
+        split_catchment (bool): If True, split the local catchment at the outlet point.
+
+    Returns:
+        gpd.GeoDataFrame: Basin geometry for each COMID, indexed by comid.
+    """
+    with span('request', n_comids=len(comids)):
+        basins = nldi.get_basins([int(c) for c in comids], fsource='comid', split_catchment=split_catchment)
+    basins.index = basins.index.astype(int)
+    basins.index.name = 'comid'
+    return basins.set_crs(crs, allow_override=True)
+
+
+def get_basin_geometries(comids, nldi=None,
+                         split_catchment=True,
+                         cache_dir=basin_cache_dir,
+                         batch_size=4,
+                         n_workers=4):
+    """
+    Gets basin geometries for COMIDs, from the cache where possible and otherwise from the NLDI.
+
+    Args:
+        comids (list): COMIDs.
+        nldi (optional): NLDI client. Defaults to pynhd.NLDI(), created only if a request is needed.
+        split_catchment (bool): If True, split the local catchment at the outlet point.
+        cache_dir (str): Folder for cached basins (one GeoParquet file per COMID).
+        batch_size (int): Number of COMIDs per NLDI request.
+        n_workers (int): Number of concurrent NLDI requests.
+
+    Returns:
+        gpd.GeoSeries: Basin geometry for each unique COMID.
+    """
+    import geopandas as gpd
+
+    comids = list(dict.fromkeys(int(c) for c in comids))
+    missing = [c for c in comids if not os.path.exists(get_basin_cache_filename(c, split_catchment, cache_dir))]
+
+    if missing:
+        if nldi is None:
+            from pynhd import NLDI
+            nldi = NLDI()
+        batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+        print(f'Requesting {len(missing)} basins from the NLDI in {len(batches)} batches...')
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            for basins in executor.map(lambda batch: fetch_basins(nldi, batch, split_catchment), batches):
+                for comid in basins.index:
+                    basins.loc[[comid]].to_parquet(get_basin_cache_filename(comid, split_catchment, cache_dir))
+
+    geometries = {}
+    for c in comids:
+        fname = get_basin_cache_filename(c, split_catchment, cache_dir)
+        if not os.path.exists(fname):
+            raise ValueError(f'No basin returned by the NLDI for COMID {c}.')
+        geometries[c] = gpd.read_parquet(fname).set_crs(crs, allow_override=True).geometry.iloc[0]
+    return gpd.GeoSeries(geometries, crs=crs, name='geometry').rename_axis('comid')
+
+
+def read_node_basin_geometries(filename):
+    """Read node basins from a shapefile or GeoParquet file."""
+    import geopandas as gpd
+
+    if filename.endswith('.parquet'):
+        return gpd.read_parquet(filename)
+    return gpd.read_file(filename)
+
+
+def write_node_basin_geometries(geo_nodes, filename):
+    """Write node basins to a shapefile or GeoParquet file."""
+    if filename.endswith('.parquet'):
+        geo_nodes.to_parquet(filename)
+    else:
+        geo_nodes.to_file(filename)
+
+
+def update_node_basin_geometries(nodes_filename=nodes_filename,
+                                 output_filename=node_basin_filename,
+                                 nldi=None,
+                                 cache_dir=basin_cache_dir,
+                                 **kwargs):
+    """
+    Updates the node basin geometry file for added, removed or changed nodes.
+
+    Args:
+        nodes_filename (str): CSV with name, lat, long and comid for each node.
+        output_filename (str): Node basin file (.shp or .parquet).
+        nldi (optional): NLDI client. Defaults to pynhd.NLDI().
+        cache_dir (str): Folder for cached basins.
+        **kwargs: Passed to get_basin_geometries() (e.g., batch_size, n_workers).
+
+    Returns:
+        gpd.GeoDataFrame: Basin geometry for each node.
+    """
+    import geopandas as gpd
+
+    nodes = pd.read_csv(nodes_filename, sep=',', index_col=0)
+    nodes.index.name = 'node'
+    nodes['comid'] = nodes['comid'].astype(int)
+
+    ### Re-use geometries of unchanged nodes
+    existing = None
+    if os.path.exists(output_filename):
+        existing = read_node_basin_geometries(output_filename).set_crs(crs, allow_override=True).set_index('node')
+        existing['comid'] = existing['comid'].astype(int)
+    unchanged = [] if existing is None else [node for node in nodes.index
+                                             if node in existing.index and nodes.loc[node, 'comid'] == existing.loc[node, 'comid']]
+    changed = [node for node in nodes.index if node not in unchanged]
+    removed = [] if existing is None else [node for node in existing.index if node not in nodes.index]
+
+    if existing is not None and not changed and not removed:
+        print(f'All {len(nodes)} node basins are up to date in {output_filename}')
+        return existing.loc[nodes.index].reset_index()[node_basin_columns]
+
+    geometries = {} if existing is None else existing.loc[unchanged, 'geometry'].to_dict()
+    basins = get_basin_geometries(nodes.loc[changed, 'comid'].values, nldi=nldi, cache_dir=cache_dir, **kwargs)
+    for node in changed:
+        geometries[node] = basins[nodes.loc[node, 'comid']]
+
+    geo_nodes = gpd.GeoDataFrame(nodes.reset_index(), geometry=[geometries[node] for node in nodes.index], crs=crs)
+    geo_nodes = geo_nodes[node_basin_columns]
+    write_node_basin_geometries(geo_nodes, output_filename)
+    print(f'Updated {len(changed)} and removed {len(removed)} node basins in {output_filename}')
+    return geo_nodes
+
+
+def main():
+    with span('node_basins'):
+        update_node_basin_geometries()
+
+
+if __name__ == '__main__':
+    main()
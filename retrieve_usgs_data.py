@@ -1,31 +1,22 @@
 """
-Queries streamflow data from the USGS NWIS, 
-identifies data within the DRB and removes streamflows which are labeled as being 
+Queries streamflow data from the USGS NWIS,
+identifies data within the DRB and removes streamflows which are labeled as being
 downstream of reservoirs.
 
-Data is retrieved from 1900 onward to the present. 
+Data is retrieved from 1900 onward to the present.
 """
 
-import sys
-import itertools
-import numpy as np
 import pandas as pd
-import geopandas as gpd
 
-from pygeohydro import NWIS
-import pynhd as pynhd
+from site_match_registry import get_site_match_registry
+from dataset_io import write_flow_csv
+from instrumentation import span
 
 OUTPUT_DIR = './datasets/USGS/'
 PYWRDRB_DIR = '../Pywr-DRB/'
-sys.path.append(PYWRDRB_DIR)
-from pywrdrb.pywr_drb_node_data import obs_site_matches, obs_pub_site_matches
-pywrdrb_obs_gauges = [x for x in obs_pub_site_matches.values() if x is not None]
-pywrdrb_obs_gauges = list(itertools.chain.from_iterable(pywrdrb_obs_gauges))
-
-print(f'PywrDRB has {pywrdrb_obs_gauges} gauges.')
 
 export_to_pywrdrb = False
- 
+
 ### Setup
 dates = ('1900-01-01', '2022-12-31')
 
@@ -33,17 +24,22 @@ filter_drb = True
 bbox = (-77.8, 37.5, -74.0, 44.0)
 boundary = 'drb' if filter_drb else 'regional'
 
+# Specific characteristics of interest, for now we only want reservoir information
+reservoir_characteristics = ['CAT_NID_STORAGE2013', 'CAT_NDAMS2013', 'CAT_MAJOR2013', 'CAT_NORM_STORAGE2013']
+TOT_reservoir_characteristics = ['TOT_NID_STORAGE2013', 'TOT_NDAMS2013', 'TOT_MAJOR2013', 'TOT_NORM_STORAGE2013']
 
-def filter_drb_sites(x, 
+
+def filter_drb_sites(x,
                      sdir = f'{PYWRDRB_DIR}/DRB_spatial/DRB_shapefiles'):
     """Filters USGS gauge data to remove gauges outside the DRB boundary.
 
     Args:
-        x (pd.DataFrame): A dataframe with gauges including columns "long" and "lat" with location data. 
+        x (pd.DataFrame): A dataframe with gauges including columns "long" and "lat" with location data.
         sdir (str, optional) The location of the folder containing the DRB shapefile: drb_bnd_polygon.shp
     Returns:
         pd.DataFrame: Dataframe containing gauge data, for gauges within the DRB boundary
     """
+    import geopandas as gpd
     crs = 4386
 
     drb_boarder = gpd.read_file(f'{sdir}/drb_bnd_polygon.shp')
@@ -53,120 +49,184 @@ def filter_drb_sites(x,
     return x_filtered
 
 
+def retrieve_pywrdrb_gauge_flows(stations, dates=dates):
+    """
+    Requests daily streamflow (cms) for Pywr-DRB gauges from the NWIS.
 
-### Request and save specific pywrdrb gauge flows
-## Get historic observations that exist (including management)
-pywrdrb_stations = []
-for node, sites in obs_site_matches.items():
-    if sites:
-        for s in sites:
-            pywrdrb_stations.append(s)
-
-nwis = NWIS()
-Q_pywrdrb = nwis.get_streamflow(pywrdrb_stations, dates)
-Q_pywrdrb.index = pd.to_datetime(Q_pywrdrb.index.date)
-
-for s in pywrdrb_stations:
-    assert(f'USGS-{s}' in Q_pywrdrb.columns),'PywrDRB gauge {s} is missing from the data.'
-
-# Export
-Q_pywrdrb.to_csv(f'{OUTPUT_DIR}/streamflow_daily_usgs_cms.csv', sep=',')
-if export_to_pywrdrb:
-    Q_pywrdrb.to_csv(f'{PYWRDRB_DIR}/input_data/usgs_gages/streamflow_daily_usgs_1950_2022_cms.csv', sep=',')
-
-
-
-### Unmanaged flows: For the prediction at ungauged or managed locations
-### we want only unmanaged flow data.  The following retrieves, filters, and exports unmanaged flows across the basin. 
-### 1: Query USGS data ###
-# Use the national water info system (NWIS)
-nwis = NWIS()
-print("Initialized")
-
-# Send a query_request for all gage info in the bbox
-query_request = {"bBox": ",".join(f"{b:.06f}" for b in bbox),
-                    "hasDataTypeCd": "dv",
-                    "outputDataTypeCd": "dv"}
-
-query_result = nwis.get_info(query_request, expanded= False, nhd_info= False)
-
-# Filter non-streamflow stations
-query_result = query_result.query("site_tp_cd in ('ST','ST-TS')")
-query_result = query_result[query_result.parm_cd == '00060']  # https://help.waterdata.usgs.gov/parameter_cd?group_cd=PHY
-query_result = query_result.reset_index(drop = True)
-
-stations = list(set(query_result.site_no.tolist()))
-print(f"Gage data gathered, {len(stations)} USGS streamflow gauges found in date range.")
-
-
-### Location data (long,lat)
-gage_data = query_result[['site_no', 'dec_long_va', 'dec_lat_va', 'begin_date', 'end_date']]
-gage_data.columns = ['site_no', 'long', 'lat', 'begin_date', 'end_date']
-gage_data.index = gage_data['site_no']
-gage_data= gage_data.drop('site_no', axis=1)
-
-
-### 2: Filter data ###
-## Remove sites outside the DRB boundary
-if filter_drb:
-    gage_data = filter_drb_sites(gage_data)
-gage_data = gage_data[~gage_data.index.duplicated(keep = 'first')]
-stations = gage_data.index.to_list()
-print(f'{len(stations)} streamflow gauges after filtering.')
-
-## Remove managed sites
-# To do this, wee will use NLDI attributes to find managed sites
-# Initialize the NLDI database
-nldi = pynhd.NLDI()
-
-# Get COMID for each gauge
-gage_comid = pd.DataFrame(index = gage_data.index, columns=['comid', 'reachcode', 'comid-long', 'comid-lat'])
-for st in gage_data.index:
-    coords = (gage_data.loc[st, ['long']].values[0], gage_data.loc[st, ['lat']].values[0])
-    try:
-        found = nldi.comid_byloc(coords)
-        gage_comid.loc[st, ['comid']] = found.comid.values[0]
-        gage_comid.loc[st, ['reachcode']] = found.reachcode.values[0]
-        gage_comid.loc[st, ['comid-long']] = found.geometry.x[0]
-        gage_comid.loc[st, ['comid-lat']] = found.geometry.y[0]
-    except:
-        print(f'Error getting COMID for site {st}')
-        
-gage_data = pd.concat([gage_data, gage_comid], axis=1)
-gage_data = gage_data.dropna(axis=0)
-gage_data["comid"] = gage_data["comid"].astype('int')
+    Args:
+        stations (list): USGS site numbers.
+        dates (tuple): Start and end date.
 
-# Specific characteristics of interest, for now we only want reservoir information
-all_characteristics = nldi.valid_characteristics
-reservoir_characteristics = ['CAT_NID_STORAGE2013', 'CAT_NDAMS2013', 'CAT_MAJOR2013', 'CAT_NORM_STORAGE2013']
-TOT_reservoir_characteristics = ['TOT_NID_STORAGE2013', 'TOT_NDAMS2013', 'TOT_MAJOR2013', 'TOT_NORM_STORAGE2013']
+    Returns:
+        pd.DataFrame: Streamflow with 'USGS-{site_no}' columns.
+    """
+    from pygeohydro import NWIS
+
+    nwis = NWIS()
+    with span('usgs/load', n_sites=len(stations)) as s:
+        Q_pywrdrb = nwis.get_streamflow(stations, dates)
+        s.set_shape(Q_pywrdrb)
+    Q_pywrdrb.index = pd.to_datetime(Q_pywrdrb.index.date)
+
+    for site in stations:
+        assert(f'USGS-{site}' in Q_pywrdrb.columns),f'PywrDRB gauge {site} is missing from the data.'
+    return Q_pywrdrb
+
+
+def query_gauges(bbox=bbox, filter_drb=filter_drb):
+    """
+    Queries the NWIS for streamflow gauges with daily data in the bbox.
+
+    Args:
+        bbox (tuple): Bounding box (west, south, east, north).
+        filter_drb (bool): If True, remove gauges outside the DRB boundary.
+
+    Returns:
+        pd.DataFrame: Gauge long, lat, begin_date and end_date, indexed by site_no.
+    """
+    from pygeohydro import NWIS
+
+    # Use the national water info system (NWIS)
+    nwis = NWIS()
+    print("Initialized")
+
+    # Send a query_request for all gage info in the bbox
+    query_request = {"bBox": ",".join(f"{b:.06f}" for b in bbox),
+                        "hasDataTypeCd": "dv",
+                        "outputDataTypeCd": "dv"}
+
+    with span('usgs/query') as s:
+        query_result = nwis.get_info(query_request, expanded= False, nhd_info= False)
+        s.set_shape(query_result)
+
+    # Filter non-streamflow stations
+    query_result = query_result.query("site_tp_cd in ('ST','ST-TS')")
+    query_result = query_result[query_result.parm_cd == '00060']  # https://help.waterdata.usgs.gov/parameter_cd?group_cd=PHY
+    query_result = query_result.reset_index(drop = True)
+
+    stations = list(set(query_result.site_no.tolist()))
+    print(f"Gage data gathered, {len(stations)} USGS streamflow gauges found in date range.")
+
+    ### Location data (long,lat)
+    gage_data = query_result[['site_no', 'dec_long_va', 'dec_lat_va', 'begin_date', 'end_date']]
+    gage_data.columns = ['site_no', 'long', 'lat', 'begin_date', 'end_date']
+    gage_data.index = gage_data['site_no']
+    gage_data= gage_data.drop('site_no', axis=1)
+
+    ## Remove sites outside the DRB boundary
+    if filter_drb:
+        with span('usgs/clip') as s:
+            gage_data = filter_drb_sites(gage_data)
+            s.set_shape(gage_data)
+    gage_data = gage_data[~gage_data.index.duplicated(keep = 'first')]
+    print(f'{len(gage_data)} streamflow gauges after filtering.')
+    return gage_data
+
+
+def add_gauge_comids(gage_data, nldi):
+    """
+    Adds the NHDPlus COMID and reachcode of each gauge, dropping gauges where none is found.
+
+    Args:
+        gage_data (pd.DataFrame): Gauge long and lat, indexed by site_no.
+        nldi (pynhd.NLDI): NLDI client.
 
-## Use the station IDs to retrieve basin information
-tot_chars = nldi.getcharacteristic_byid(gage_data.comid, fsource = 'comid', 
-                                        char_type= "tot", char_ids= TOT_reservoir_characteristics)
-local_chars = nldi.getcharacteristic_byid(gage_data.comid, fsource = 'comid',
-                                            char_type= "local", char_ids= reservoir_characteristics)
-
-cat_chars = pd.concat([tot_chars, local_chars], axis=1)
-
-cat = cat_chars
-cat['comid'] = cat.index
-print(f'Found characteristics for {cat_chars.shape} of {gage_data.shape} basins.')
-
-
-## Remove sites that have reservoirs upstream
-gage_with_cat_chars = pd.merge(gage_data, cat, on = "comid")
-gage_with_cat_chars.index = gage_data.index
-managed_stations = []
-for i, st in enumerate(gage_data.index):
-    if gage_with_cat_chars.loc[st, TOT_reservoir_characteristics].sum() > 0:
-        if st not in pywrdrb_obs_gauges:
-            managed_stations.append(st)
-    
-# Take data from just unmanaged
-unmanaged_gauge_data = gage_data.drop(managed_stations)
-print(f'{len(managed_stations)} of the {gage_data.shape[0]} gauge stations are managed and being removed.')
-
-# Export gage_data
-gage_data.to_csv(f'{OUTPUT_DIR}/{boundary}_all_usgs_metadata.csv', sep=',')
-unmanaged_gauge_data.to_csv(f'{OUTPUT_DIR}/{boundary}_unmanaged_usgs_metadata.csv', sep=',')
+    Returns:
+        pd.DataFrame: gage_data with comid, reachcode, comid-long and comid-lat columns.
+    """
+    gage_comid = pd.DataFrame(index = gage_data.index, columns=['comid', 'reachcode', 'comid-long', 'comid-lat'])
+    with span('usgs/comids', n_sites=len(gage_data)):
+        for st in gage_data.index:
+            coords = (gage_data.loc[st, ['long']].values[0], gage_data.loc[st, ['lat']].values[0])
+            try:
+                found = nldi.comid_byloc(coords)
+                gage_comid.loc[st, ['comid']] = found.comid.values[0]
+                gage_comid.loc[st, ['reachcode']] = found.reachcode.values[0]
+                gage_comid.loc[st, ['comid-long']] = found.geometry.x[0]
+                gage_comid.loc[st, ['comid-lat']] = found.geometry.y[0]
+            except:
+                print(f'Error getting COMID for site {st}')
+
+    gage_data = pd.concat([gage_data, gage_comid], axis=1)
+    gage_data = gage_data.dropna(axis=0)
+    gage_data["comid"] = gage_data["comid"].astype('int')
+    return gage_data
+
+
+def get_managed_stations(gage_data, nldi, keep_stations=()):
+    """
+    Finds gauges with reservoirs upstream, using NLDI basin characteristics.
+
+    Args:
+        gage_data (pd.DataFrame): Gauge data with a comid column, indexed by site_no.
+        nldi (pynhd.NLDI): NLDI client.
+        keep_stations (list): Gauges which are never labelled as managed (e.g., Pywr-DRB gauges).
+
+    Returns:
+        list: Managed site numbers.
+    """
+    ## Use the station IDs to retrieve basin information
+    with span('usgs/characteristics', n_sites=len(gage_data)):
+        tot_chars = nldi.getcharacteristic_byid(gage_data.comid, fsource = 'comid',
+                                                char_type= "tot", char_ids= TOT_reservoir_characteristics)
+        local_chars = nldi.getcharacteristic_byid(gage_data.comid, fsource = 'comid',
+                                                    char_type= "local", char_ids= reservoir_characteristics)
+
+    cat_chars = pd.concat([tot_chars, local_chars], axis=1)
+
+    cat = cat_chars
+    cat['comid'] = cat.index
+    print(f'Found characteristics for {cat_chars.shape} of {gage_data.shape} basins.')
+
+    ## Remove sites that have reservoirs upstream
+    gage_with_cat_chars = pd.merge(gage_data, cat, on = "comid")
+    gage_with_cat_chars.index = gage_data.index
+    managed_stations = []
+    for i, st in enumerate(gage_data.index):
+        if gage_with_cat_chars.loc[st, TOT_reservoir_characteristics].sum() > 0:
+            if st not in keep_stations:
+                managed_stations.append(st)
+    return managed_stations
+
+
+def main():
+    import pynhd as pynhd
+
+    registry = get_site_match_registry()
+    pywrdrb_obs_gauges = registry.get_read_list('obs_pub')
+    print(f'PywrDRB has {pywrdrb_obs_gauges} gauges.')
+
+    ### Request and save specific pywrdrb gauge flows
+    ## Get historic observations that exist (including management)
+    pywrdrb_stations = registry.get_read_list('obs', roles=('node',))
+    Q_pywrdrb = retrieve_pywrdrb_gauge_flows(pywrdrb_stations, dates)
+
+    # Export
+    with span('usgs'):
+        write_flow_csv(Q_pywrdrb, f'{OUTPUT_DIR}/streamflow_daily_usgs_1950_2022_cms.csv')
+        if export_to_pywrdrb:
+            write_flow_csv(Q_pywrdrb, f'{PYWRDRB_DIR}/input_data/usgs_gages/streamflow_daily_usgs_1950_2022_cms.csv')
+
+    ### Unmanaged flows: For the prediction at ungauged or managed locations
+    ### we want only unmanaged flow data.  The following retrieves, filters, and exports unmanaged flows across the basin.
+    ### 1: Query USGS data, and 2: Filter data ###
+    gage_data = query_gauges(bbox, filter_drb)
+
+    ## Remove managed sites
+    # To do this, wee will use NLDI attributes to find managed sites
+    # Initialize the NLDI database
+    nldi = pynhd.NLDI()
+    gage_data = add_gauge_comids(gage_data, nldi)
+    managed_stations = get_managed_stations(gage_data, nldi, keep_stations=pywrdrb_obs_gauges)
+
+    # Take data from just unmanaged
+    unmanaged_gauge_data = gage_data.drop(managed_stations)
+    print(f'{len(managed_stations)} of the {gage_data.shape[0]} gauge stations are managed and being removed.')
+
+    # Export gage_data
+    gage_data.to_csv(f'{OUTPUT_DIR}/{boundary}_all_usgs_metadata.csv', sep=',')
+    unmanaged_gauge_data.to_csv(f'{OUTPUT_DIR}/{boundary}_unmanaged_usgs_metadata.csv', sep=',')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Registry of the dataset IDs matched to each Pywr-DRB node, across all data sources.
+
+The site match dicts in pywr_drb_node_data.py are combined once into a frozen SiteMatchRegistry,
+with:
+- A forward index: node -> source -> role -> IDs
+- An inverse index: (source, ID) -> (node, role) pairs
+
+Each extraction script gets its exact, deduplicated list of IDs to read from get_read_list(),
+in a stable order (node order of the match dicts, then role order). find_conflicts() reports nodes
+where two sources (or roles) are matched to different IDs, e.g., WRF-Hydro lake/reach IDs vs NWM.
+
+Roles:
+- 'node': flow at the node (obs, obs_pub, nhmv10, nwmv21, weap)
+- 'reach' / 'lake': WRF-Hydro node flow from the reach (lakes off) or lake inflow outputs
+- 'scaling_gauge' / 'scaling_hru': gauge and total catchment IDs used for inflow scaling
+
+Example:
+    registry = get_site_match_registry()
+    registry.get_read_list('wrf', roles=('reach', 'scaling_gauge'))
+    registry.find_conflicts('wrf', 'nwmv21')
+"""
+
+from functools import lru_cache
+from types import MappingProxyType
+
+from pywr_drb_node_data import obs_site_matches, obs_pub_site_matches, nhm_site_matches, nwm_site_matches
+from pywr_drb_node_data import wrf_hydro_site_matches, pywrdrb_wrf_hydro_flowtypes, scaling_site_matches
+from pywr_drb_node_data import WEAP_29June2023_gridmet_NatFlows_matches
+
+
+class SiteMatchRegistry:
+    """
+    Frozen forward and inverse indices of node/dataset ID matches.
+
+    Args:
+        matches (dict): For each source, a dict of {role: {node: IDs}}. IDs may be None or empty.
+    """
+
+    def __init__(self, matches):
+        forward = {}
+        inverse = {}
+        for source, roles in matches.items():
+            for role, site_matches in roles.items():
+                for node, ids in site_matches.items():
+                    ids = tuple(dict.fromkeys(str(i) for i in ids)) if ids else ()
+                    if not ids:
+                        continue
+                    forward.setdefault(node, {}).setdefault(source, {})[role] = ids
+                    for site_id in ids:
+                        inverse.setdefault((source, site_id), []).append((node, role))
+
+        self.sources = tuple(matches.keys())
+        self.roles = MappingProxyType({source: tuple(roles.keys()) for source, roles in matches.items()})
+        self.forward = MappingProxyType({
+            node: MappingProxyType({source: MappingProxyType(roles) for source, roles in sources.items()})
+            for node, sources in forward.items()})
+        self.inverse = MappingProxyType({key: tuple(nodes) for key, nodes in inverse.items()})
+
+    @property
+    def nodes(self):
+        """Return all nodes with at least one match, in registry order."""
+        return tuple(self.forward.keys())
+
+    def get_ids(self, node, source, roles=None):
+        """
+        Gets the IDs matched to a node.
+
+        Args:
+            node (str): Pywr-DRB node.
+            source (str): Data source (e.g., 'nhmv10').
+            roles (tuple, optional): Roles to include. Defaults to all roles of the source.
+
+        Returns:
+            tuple: Deduplicated IDs.
+        """
+        node_roles = self.forward.get(node, {}).get(source, {})
+        roles = self.roles[source] if roles is None else roles
+        return tuple(dict.fromkeys(i for role in roles for i in node_roles.get(role, ())))
+
+    def get_node_matches(self, source, role='node'):
+        """Return a {node: IDs} dict for one source and role."""
+        return {node: sources[source][role] for node, sources in self.forward.items()
+                if role in sources.get(source, {})}
+
+    def get_read_list(self, source, roles=None):
+        """
+        Gets the deduplicated IDs to read from a source, in a stable order.
+
+        Args:
+            source (str): Data source (e.g., 'wrf').
+            roles (tuple, optional): Roles to include. Defaults to all roles of the source.
+
+        Returns:
+            list: IDs in node order, then role order.
+        """
+        read_list = {}
+        for node in self.nodes:
+            read_list.update(dict.fromkeys(self.get_ids(node, source, roles)))
+        return list(read_list)
+
+    def get_nodes(self, source, site_id):
+        """Return the (node, role) pairs matched to an ID of a source."""
+        return self.inverse.get((source, str(site_id)), ())
+
+    def get_shared_ids(self, source):
+        """Return the IDs of a source matched to more than one node, with their (node, role) pairs."""
+        return {site_id: nodes for (s, site_id), nodes in self.inverse.items()
+                if s == source and len({node for node, _ in nodes}) > 1}
+
+    def find_conflicts(self, source, other_source, roles=None, other_roles=None):
+        """
+        Finds nodes where two sources (or two sets of roles) are matched to different IDs.
+
+        Args:
+            source (str): First data source.
+            other_source (str): Second data source.
+            roles (tuple, optional): Roles of the first source. Defaults to all.
+            other_roles (tuple, optional): Roles of the second source. Defaults to all.
+
+        Returns:
+            dict: For each conflicting node, a tuple of (IDs of source, IDs of other_source).
+        """
+        conflicts = {}
+        for node in self.nodes:
+            ids = self.get_ids(node, source, roles)
+            other_ids = self.get_ids(node, other_source, other_roles)
+            if ids and other_ids and set(ids) != set(other_ids):
+                conflicts[node] = (ids, other_ids)
+        return conflicts
+
+
+def get_scaling_matches(prefix, suffix):
+    """Return the {reservoir: IDs} dict for one scaling_site_matches key (e.g., 'wrf_gauges')."""
+    return {reservoir: ids[f'{prefix}_{suffix}'] for reservoir, ids in scaling_site_matches.items()
+            if f'{prefix}_{suffix}' in ids}
+
+
+@lru_cache(maxsize=None)
+def get_site_match_registry():
+    """Return the SiteMatchRegistry for the dicts in pywr_drb_node_data.py, built once per process."""
+    wrf_matches = {flowtype: {node: ids for node, ids in wrf_hydro_site_matches.items()
+                              if pywrdrb_wrf_hydro_flowtypes[node] == flowtype}
+                   for flowtype in ('reaches', 'lakes')}
+    matches = {
+        'obs': {'node': obs_site_matches,
+                'scaling_gauge': get_scaling_matches('obs', 'gauges')},
+        'obs_pub': {'node': obs_pub_site_matches},
+        'nhmv10': {'node': nhm_site_matches,
+                   'scaling_gauge': get_scaling_matches('nhmv10', 'gauges'),
+                   'scaling_hru': get_scaling_matches('nhmv10', 'hru')},
+        'nwmv21': {'node': nwm_site_matches,
+                   'scaling_gauge': get_scaling_matches('nwmv21', 'gauges'),
+                   'scaling_hru': get_scaling_matches('nwmv21', 'hru')},
+        'wrf': {'reach': wrf_matches['reaches'],
+                'lake': wrf_matches['lakes'],
+                'scaling_gauge': get_scaling_matches('wrf', 'gauges'),
+                'scaling_hru': get_scaling_matches('wrf', 'hru')},
+        'weap': {'node': WEAP_29June2023_gridmet_NatFlows_matches},
+    }
+    return SiteMatchRegistry(matches)
+
+
+def main():
+    registry = get_site_match_registry()
+    for source in registry.sources:
+        print(f'{source}: {len(registry.get_read_list(source))} IDs to read')
+        shared = registry.get_shared_ids(source)
+        if shared:
+            print(f'  IDs matched to more than one node: {shared}')
+
+    print('WRF-Hydro IDs which differ from NWM node IDs:')
+    for node, (wrf_ids, nwm_ids) in registry.find_conflicts('wrf', 'nwmv21', roles=('reach', 'lake'), other_roles=('node',)).items():
+        print(f'  {node}: wrf {wrf_ids}, nwm {nwm_ids}')
+
+
+if __name__ == '__main__':
+    main()
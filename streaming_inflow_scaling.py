@@ -0,0 +1,156 @@
+"""
+Incremental inflow scaling for daily USGS observations.
+
+generate_scaled_inflows() in inflow_scaling_regression.py scales a full date range
+at once. The StreamingInflowScaler produces the same scaled reservoir inflows one day
+(or a small batch of days) at a time. It keeps the rolling mean window of unscaled inflow
+for each reservoir, and the seasonal regression coefficients, as its state. The state can be
+saved to and restored from a JSON checkpoint, so that a daily job does not need to re-read
+the historic record.
+
+Example:
+    scaler = StreamingInflowScaler.from_linear_results(linear_results, window=3)
+    scaler.update('2023-01-01', {'01423000': 250.0, ...})
+    scaler.save_checkpoint('scaler_state.json')
+"""
+
+import json
+import math
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from inflow_scaling_regression import scaling_site_matches, quarters, get_quarter
+from instrumentation import span
+
+
+class StreamingInflowScaler:
+    """
+    Holds the rolling-window state and seasonal scaling coefficients for each reservoir,
+    and scales new daily gauge flows in O(1) time per day.
+
+    Args:
+        coefs (dict): Regression [const, slope] for each reservoir and quarter.
+        window (int): Number of days to use for rolling mean inflow.
+        reservoirs (list, optional): Reservoirs to scale. Defaults to all reservoirs in coefs.
+    """
+
+    def __init__(self, coefs, window=3, reservoirs=None):
+        self.window = int(window)
+        self.reservoirs = list(coefs.keys()) if reservoirs is None else list(reservoirs)
+        self.coefs = {r: {q: [float(c) for c in coefs[r][q]] for q in quarters} for r in self.reservoirs}
+        self.inflow_gauges = {r: scaling_site_matches[r]['obs_gauges'] for r in self.reservoirs}
+        self.buffers = {r: deque(maxlen=self.window) for r in self.reservoirs}
+        self.last_date = None
+
+    @classmethod
+    def from_linear_results(cls, linear_results, window=3):
+        """
+        Creates a scaler from the fit models of train_all_inflow_scale_regression_models().
+
+        Args:
+            linear_results (dict): Fit models for each reservoir and quarter.
+            window (int): Number of days to use for rolling mean inflow.
+
+        Returns:
+            StreamingInflowScaler: New scaler with empty rolling windows.
+        """
+        coefs = {r: {q: np.asarray(lrrs[q].params) for q in quarters} for r, lrrs in linear_results.items()}
+        return cls(coefs, window=window)
+
+    def update(self, date, gauge_flows):
+        """
+        Adds one day of observed gauge flows and returns the scaled reservoir inflows for that day.
+
+        Args:
+            date (str or pd.Timestamp): Date of the observations. Must be after the last date. Days skipped
+                since the last date are added to the rolling windows as missing (NaN), so the rolling
+                mean only uses days within the window, as for missing days in generate_scaled_inflows().
+            gauge_flows (dict or pd.Series): Observed flow (MGD) for each USGS site number.
+                If any gauge of a reservoir is missing or NaN, its inflow is NaN, as in generate_scaled_inflows(),
+                and the rolling mean skips that day.
+
+        Returns:
+            pd.Series: Scaled inflow (MGD) for each reservoir.
+        """
+        date = pd.Timestamp(date)
+        if self.last_date is not None and date <= self.last_date:
+            raise ValueError(f'Date {date.date()} is not after the last processed date {self.last_date.date()}.')
+
+        n_skipped = 0 if self.last_date is None else (date - self.last_date).days - 1
+        quarter = get_quarter(date.month)
+        scaled_inflows = {}
+        for reservoir in self.reservoirs:
+            flows = [gauge_flows.get(site, np.nan) for site in self.inflow_gauges[reservoir]]
+            flows = [np.nan if flow is None else float(flow) for flow in flows]
+            unscaled_inflow = sum(flows)
+
+            buffer = self.buffers[reservoir]
+            buffer.extend([math.nan]*min(n_skipped, self.window))
+            buffer.append(unscaled_inflow)
+            window_flows = [flow for flow in buffer if not math.isnan(flow)]
+            rolling_mean = sum(window_flows) / len(window_flows) if window_flows else math.nan
+
+            # No flow in the window: log(0) is undefined, and the (zero) inflow is left unscaled
+            const, slope = self.coefs[reservoir][quarter]
+            scale = const + slope * math.log(rolling_mean) if rolling_mean > 0 else 1.0
+            scale = 1.0 if scale < 1 else scale
+            scaled_inflows[reservoir] = unscaled_inflow * scale
+
+        self.last_date = date
+        return pd.Series(scaled_inflows, name=date)
+
+    def update_batch(self, gauge_flows):
+        """
+        Adds a batch of daily observed gauge flows.
+
+        Args:
+            gauge_flows (pd.DataFrame): Observed flows (MGD) with a date index and USGS site number columns.
+
+        Returns:
+            pd.DataFrame: Scaled inflows (MGD) for each date and reservoir.
+        """
+        with span('scale') as s:
+            gauge_flows = gauge_flows.sort_index()
+            scaled_inflows = pd.DataFrame([self.update(date, row) for date, row in gauge_flows.iterrows()],
+                                          columns=self.reservoirs)
+            s.set_shape(scaled_inflows)
+        return scaled_inflows
+
+    def get_state(self):
+        """Return the scaler state as a JSON-serializable dict."""
+        return {'window': self.window,
+                'reservoirs': self.reservoirs,
+                'coefs': self.coefs,
+                'buffers': {r: list(self.buffers[r]) for r in self.reservoirs},
+                'last_date': None if self.last_date is None else self.last_date.strftime('%Y-%m-%d')}
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Restores a scaler from get_state().
+
+        Args:
+            state (dict): Scaler state.
+
+        Returns:
+            StreamingInflowScaler: Restored scaler.
+        """
+        scaler = cls(state['coefs'], window=state['window'], reservoirs=state['reservoirs'])
+        for reservoir, values in state['buffers'].items():
+            scaler.buffers[reservoir].extend(values)
+        if state['last_date'] is not None:
+            scaler.last_date = pd.Timestamp(state['last_date'])
+        return scaler
+
+    def save_checkpoint(self, filename):
+        """Save the scaler state to a JSON file."""
+        with span('export', filename=filename), open(filename, 'w') as f:
+            json.dump(self.get_state(), f, indent=2)
+
+    @classmethod
+    def load_checkpoint(cls, filename):
+        """Load a scaler from a JSON file written by save_checkpoint()."""
+        with span('load', filename=filename), open(filename, 'r') as f:
+            return cls.from_state(json.load(f))
@@ -0,0 +1,336 @@
+"""
+Generates ensembles of synthetic daily inflows at the Pywr-DRB nodes, using the
+Kirsch-Nowak method:
+1. Monthly flows: historical monthly flows are log-transformed and standardized for each
+   month and node. Each synthetic year draws a historical year for each month (Kirsch et al., 2013).
+   The same draws are used at all nodes, so the cross-site correlation is kept. The correlation between
+   months is restored by multiplying each node's draws by the Cholesky factor of its historical
+   month-to-month correlation. A second factor, for years shifted by 6 months, keeps the Dec-Jan correlation.
+2. Daily flows: each synthetic month is disaggregated with the daily pattern of one of its K nearest
+   historical months (Nowak et al., 2010), compared on the standardized monthly flows of all nodes.
+   The same historical month is used at all nodes.
+
+The historical flows are the NHMv10 node flows, with the scaled reservoir inflows
+(scaled_inflows_{donor_model}) at the reservoirs where they are available. Synthetic years have
+365 days (Feb 29 is dropped).
+
+Realizations are generated in worker processes, in chunks. Each realization has its own random
+generator, seeded by (seed, realization), so the ensemble does not depend on the number of workers.
+Workers write their realizations directly into one memory-mapped (realization x day x node) array
+(see dataset_io.create_ensemble_array()), which is renamed into place when all are done.
+
+Usage:
+    python synthetic_generator.py --n-realizations 1000 --n-years 70 --seed 1
+"""
+
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from pywr_drb_node_data import nhm_site_matches
+from dataset_io import read_flow_dataset, create_ensemble_array, open_ensemble_array, commit_ensemble_array, discard_ensemble_array
+from instrumentation import span
+
+OUTPUT_DIR = './datasets/synthetic/'
+nhm_flow_dataset = './datasets/NHMv10/csv/streamflow_daily_nhmv10_mgd'
+scaled_inflow_dataset = './datasets/Hybrid/scaled_inflows_{donor_model}'
+
+N_REALIZATIONS = 1000
+N_YEARS = 70
+START_DATE = '2000-01-01'
+SEED = 1
+
+# Realizations generated per worker task
+CHUNK_SIZE = 25
+
+# Monthly flows are floored at this value (MGD) before the log transform
+MIN_MONTHLY_FLOW = 1e-3
+
+days_in_month = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+month_starts = np.concatenate([[0], np.cumsum(days_in_month)[:-1]])
+day_month = np.repeat(np.arange(12), days_in_month)
+
+
+def load_historic_flows(donor_model='wrf'):
+    """
+    Loads the historical node flows: NHMv10 node flows, with the scaled reservoir inflows
+    replacing the NHM flows at the scaled reservoirs (on the dates both are available).
+
+    Args:
+        donor_model (str): Donor model of the scaled inflows (see inflow_scaling_regression.py).
+
+    Returns:
+        pd.DataFrame: Daily flows (MGD) with node columns.
+    """
+    from marginal_inflows import get_node_flows
+
+    flows = get_node_flows(read_flow_dataset(nhm_flow_dataset, dtype='float64'), nhm_site_matches)
+    try:
+        scaled_inflows = read_flow_dataset(scaled_inflow_dataset.format(donor_model=donor_model), dtype='float64')
+    except FileNotFoundError:
+        print(f'No scaled inflows found for {donor_model}; using the NHMv10 flows at all nodes.')
+        return flows
+
+    scaled_inflows.index = pd.to_datetime(scaled_inflows.index)
+    flows = flows.loc[flows.index.isin(scaled_inflows.index)]
+    scaled_nodes = scaled_inflows.columns.intersection(flows.columns)
+    flows.loc[:, scaled_nodes] = scaled_inflows.loc[flows.index, scaled_nodes].values
+    return flows
+
+
+def get_complete_years(flows):
+    """
+    Reshapes daily flows into 365 day years, keeping the calendar years without missing values.
+
+    Args:
+        flows (pd.DataFrame): Daily flows with node columns.
+
+    Returns:
+        np.ndarray: Flows with shape (year, 365, node).
+    """
+    index = pd.DatetimeIndex(flows.index)
+    flows = flows.loc[~((index.month == 2) & (index.day == 29))]
+    years = pd.DatetimeIndex(flows.index).year
+    counts = pd.Series(~flows.isna().any(axis=1).values, index=years).groupby(level=0).sum()
+    complete_years = counts.index[counts == 365]
+    if len(complete_years) < 2:
+        raise ValueError(f'At least 2 complete years of flows are needed; found {len(complete_years)}')
+    values = flows.loc[years.isin(complete_years)].to_numpy(dtype='float64')
+    return values.reshape(len(complete_years), 365, -1)
+
+
+def get_correlation_cholesky(z):
+    """
+    Return the upper Cholesky factor of the month-to-month correlation of each node.
+    Correlation matrices which are not positive definite have their eigenvalues clipped.
+
+    Args:
+        z (np.ndarray): Standardized flows with shape (year, month, node).
+
+    Returns:
+        np.ndarray: Factors U with shape (node, month, month), where corr = U.T @ U.
+    """
+    n_months = z.shape[1]
+    factors = np.empty((z.shape[2], n_months, n_months))
+    for node in range(z.shape[2]):
+        corr = np.corrcoef(z[:, :, node], rowvar=False)
+        corr = np.where(np.isfinite(corr), corr, np.eye(n_months))
+        try:
+            lower = np.linalg.cholesky(corr)
+        except np.linalg.LinAlgError:
+            eigenvalues, eigenvectors = np.linalg.eigh(corr)
+            corr = eigenvectors @ np.diag(np.clip(eigenvalues, 1e-6, None)) @ eigenvectors.T
+            d = np.sqrt(np.diag(corr))
+            lower = np.linalg.cholesky(corr/np.outer(d, d))
+        factors[node] = lower.T
+    return factors
+
+
+def fit_kirsch_nowak_model(flows):
+    """
+    Gets the historical statistics used to generate synthetic flows.
+
+    Args:
+        flows (pd.DataFrame): Historical daily flows with node columns.
+
+    Returns:
+        dict: nodes, monthly log mean and std (month x node), standardized monthly flows z
+            (year x month x node), Cholesky factors of the unshifted and 6 month shifted years,
+            daily fractions of each month (year x 365 x node), and the number of KNN neighbors.
+    """
+    daily = get_complete_years(flows)
+    monthly = np.add.reduceat(daily, month_starts, axis=1)
+    log_monthly = np.log(np.maximum(monthly, MIN_MONTHLY_FLOW))
+    mean = log_monthly.mean(axis=0)
+    std = log_monthly.std(axis=0, ddof=1)
+    std = np.where(std > 0, std, 1.0)
+    z = (log_monthly - mean)/std
+
+    # Daily fractions of each month's flow; months without flow are spread evenly
+    month_totals = monthly[:, day_month, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fractions = np.where(month_totals > 0, daily/month_totals, 1.0/days_in_month[day_month][None, :, None])
+
+    z_shifted = np.concatenate([z[:-1, 6:], z[1:, :6]], axis=1)
+    return {'nodes': list(flows.columns),
+            'mean': mean,
+            'std': std,
+            'z': z,
+            'cholesky': get_correlation_cholesky(z),
+            'cholesky_shifted': get_correlation_cholesky(z_shifted),
+            'fractions': fractions,
+            'n_neighbors': max(1, int(round(np.sqrt(len(z)))))}
+
+
+def generate_monthly_flows(model, n_years, rng):
+    """
+    Generates synthetic monthly flows by Kirsch bootstrapping.
+
+    Args:
+        model (dict): Output from fit_kirsch_nowak_model().
+        n_years (int): Number of synthetic years.
+        rng (np.random.Generator): Random generator.
+
+    Returns:
+        (np.ndarray, np.ndarray): Monthly flows and standardized log flows, both with shape (year, month, node).
+    """
+    z = model['z']
+    # One extra year, since the shifted years span two years
+    draws = rng.integers(0, len(z), size=(n_years + 1, 12))
+    bootstrapped = z[draws, np.arange(12)[None, :], :]
+    bootstrapped_shifted = np.concatenate([bootstrapped[:-1, 6:], bootstrapped[1:, :6]], axis=1)
+
+    # Row vector times upper factor, for each node
+    correlated = np.einsum('ymn,nmk->ykn', bootstrapped, model['cholesky'])
+    correlated_shifted = np.einsum('ymn,nmk->ykn', bootstrapped_shifted, model['cholesky_shifted'])
+
+    # Jan-Jun from the shifted years, which keeps the correlation with the previous Dec
+    z_synthetic = np.concatenate([correlated_shifted[:, 6:], correlated[1:, 6:]], axis=1)
+    return np.exp(z_synthetic*model['std'] + model['mean']), z_synthetic
+
+
+def disaggregate_daily_flows(model, monthly_flows, z_synthetic, rng):
+    """
+    Disaggregates synthetic monthly flows to daily flows, using the daily fractions of
+    a historical month drawn from the K nearest neighbors (Nowak et al., 2010).
+
+    Args:
+        model (dict): Output from fit_kirsch_nowak_model().
+        monthly_flows (np.ndarray): Synthetic monthly flows with shape (year, month, node).
+        z_synthetic (np.ndarray): Standardized log monthly flows with shape (year, month, node).
+        rng (np.random.Generator): Random generator.
+
+    Returns:
+        np.ndarray: Daily flows with shape (year*365, node).
+    """
+    z = model['z']
+    k = min(model['n_neighbors'], len(z))
+
+    # (synthetic year x month x historical year) distances over all nodes
+    distances = ((z_synthetic[:, :, None, :] - z.transpose(1, 0, 2)[None, :, :, :])**2).sum(axis=-1)
+    neighbors = np.argsort(distances, axis=-1)[:, :, :k]
+    weights = 1.0/np.arange(1, k + 1)
+    picks = rng.choice(k, size=z_synthetic.shape[:2], p=weights/weights.sum())
+    historic_years = np.take_along_axis(neighbors, picks[:, :, None], axis=-1)[:, :, 0]
+
+    n_years = len(monthly_flows)
+    day_years = historic_years[:, day_month]
+    daily = model['fractions'][day_years, np.arange(365)[None, :], :] * monthly_flows[:, day_month, :]
+    return daily.reshape(n_years*365, -1)
+
+
+def generate_realization(model, n_years, seed, realization):
+    """
+    Generates one realization of synthetic daily flows.
+
+    Args:
+        model (dict): Output from fit_kirsch_nowak_model().
+        n_years (int): Number of synthetic years.
+        seed (int): Ensemble seed.
+        realization (int): Realization number.
+
+    Returns:
+        np.ndarray: Daily flows with shape (n_years*365, node).
+    """
+    rng = np.random.default_rng([seed, realization])
+    monthly_flows, z_synthetic = generate_monthly_flows(model, n_years, rng)
+    return disaggregate_daily_flows(model, monthly_flows, z_synthetic, rng)
+
+
+_worker_state = {}
+
+
+def _init_worker(model, ensemble_filename):
+    _worker_state['model'] = model
+    _worker_state['values'], _ = open_ensemble_array(ensemble_filename, mode='r+')
+
+
+def _generate_realizations_worker(args):
+    realizations, n_years, seed = args
+    values = _worker_state['values']
+    for realization in realizations:
+        values[realization] = generate_realization(_worker_state['model'], n_years, seed, realization)
+    values.flush()
+    return len(realizations)
+
+
+def generate_synthetic_ensemble(model, filename,
+                                n_realizations=N_REALIZATIONS,
+                                n_years=N_YEARS,
+                                seed=SEED,
+                                start_date=START_DATE,
+                                n_workers=None,
+                                chunk_size=CHUNK_SIZE):
+    """
+    Generates an ensemble of synthetic daily flows in worker processes, streaming each
+    realization into a memory-mapped (realization x day x node) array.
+
+    Args:
+        model (dict): Output from fit_kirsch_nowak_model().
+        filename (str): Ensemble filename, with or without extension.
+        n_realizations (int): Number of realizations.
+        n_years (int): Number of synthetic years in each realization.
+        seed (int): Ensemble seed; realization r uses the generator seeded by (seed, r).
+        start_date (str): Date of the first synthetic day.
+        n_workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int): Realizations generated per worker task.
+
+    Returns:
+        str: Filename of the ensemble .npy file.
+    """
+    create_ensemble_array(filename, model['nodes'], n_realizations, start_date, n_years*365,
+                          calendar='noleap', units='mgd', source='kirsch_nowak', seed=seed)
+    chunks = [(range(i, min(i + chunk_size, n_realizations)), n_years, seed)
+              for i in range(0, n_realizations, chunk_size)]
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(model, filename)) as executor:
+            n_done = 0
+            for n in executor.map(_generate_realizations_worker, chunks):
+                n_done += n
+                print(f'Generated {n_done} of {n_realizations} realizations.')
+    except BaseException:
+        discard_ensemble_array(filename)
+        raise
+    return commit_ensemble_array(filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate Kirsch-Nowak synthetic inflow ensembles for the Pywr-DRB nodes.')
+    parser.add_argument('--n-realizations', type=int, default=N_REALIZATIONS)
+    parser.add_argument('--n-years', type=int, default=N_YEARS)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--donor-model', default='wrf', help='Donor model of the scaled reservoir inflows.')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: number of CPUs).')
+    parser.add_argument('--output', default=f'{OUTPUT_DIR}synthetic_inflows_kirsch_nowak_mgd')
+    args = parser.parse_args(argv)
+
+    with span('synthetic', n_realizations=args.n_realizations, n_years=args.n_years):
+        with span('load') as s:
+            flows = load_historic_flows(args.donor_model)
+            s.set_shape(flows)
+        missing_nodes = list(flows.columns[flows.isna().all()])
+        if missing_nodes:
+            print(f'No historical flows for {missing_nodes}; they are not generated.')
+            flows = flows.drop(columns=missing_nodes)
+
+        with span('fit'):
+            model = fit_kirsch_nowak_model(flows)
+        print(f'Fit to {len(model["z"])} complete years at {len(model["nodes"])} nodes.')
+
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with span('generate') as s:
+            fname = generate_synthetic_ensemble(model, args.output,
+                                                n_realizations=args.n_realizations,
+                                                n_years=args.n_years,
+                                                seed=args.seed,
+                                                n_workers=args.workers)
+            s.set(bytes=os.path.getsize(fname))
+        print(f'Exported synthetic inflow ensemble to {fname}')
+
+
+if __name__ == '__main__':
+    main()
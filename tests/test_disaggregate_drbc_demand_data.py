@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+
+from disaggregate_drbc_demand_data import (calculate_basin_area_fractions, build_area_weight_matrix,
+                                           aggregate_demands_to_nodes)
+
+
+def test_basin_touching_a_node_does_not_spread_missing_years():
+    # node_a covers basin 1; basin 2 only shares its border
+    model_basins = gpd.GeoDataFrame({'node': ['node_a']}, geometry=[box(0, 0, 1, 1)], crs=3857)
+    drbc_basins = gpd.GeoDataFrame({'BASIN_ID': [1, 2]}, geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1)], crs=3857)
+
+    df_areas = calculate_basin_area_fractions(model_basins, drbc_basins)
+    assert list(df_areas.index.get_level_values('DRBC_BASIN_ID')) == [1]
+
+    weights, model_basin_ids, drbc_basin_ids = build_area_weight_matrix(df_areas)
+    df_demand = pd.DataFrame({2000: [10.0, np.nan]}, index=[1, 2])
+    node_demands = aggregate_demands_to_nodes(weights, model_basin_ids, drbc_basin_ids, df_demand)
+    assert node_demands.loc['node_a', 2000] == 10.0
+
+
+def test_collapsed_nodes_are_reported_on_cache_hits(tmp_path, monkeypatch, capsys):
+    import disaggregate_drbc_demand_data as disaggregate
+
+    # delMontague's basin is covered by cannonsville's, so its marginal basin collapses
+    basins = gpd.GeoDataFrame({'node': ['cannonsville', 'delMontague', 'delTrenton']},
+                              geometry=[box(0, 0, 2, 2), box(0, 0, 2, 2), box(0, 0, 4, 4)], crs=3857)
+    basins.to_file(tmp_path / 'node_basin_geometries.shp')
+    upstream_nodes_dict = {'delMontague': ['cannonsville'], 'delTrenton': ['cannonsville', 'delMontague']}
+    monkeypatch.setattr(disaggregate, 'get_pywrdrb_node_lists',
+                        lambda: (upstream_nodes_dict, ['delMontague', 'delTrenton'], ['cannonsville']))
+
+    for _ in range(2):
+        g1 = disaggregate.get_node_basin_geometries(f'{tmp_path}/', cache_dir=f'{tmp_path}/cache/')
+        assert 'link_delMontague' not in set(g1['node'])
+        assert 'link_delMontague collapses' in capsys.readouterr().out
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from pywr_drb_network import get_pywrdrb_network
+from marginal_inflows import derive_marginal_inflows
+
+
+def get_constant_node_flows(n_days=10):
+    network = get_pywrdrb_network()
+    nodes = [str(n) for n in network.nodes]
+    index = pd.date_range('2000-01-01', periods=n_days)
+    return network, pd.DataFrame(1.0, index=index, columns=nodes)
+
+
+def test_nan_node_only_affects_its_downstream_node():
+    network, flows = get_constant_node_flows()
+    flows['cannonsville'] = np.nan
+
+    marginal, _ = derive_marginal_inflows({'test': flows}, network=network, clip_negative=False)
+    marginal = marginal['test']
+
+    downstream = network.get_downstream_nodes('cannonsville')[0]
+    nan_nodes = set(marginal.columns[marginal.isna().any()])
+    assert nan_nodes == {'cannonsville', downstream}
+
+
+def test_marginal_inflows_add_back_to_totals():
+    network, flows = get_constant_node_flows()
+    flows = flows.cumsum()
+
+    marginal, _ = derive_marginal_inflows({'test': flows}, network=network, clip_negative=False)
+    marginal = marginal['test']
+
+    # A node with upstream nodes gets its total minus their (lagged) totals
+    node = 'delTrenton'
+    upstream = network.get_immediate_upstream_nodes(node)
+    day = flows.index[-1]
+    expected = flows.loc[day, node] - sum(flows[u].shift(network.get_lag(u, node)).loc[day] for u in upstream)
+    assert np.isclose(marginal.loc[day, node], expected)
@@ -0,0 +1,20 @@
+import numpy as np
+import pandas as pd
+
+from pywr_drb_network import get_pywrdrb_network
+from marginal_inflows import derive_marginal_inflows
+from network_flows import accumulate_flows
+
+
+def test_accumulate_flows_inverts_derive_marginal_inflows():
+    network = get_pywrdrb_network()
+    nodes = [str(n) for n in network.nodes]
+    index = pd.date_range('2000-01-01', periods=10)
+    rng = np.random.default_rng(0)
+    marginal = pd.DataFrame(rng.random((len(index), len(nodes))), index=index, columns=nodes)
+
+    # Both modules assume the first upstream total before the start of the record
+    totals = accumulate_flows(marginal, network=network)
+    assert not totals.isna().any().any()
+    derived, _ = derive_marginal_inflows({'test': totals}, network=network, clip_negative=False)
+    assert np.allclose(derived['test'].values, marginal.values, atol=1e-5)
@@ -0,0 +1,37 @@
+import pipeline
+
+
+def make_stages(tmp_path):
+    script = tmp_path / 'stage.py'
+    script.write_text('from dataset_io import read_flow_dataset\n')
+    return {
+        'extract': {'script': str(script),
+                    'inputs': [str(tmp_path / 'source' / '*.nc')],
+                    'outputs': [str(tmp_path / 'extracted.csv')],
+                    'params': []},
+        'derive': {'script': str(script),
+                   'inputs': [str(tmp_path / 'extracted.csv')],
+                   'outputs': [str(tmp_path / 'derived.csv')],
+                   'params': []},
+    }
+
+
+def test_empty_glob_is_a_missing_input(tmp_path):
+    stages = make_stages(tmp_path)
+    status = pipeline.run_pipeline(stages, dry_run=True, state_file=str(tmp_path / 'state.json'))
+    assert status['extract'] == 'missing inputs'
+    assert status['derive'] == 'missing inputs'
+
+
+def test_existing_outputs_stand_in_for_missing_inputs(tmp_path):
+    stages = make_stages(tmp_path)
+    (tmp_path / 'extracted.csv').write_text('date,flow\n')
+    status = pipeline.run_pipeline(stages, dry_run=True, state_file=str(tmp_path / 'state.json'))
+    assert status['extract'] == 'up to date'
+    assert status['derive'] == 'would run'
+
+
+def test_fingerprint_includes_imported_repo_modules(tmp_path):
+    stages = make_stages(tmp_path)
+    assert 'dataset_io.py' in pipeline.get_local_modules(stages['derive']['script'])
+    assert 'instrumentation.py' in pipeline.get_local_modules(stages['derive']['script'])